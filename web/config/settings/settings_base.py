@@ -39,6 +39,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # first, so that it times all the others; does nothing unless INSTRUMENT_REQUESTS
+    'perma_payments.instrumentation.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -54,7 +56,9 @@ ROOT_URLCONF = 'config.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # the standard backend, but rendering is timed when INSTRUMENT_REQUESTS
+        'BACKEND': 'perma_payments.instrumentation.DjangoTemplates',
+        'NAME': 'django',
         'DIRS': [],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -84,9 +88,57 @@ DATABASES = {
         'PORT': 5432,
     }
 }
+# settings_prod keeps connections open between requests (CONN_MAX_AGE), checking them before reuse
+# (CONN_HEALTH_CHECKS). To pool them instead, see perma_payments/postgresql_pool/base.py.
 
 DEFAULT_AUTO_FIELD = "django.db.models.AutoField"
 
+# Aliases in DATABASES of read replicas of 'default', e.g. with
+#   DJANGO__DATABASES__replica__HOST=... (and the rest of its connection settings) and DJANGO__DATABASE_REPLICAS__0=replica.
+# Read-only views read from one of them: see perma_payments/routers.py.
+# Requires a default cache shared by all processes, or fails at startup: see CACHES, below.
+DATABASE_REPLICAS = []
+DATABASE_ROUTERS = ['perma_payments.routers.ReplicaRouter']
+# Once a customer's subscription or purchases change, read about them from the primary for this long:
+# comfortably longer than the replicas lag behind.
+REPLICA_PIN_SECONDS = 10
+
+
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+# Each process has its own local-memory cache, and forgetting an entry only forgets it
+# in the process that handled the change. The default cache holds each customer's cached
+# /subscription/ status and, with DATABASE_REPLICAS, their pin to the primary: to cache statuses,
+# or to use DATABASE_REPLICAS, configure a shared backend (e.g. DatabaseCache or Redis) instead. See the README and PER_PROCESS_CACHE_BACKENDS in utils/post_processing.py.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Nonces of recent messages from Perma, so that replays can be rejected: see security.is_replay.
+    # Bounded: when full, the least recently used are evicted. This is per process; to catch
+    # replays sent to a different worker, point it at a shared cache, e.g. Redis.
+    'perma_nonces': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'perma_nonces',
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+        },
+    },
+}
+
+# How long to cache each customer's response to /subscription/.
+# The cache is cleared whenever we record a change to the customer's subscription
+# or purchases; this bounds staleness from anything else (e.g. the passage of time).
+# If None, 60 if the default cache is shared, else 0: not cached. A positive timeout
+# with a per-process default cache fails at startup, as other processes wouldn't forget.
+SUBSCRIPTION_STATUS_CACHE_TIMEOUT = None
+
+# Refresh the subscription counts on the admin dashboard at most this often in response to changes
+# (per process, unless the default cache is shared). Changes in between show up at the next refresh:
+# run `invoke refresh-subscription-summary` from cron at about this interval to bound how long that takes.
+SUBSCRIPTION_SUMMARY_REFRESH_SECONDS = 60
+
 # Password validation
 # https://docs.djangoproject.com/en/1.11/ref/settings/#auth-password-validators
 
@@ -132,6 +184,21 @@ DEFAULT_CONTACT_EMAIL = DEFAULT_FROM_EMAIL
 DEFAULT_REPLYTO_EMAIL = DEFAULT_FROM_EMAIL
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 
+# Emails to ourselves are queued in the database, and sent by a background thread
+# of the web process. If False, they are sent as soon as they are queued, before responding;
+# either way, `invoke send-queued-emails` sends anything left in the queue.
+EMAIL_QUEUE_IN_THREAD = True
+# Failed sends are retried after 1 minute, then 2, 4, 8...
+EMAIL_QUEUE_RETRY_DELAY_SECONDS = 60
+EMAIL_QUEUE_MAX_ATTEMPTS = 8
+# How long a sender may take to send an email before someone else may try it
+EMAIL_QUEUE_LEASE_SECONDS = 300
+
+
+# Storage keys that full responses may still be encrypted with, each with its 'id' and 'vault_secret_key'.
+# Only needed while running `invoke reencrypt-full-responses`, to move them under STORAGE_ENCRYPTION_KEYS.
+RETIRED_STORAGE_ENCRYPTION_KEYS = []
+
 
 # Admin
 ADMIN_ENABLED = False
@@ -140,6 +207,19 @@ READONLY_ADMIN = True
 
 PERMA_TIMESTAMP_MAX_AGE_SECONDS = 120
 
+# Key pairs, besides PERMA_ENCRYPTION_KEYS, that Perma may encrypt its messages with: during a key rotation,
+# list the pair being rotated in or out here. Replies are always encrypted with PERMA_ENCRYPTION_KEYS.
+ACCEPTED_PERMA_ENCRYPTION_KEYS = []
+
+# The most customers Perma may ask about in one call to /subscriptions/
+MAX_CUSTOMERS_PER_REQUEST = 1000
+
+# The most purchases Perma may acknowledge in one call to /acknowledge-purchases/
+MAX_PURCHASES_PER_REQUEST = 1000
+
+# The most purchases /purchase-history/ returns in one page, when Perma asks for pages
+PURCHASE_HISTORY_PAGE_SIZE = 500
+
 # Direct all Perma.cc communications to perma dev by default
 PERMA_URL = 'https://perma-dev.org'
 PERMA_SUBSCRIPTION_CANCELED_REDIRECT_URL = 'https://perma-dev.org/settings/subscription/'
@@ -149,12 +229,38 @@ REGISTRAR_USERS_PATH = '/manage/registrar-users?registrar='
 
 # Direct all CyberSource communications to their test server by default
 CS_MODE = 'test'
+# Secret keys, besides CS_SECRET_KEY, that CyberSource may sign its replies with: while rotating
+# the Secure Acceptance profile's key, list the outgoing one here. We always sign with CS_SECRET_KEY.
+ACCEPTED_CS_SECRET_KEYS = []
 
 # Exception handling for bulk updating subscription statuses;
 # override if desired for easier testing (e.g., in dev)
 RAISE_IF_SUBSCRIPTION_NOT_FOUND = True
 RAISE_IF_MULTIPLE_SUBSCRIPTIONS_FOUND = True
 
+# Apply status reports queued from the admin in a background thread of the web process.
+# If False, queued reports are applied as soon as they are uploaded, before responding;
+# either way, `invoke process-status-update-jobs` applies anything left in the queue.
+STATUS_UPDATE_JOBS_IN_THREAD = True
+# A running job records its progress after every chunk of rows. One that hasn't for this long is
+# presumed abandoned (its worker killed, e.g. by a restart), and may be claimed or re-run.
+STATUS_UPDATE_JOB_LEASE_SECONDS = 600
+# How many of a report's problem rows (not found, duplicates, invalid) to list; the rest are only counted
+STATUS_UPDATE_MAX_PROBLEMS = 100
+
+# If True, CyberSource callbacks save the decision, and the full response sealed with the cheap
+# RESPONSE_STAGING_KEY, synchronously; it is encrypted for storage once the transaction commits:
+# see response_encryption.py. `invoke encrypt-pending-full-responses` finishes any left staged,
+# e.g. by a process that was killed.
+ENCRYPT_RESPONSES_IN_BACKGROUND = False
+# Required if ENCRYPT_RESPONSES_IN_BACKGROUND: generated using perma_payments.security.generate_staging_key.
+# Before changing it, run `invoke encrypt-pending-full-responses`.
+RESPONSE_STAGING_KEY = None
+# Encrypt deferred responses in a background thread of the web process; if False, right after commit.
+RESPONSE_ENCRYPTION_IN_THREAD = True
+# Past this many responses awaiting encryption, encrypt right after commit rather than queue
+RESPONSE_ENCRYPTION_QUEUE_LIMIT = 1000
+
 # If an annual subscription is scheduled to be renewed on the day we
 # update subscription statuses, we can't know the subscription's status
 # with certainty: has their card been charged yet today or not?
@@ -167,6 +273,19 @@ RAISE_IF_MULTIPLE_SUBSCRIPTIONS_FOUND = True
 # if 31: next month (that is, exactly as usual, as though this never happened)
 GRACE_PERIOD = 31
 
+# Per-request timing of database queries, crypto and template rendering;
+# see perma_payments/instrumentation.py. Reported in a Server-Timing header,
+# and/or as one JSON line per request from the perma_payments.instrumentation logger.
+INSTRUMENT_REQUESTS = False
+INSTRUMENTATION_SERVER_TIMING = False
+INSTRUMENTATION_LOG = True
+
+# /metrics/ is open to staff, and to scrapers sending "Authorization: Bearer <METRICS_TOKEN>", if set.
+# Its counters are per process: give the scraper one target per worker process (see the README).
+METRICS_TOKEN = None
+# Metrics that need aggregate queries are recomputed at most this often
+METRICS_GAUGE_CACHE_SECONDS = 60
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
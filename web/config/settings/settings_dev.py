@@ -8,6 +8,11 @@ DEBUG = True
 
 ALLOWED_HOSTS = ['*']
 
+# See timings for each request in your browser's dev tools
+INSTRUMENT_REQUESTS = True
+INSTRUMENTATION_SERVER_TIMING = True
+INSTRUMENTATION_LOG = False
+
 ADMIN_ENABLED = True
 ADMIN_URL = 'admin/'
 
@@ -20,6 +25,9 @@ STORAGE_ENCRYPTION_KEYS = {
     'vault_public_key': 'BfRkGEQ8j02ItW4wXtNbuWb+l75e5gHlaq75/9ZyXm8='
 }
 
+# This key is just for local development, and is safe to commit to the repo
+RESPONSE_STAGING_KEY = 'DgdZhjdXNi5qY9uITl7K2m8XbBwn0YuIp1iN9FXxhPI='
+
 # These keys are just for local development, and are safe to commit to the repo
 PERMA_ENCRYPTION_KEYS = {
     'id': 1,
@@ -2,6 +2,12 @@ from .settings_base import *
 
 DEBUG = False
 
+# Reuse each thread's database connection for up to a minute, rather than connecting for every request,
+# checking that it still works before the first query of each request.
+# Override with e.g. DJANGO__INT__DATABASES__default__CONN_MAX_AGE=0.
+DATABASES['default']['CONN_MAX_AGE'] = 60
+DATABASES['default']['CONN_HEALTH_CHECKS'] = True
+
 LOGGING['loggers'] = {
     '': {
         'handlers': ['file'],
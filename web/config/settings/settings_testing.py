@@ -3,6 +3,9 @@ from .settings_base import *
 # SECURITY WARNING: keep the secret key used in production secret!
 SECRET_KEY = 'k2#@_q=1$(__n7#(zax6#46fu)x=3&^lz&bwb8ol-_097k_rj5'
 
+# A second connection to the test database, standing in for a read replica in tests of routers.py
+DATABASES['replica'] = dict(DATABASES['default'], TEST={'MIRROR': 'default'})
+
 # CyberSource creds
 CS_ACCESS_KEY = 'test'
 CS_PROFILE_ID = 'test'
@@ -18,6 +21,9 @@ STORAGE_ENCRYPTION_KEYS = {
     'vault_public_key': 'vTbhNI1CtazbldwuOj14aGK9rHd41RdHii+p9TibcFU=',
 }
 
+# For staging full responses awaiting encryption: see ENCRYPT_RESPONSES_IN_BACKGROUND
+RESPONSE_STAGING_KEY = 'XRv5L6zluOjRfmRbWJC08pRaIK6s96eS7S9MQr21iYM='
+
 
 # Encryption keys for communicating with Perma.cc
 # generated using perma_payments.security.generate_public_private_keys
@@ -32,3 +38,20 @@ PERMA_ENCRYPTION_KEYS = {
 ADMINS = (
     ("Admin's Name", 'admin@example.com'),
 )
+
+# Apply queued status reports, send queued emails and encrypt deferred responses synchronously,
+# so tests can see the results
+STATUS_UPDATE_JOBS_IN_THREAD = False
+EMAIL_QUEUE_IN_THREAD = False
+RESPONSE_ENCRYPTION_IN_THREAD = False
+
+# Don't let cached responses leak between tests; tests of caching opt back in
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+    },
+    'perma_nonces': {
+        'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+    },
+}
+SUBSCRIPTION_STATUS_CACHE_TIMEOUT = 0
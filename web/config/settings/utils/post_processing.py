@@ -2,8 +2,33 @@
 # here we do stuff that should be checked or fixed after ALL settings from any source are loaded
 # this is called by __init__.py
 
+# Cache backends whose entries other processes can't see
+PER_PROCESS_CACHE_BACKENDS = {
+    'django.core.cache.backends.dummy.DummyCache',
+    'django.core.cache.backends.locmem.LocMemCache',
+}
+
 
 def post_process_settings(settings):
 
     # check secret key
     assert 'SECRET_KEY' in settings and settings['SECRET_KEY'] is not None, "Set DJANGO__SECRET_KEY env var!"
+
+    # deferred encryption stages full responses in the database with this key
+    assert not settings.get('ENCRYPT_RESPONSES_IN_BACKGROUND') or settings.get('RESPONSE_STAGING_KEY'), \
+        "Set DJANGO__RESPONSE_STAGING_KEY env var, to use ENCRYPT_RESPONSES_IN_BACKGROUND!"
+
+    # other processes can't see entries forgotten in a per-process cache: only cache statuses in a shared one
+    default_cache_is_shared = settings['CACHES']['default']['BACKEND'] not in PER_PROCESS_CACHE_BACKENDS
+    if settings.get('SUBSCRIPTION_STATUS_CACHE_TIMEOUT', None) is None:
+        settings['SUBSCRIPTION_STATUS_CACHE_TIMEOUT'] = 60 if default_cache_is_shared else 0
+    assert default_cache_is_shared or not settings['SUBSCRIPTION_STATUS_CACHE_TIMEOUT'], \
+        "Configure a shared default cache (e.g. Redis), to use a positive SUBSCRIPTION_STATUS_CACHE_TIMEOUT!"
+
+    # pins to the primary (see routers.py) must be seen by every process, or they may read stale replicas
+    assert default_cache_is_shared or not settings.get('DATABASE_REPLICAS'), \
+        "Configure a shared default cache (e.g. Redis), to use DATABASE_REPLICAS!"
+
+    # a read replica takes its settings from the primary, unless it sets its own: often, only HOST
+    for alias in settings.get('DATABASE_REPLICAS', []):
+        settings['DATABASES'][alias] = {**settings['DATABASES']['default'], **settings['DATABASES'].get(alias, {})}
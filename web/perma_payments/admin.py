@@ -4,7 +4,9 @@ from simple_history.admin import SimpleHistoryAdmin
 from django.conf import settings
 from django.contrib import admin
 from django.contrib.auth.models import Group, User
+from django.utils.decorators import method_decorator
 
+from .routers import reads_from_replica
 from .models import (
     PurchaseRequest,
     PurchaseRequestResponse,
@@ -15,6 +17,8 @@ from .models import (
     SubscriptionRequestResponse,
     UpdateRequestResponse,
     ChangeRequestResponse,
+    StatusUpdateJob,
+    OutgoingEmail,
 )
 
 # remove builtin models
@@ -47,12 +51,21 @@ class ReadOnlyTabularInline(NestedTabularInline):
         return False
 
 
+class ReplicaChangeListMixin:
+    """
+    Lists are read from a read replica, if there is one.
+    """
+    @method_decorator(reads_from_replica)
+    def changelist_view(self, request, extra_context=None):
+        return super().changelist_view(request, extra_context)
+
+
 ## Admin Models ##
 
 class UpdateRequestResponseInline(ReadOnlyTabularInline):
     model = UpdateRequestResponse
     fk_name = 'related_request'
-    exclude = ['full_response', 'polymorphic_ctype', 'response_ptr']
+    exclude = ['full_response', 'staged_full_response', 'polymorphic_ctype', 'response_ptr']
 
 
 class UpdateRequestInline(ReadOnlyTabularInline):
@@ -67,7 +80,7 @@ class UpdateRequestInline(ReadOnlyTabularInline):
 class ChangeRequestResponseInline(ReadOnlyTabularInline):
     model = ChangeRequestResponse
     fk_name = 'related_request'
-    exclude = ['full_response', 'polymorphic_ctype', 'response_ptr']
+    exclude = ['full_response', 'staged_full_response', 'polymorphic_ctype', 'response_ptr']
 
 
 class ChangeRequestInline(ReadOnlyTabularInline):
@@ -82,7 +95,7 @@ class ChangeRequestInline(ReadOnlyTabularInline):
 class SubscriptionRequestResponseInline(ReadOnlyTabularInline):
     model = SubscriptionRequestResponse
     fk_name = 'related_request'
-    exclude = ['full_response', 'polymorphic_ctype', 'response_ptr']
+    exclude = ['full_response', 'staged_full_response', 'polymorphic_ctype', 'response_ptr']
 
 
 class SubscriptionRequestInline(ReadOnlyTabularInline):
@@ -95,7 +108,7 @@ class SubscriptionRequestInline(ReadOnlyTabularInline):
 
 
 @admin.register(SubscriptionAgreement)
-class SubscriptionAgreementAdmin(NestedModelAdmin, SimpleHistoryAdmin):
+class SubscriptionAgreementAdmin(ReplicaChangeListMixin, NestedModelAdmin, SimpleHistoryAdmin):
     # If you need fields to be editable, but want to keep this order,
     # duplicate the tuple that is currently 'readonly_fields' as 'fields'.
     # Then, remove the field you want to be editable from readonly_fields.
@@ -133,11 +146,11 @@ class SubscriptionAgreementAdmin(NestedModelAdmin, SimpleHistoryAdmin):
 class PurchaseRequestResponseInline(ReadOnlyTabularInline):
     model = PurchaseRequestResponse
     fk_name = 'related_request'
-    exclude = ['full_response', 'polymorphic_ctype', 'response_ptr']
+    exclude = ['full_response', 'staged_full_response', 'polymorphic_ctype', 'response_ptr']
 
 
 @admin.register(PurchaseRequest)
-class PurchaseRequestAdmin(NestedModelAdmin):
+class PurchaseRequestAdmin(ReplicaChangeListMixin, NestedModelAdmin):
     # If you need fields to be editable, but want to keep this order,
     # duplicate the tuple that is currently 'readonly_fields' as 'fields'.
     # Then, remove the field you want to be editable from readonly_fields.
@@ -162,3 +175,43 @@ class PurchaseRequestAdmin(NestedModelAdmin):
         def save_model(self, request, obj, form, change):
             # Return nothing to make sure user can't update any data
             pass
+
+
+@admin.register(StatusUpdateJob)
+class StatusUpdateJobAdmin(ReplicaChangeListMixin, admin.ModelAdmin):
+    readonly_fields = ('id', 'status', 'created_date', 'created_by', 'started_at', 'last_progress_at', 'finished_at', 'rows_processed', 'updated', 'unchanged', 'not_found', 'duplicates', 'invalid', 'problems', 'error')
+    list_display = ('id', 'status', 'created_date', 'created_by', 'rows_processed', 'updated', 'not_found', 'duplicates', 'invalid')
+    list_filter = ('status',)
+
+    def has_add_permission(self, request, obj=None):
+        # Reports are uploaded via the form on the admin index page
+        return False
+
+    if settings.READONLY_ADMIN:
+        def has_delete_permission(self, request, obj=None):
+            # Disable delete
+            return False
+
+        def save_model(self, request, obj, form, change):
+            # Return nothing to make sure user can't update any data
+            pass
+
+
+@admin.register(OutgoingEmail)
+class OutgoingEmailAdmin(ReplicaChangeListMixin, admin.ModelAdmin):
+    readonly_fields = ('id', 'status', 'subject', 'body', 'from_email', 'to', 'reply_to', 'created_date', 'attempts', 'next_attempt_at', 'sent_at', 'last_error')
+    list_display = ('id', 'status', 'subject', 'created_date', 'attempts', 'next_attempt_at', 'sent_at')
+    list_filter = ('status',)
+
+    def has_add_permission(self, request, obj=None):
+        # Emails are queued by the application
+        return False
+
+    if settings.READONLY_ADMIN:
+        def has_delete_permission(self, request, obj=None):
+            # Disable delete
+            return False
+
+        def save_model(self, request, obj, form, change):
+            # Return nothing to make sure user can't update any data
+            pass
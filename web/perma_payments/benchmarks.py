@@ -0,0 +1,265 @@
+"""
+A load-testing harness for the routes Perma.cc and CyberSource talk to.
+
+Requests go through the whole Django stack (middleware, views, templates, database)
+via the test client, with payloads built the way the real clients build them:
+encrypted with the Perma key pair, or signed with the CyberSource secret.
+See `invoke benchmark-endpoints`, which runs this against a throwaway database.
+"""
+from collections import OrderedDict
+from datetime import datetime
+import statistics
+import threading
+import time
+
+from django.db import connection, connections, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from .models import CUSTOMER_TYPES
+from .security import encrypt_for_perma, sign_data, stringify_data, stringify_for_signature
+
+
+# Seeded customers get primary keys from here up; customers who subscribe during a run, from further up.
+FIRST_CUSTOMER_PK = 1000000
+NEW_CUSTOMER_PK_OFFSET = 1000000
+
+
+#
+# Seeding
+#
+
+def seed(customers=500, purchases_per_customer=5):
+    """
+    Creates `customers` customers, each with a current subscription that has been paid for,
+    and `purchases_per_customer` purchases that Perma has been told about and has acknowledged.
+    Returns the customers, as (customer_pk, customer_type) tuples.
+    """
+    from .tests.factories import PurchaseRequestResponseFactory, SubscriptionRequestResponseFactory  #noqa
+
+    seeded = []
+    with transaction.atomic():
+        for i in range(customers):
+            customer_pk, customer_type = FIRST_CUSTOMER_PK + i, CUSTOMER_TYPES[i % len(CUSTOMER_TYPES)]
+            SubscriptionRequestResponseFactory(
+                related_request__subscription_agreement__customer_pk=customer_pk,
+                related_request__subscription_agreement__customer_type=customer_type,
+                related_request__subscription_agreement__status='Current',
+                decision='ACCEPT',
+                reason_code=100,
+            )
+            for _ in range(purchases_per_customer):
+                PurchaseRequestResponseFactory(
+                    related_request__customer_pk=customer_pk,
+                    related_request__customer_type=customer_type,
+                    decision='ACCEPT',
+                    reason_code=100,
+                    inform_perma=True,
+                    perma_acknowledged_at=datetime.now().astimezone(),
+                )
+            seeded.append((customer_pk, customer_type))
+    return seeded
+
+
+#
+# Scenarios
+#
+# For each endpoint: a function that takes the seeded customers and a number of requests,
+# sets up anything those requests will use up, and returns the fields for each request;
+# how to encode those fields; and the template a successful response renders, if any.
+#
+
+def customer_fields(customers, n):
+    return [
+        {'customer_pk': customer_pk, 'customer_type': customer_type}
+        for customer_pk, customer_type in (customers[i % len(customers)] for i in range(n))
+    ]
+
+
+def purchase_fields(customers, n):
+    return [dict(fields, amount='25.00', link_quantity=10) for fields in customer_fields(customers, n)]
+
+
+def subscribe_fields(customers, n):
+    # only customers without a standing subscription can subscribe: make up new ones
+    return [
+        {
+            'customer_pk': FIRST_CUSTOMER_PK + NEW_CUSTOMER_PK_OFFSET + i,
+            'customer_type': CUSTOMER_TYPES[i % len(CUSTOMER_TYPES)],
+            'amount': '0.00',
+            'recurring_amount': '10.00',
+            'recurring_frequency': 'monthly',
+            'recurring_start_date': datetime.now().date().isoformat(),
+            'link_limit': '10',
+            'link_limit_effective_timestamp': datetime.now().timestamp(),
+        } for i in range(n)
+    ]
+
+
+def change_fields(customers, n):
+    return [
+        dict(fields, amount='5.00', recurring_amount='20.00', link_limit='20', link_limit_effective_timestamp=datetime.now().timestamp())
+        for fields in customer_fields(customers, n)
+    ]
+
+
+def acknowledge_purchase_fields(customers, n):
+    # each purchase can only be acknowledged once
+    from .tests.factories import PurchaseRequestResponseFactory  #noqa
+    with transaction.atomic():
+        purchases = [
+            PurchaseRequestResponseFactory(
+                related_request__customer_pk=customer['customer_pk'],
+                related_request__customer_type=customer['customer_type'],
+                decision='ACCEPT',
+                reason_code=100,
+                inform_perma=True,
+            ) for customer in customer_fields(customers, n)
+        ]
+    return [{'purchase_pk': purchase.pk} for purchase in purchases]
+
+
+def cybersource_callback_fields(customers, n):
+    # each request to CyberSource gets exactly one reply: alternate purchases and new subscriptions
+    from .tests.factories import PurchaseRequestFactory, SubscriptionRequestFactory  #noqa
+    with transaction.atomic():
+        outgoing = [
+            PurchaseRequestFactory(**customer) if i % 2 else SubscriptionRequestFactory(
+                subscription_agreement__customer_pk=customer['customer_pk'] + NEW_CUSTOMER_PK_OFFSET * 2,
+                subscription_agreement__customer_type=customer['customer_type'],
+            )
+            for i, customer in enumerate(customer_fields(customers, n))
+        ]
+    return [
+        {
+            'req_transaction_uuid': request.transaction_uuid,
+            'req_reference_number': request.reference_number,
+            'decision': 'ACCEPT',
+            'reason_code': '100',
+            'message': 'Request was processed successfully.',
+            'payment_token': 'x' * 26,
+        } for request in outgoing
+    ]
+
+
+def encode_for_perma_payments(fields):
+    """
+    What Perma POSTs. Its box and ours derive the same shared key, so ours can stand in for it.
+    """
+    return {'encrypted_data': encrypt_for_perma(stringify_data(dict(fields, timestamp=datetime.utcnow().timestamp()))).decode('ascii')}
+
+
+def encode_from_cybersource(fields):
+    """
+    What CyberSource POSTs: every field signed, and the signature.
+    """
+    signed_fields = OrderedDict(sorted(dict(fields, signed_date_time=datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ')).items()))
+    signed_fields['signed_field_names'] = ','.join(list(signed_fields) + ['signed_field_names'])
+    return dict(signed_fields, signature=sign_data(stringify_for_signature(signed_fields, sort=False)).decode('utf-8'))
+
+
+SCENARIOS = {
+    'purchase': (purchase_fields, encode_for_perma_payments, 'redirect.html'),
+    'subscribe': (subscribe_fields, encode_for_perma_payments, 'redirect.html'),
+    'change': (change_fields, encode_for_perma_payments, 'redirect.html'),
+    'update': (customer_fields, encode_for_perma_payments, 'redirect.html'),
+    'subscription': (customer_fields, encode_for_perma_payments, None),
+    'purchase_history': (customer_fields, encode_for_perma_payments, None),
+    'acknowledge_purchase': (acknowledge_purchase_fields, encode_for_perma_payments, None),
+    'cybersource_callback': (cybersource_callback_fields, encode_from_cybersource, 'generic.html'),
+}
+
+
+#
+# Running
+#
+
+def benchmark_endpoint(endpoint, customers, requests=200, concurrency=1):
+    """
+    POSTs `requests` requests to `endpoint`, from `concurrency` threads, and summarizes how it went.
+    Only the requests themselves are timed, not building their payloads.
+
+    With more than one thread, each needs its own database connection,
+    so the seeded data must have been committed.
+    """
+    get_fields, encode, expected_template = SCENARIOS[endpoint]
+    path = reverse(endpoint)
+    all_fields = get_fields(customers, requests)
+    samples = []
+    lock = threading.Lock()
+
+    def send(indices):
+        client = Client()
+        for i in indices:
+            data = encode(all_fields[i])
+            with CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                response = client.post(path, data)
+                elapsed = time.perf_counter() - start
+            ok = response.status_code == 200 and (
+                expected_template is None or expected_template in [template.name for template in response.templates]
+            )
+            with lock:
+                samples.append((elapsed, len(queries), ok))
+
+    def send_in_thread(indices):
+        try:
+            send(indices)
+        finally:
+            connections.close_all()
+
+    start = time.perf_counter()
+    if concurrency == 1:
+        send(range(requests))
+    else:
+        threads = [threading.Thread(target=send_in_thread, args=(range(t, requests, concurrency),)) for t in range(concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    wall_time = time.perf_counter() - start
+
+    return summarize(samples, wall_time)
+
+
+def summarize(samples, wall_time):
+    latencies = sorted(elapsed * 1000 for elapsed, _, _ in samples)
+    query_counts = [queries for _, queries, _ in samples]
+    percentiles = statistics.quantiles(latencies, n=100, method='inclusive') if len(latencies) > 1 else latencies * 99
+    return {
+        'requests': len(samples),
+        'errors': sum(1 for _, _, ok in samples if not ok),
+        'requests_per_second': round(len(samples) / wall_time, 1),
+        'latency_ms': {
+            'p50': round(percentiles[49], 2),
+            'p95': round(percentiles[94], 2),
+            'p99': round(percentiles[98], 2),
+            'max': round(latencies[-1], 2),
+        },
+        'queries_per_request': {
+            'mean': round(statistics.mean(query_counts), 2),
+            'max': max(query_counts),
+        },
+    }
+
+
+def compare(baseline, results):
+    """
+    Lists how each endpoint's median and p99 latency, and throughput, changed since `baseline`,
+    as (endpoint, metric, before, after, percent change) tuples.
+    """
+    changes = []
+    for endpoint, result in results['endpoints'].items():
+        before = baseline['endpoints'].get(endpoint)
+        if not before:
+            continue
+        for metric, get in [
+            ('p50', lambda r: r['latency_ms']['p50']),
+            ('p99', lambda r: r['latency_ms']['p99']),
+            ('rps', lambda r: r['requests_per_second']),
+            ('queries', lambda r: r['queries_per_request']['mean']),
+        ]:
+            old, new = get(before), get(result)
+            changes.append((endpoint, metric, old, new, (new - old) / old * 100 if old else 0))
+    return changes
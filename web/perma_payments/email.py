@@ -1,12 +1,26 @@
+from datetime import datetime, timedelta
+from pytz import timezone
+import threading
+
 from django.conf import settings
-from django.core.mail import EmailMessage
+from django.core.mail import EmailMessage, get_connection
+from django.db import connections, models, transaction
 from django.template import RequestContext, engines
 
+from .models import OutgoingEmail
+from .security import format_exception
+
+import logging
+logger = logging.getLogger(__name__)
+
 
 def send_self_email(title, request, template="email/default.txt", context={}, devs_only=True):
     """
         Send a message to ourselves. By default, sends only to settings.ADMINS.
         To contact the main Perma email address, set devs_only=False
+
+        The message is queued, and sent in the background once the current transaction commits:
+        see send_queued_emails.
     """
     # load the django template engine directly, so that we can
     # pass in a Context/RequestContext object with autocomplete=False
@@ -18,18 +32,161 @@ def send_self_email(title, request, template="email/default.txt", context={}, de
     email_text = engine.get_template(template).render(RequestContext(request, context, autoescape=False))
 
     if devs_only:
-        EmailMessage(
+        queue_email(
             title,
             email_text,
             settings.DEFAULT_FROM_EMAIL,
             [admin[1] for admin in settings.ADMINS]
-        ).send(fail_silently=False)
+        )
     else:
         # Use a special reply-to address to avoid Freshdesk's filters: a ticket will be opened.
-        EmailMessage(
+        queue_email(
             title,
             email_text,
             settings.DEFAULT_FROM_EMAIL,
             [settings.DEFAULT_FROM_EMAIL],
             reply_to=[settings.DEFAULT_REPLYTO_EMAIL]
+        )
+
+
+#
+# The queue
+#
+
+def now():
+    return datetime.now(tz=timezone(settings.TIME_ZONE))
+
+
+def queue_email(subject, body, from_email, to, reply_to=()):
+    email = OutgoingEmail(
+        subject=subject,
+        body=body,
+        from_email=from_email,
+        to=list(to),
+        reply_to=list(reply_to),
+        next_attempt_at=now()
+    )
+    email.save()
+    transaction.on_commit(start_email_sender)
+    return email
+
+
+# At most one sender thread per process, sharing one SMTP connection;
+# woken whenever something new is queued.
+_sender_running = threading.Lock()
+_wake_sender = threading.Event()
+
+
+def start_email_sender():
+    if not settings.EMAIL_QUEUE_IN_THREAD:
+        send_queued_emails()
+        return
+    _wake_sender.set()
+    if _sender_running.acquire(blocking=False):
+        threading.Thread(target=run_email_sender_thread, name='email-sender', daemon=True).start()
+
+
+def run_email_sender_thread():
+    """
+    Sends queued emails until there are none left, sleeping until any retries are due.
+
+    If the process exits first, queued emails stay queued: `invoke send-queued-emails` drains the queue.
+    """
+    try:
+        while True:
+            try:
+                while True:
+                    _wake_sender.clear()
+                    delay = send_queued_emails()
+                    if delay is None and not _wake_sender.is_set():
+                        break
+                    _wake_sender.wait(timeout=delay)
+            finally:
+                _sender_running.release()
+            # Something queued after the check above, but before the release, found this thread
+            # still running and so didn't start another: unless someone else has since, send it.
+            if not (_wake_sender.is_set() and _sender_running.acquire(blocking=False)):
+                return
+    finally:
+        # each thread gets its own database connections: don't leak them
+        connections.close_all()
+
+
+def send_queued_emails():
+    """
+    Sends every queued email that is due, over a single SMTP connection.
+    Any number of senders can run at once: each attempt is claimed by exactly one.
+
+    Returns the number of seconds until the next retry is due, or None if nothing is left in the queue.
+    """
+    connection = None
+    try:
+        while True:
+            email = claim_email()
+            if email is None:
+                break
+            if connection is None:
+                connection = get_connection()
+            if not send_email(email, connection):
+                # the connection may be broken: start again with the next email
+                connection.close()
+                connection = None
+    finally:
+        if connection is not None:
+            connection.close()
+
+    next_attempt_at = OutgoingEmail.objects.filter(status='Queued').aggregate(next=models.Min('next_attempt_at'))['next']
+    if next_attempt_at is None:
+        return None
+    return max((next_attempt_at - now()).total_seconds(), 0)
+
+
+def claim_email():
+    """
+    Takes a lease on the oldest email that is due: while it lasts, no one else will try to send it.
+    If we die without sending or releasing it, it will be tried again once the lease is up.
+    """
+    with transaction.atomic():
+        email = OutgoingEmail.objects.select_for_update(skip_locked=True).filter(
+            status='Queued',
+            next_attempt_at__lte=now()
+        ).order_by('next_attempt_at', 'id').first()
+        if email is None:
+            return None
+        email.attempts += 1
+        email.next_attempt_at = now() + timedelta(seconds=settings.EMAIL_QUEUE_LEASE_SECONDS)
+        email.save(update_fields=['attempts', 'next_attempt_at'])
+    return email
+
+
+def send_email(email, connection):
+    """
+    Tries to send a claimed email. On failure, backs off exponentially before the next attempt,
+    until EMAIL_QUEUE_MAX_ATTEMPTS have been made. Returns whether the email was sent.
+    """
+    try:
+        connection.open()
+        EmailMessage(
+            email.subject,
+            email.body,
+            email.from_email,
+            email.to,
+            reply_to=email.reply_to,
+            connection=connection
         ).send(fail_silently=False)
+    except Exception as e:
+        email.last_error = format_exception(e)
+        if email.attempts >= settings.EMAIL_QUEUE_MAX_ATTEMPTS:
+            email.status = 'Failed'
+            logger.error("Giving up on {} after {} attempts: {}".format(email, email.attempts, email.last_error))
+        else:
+            delay = settings.EMAIL_QUEUE_RETRY_DELAY_SECONDS * 2 ** (email.attempts - 1)
+            email.next_attempt_at = now() + timedelta(seconds=delay)
+            logger.warning("Failed to send {} (attempt {}); retrying in {}s: {}".format(email, email.attempts, delay, email.last_error))
+        email.save(update_fields=['status', 'next_attempt_at', 'last_error'])
+        return False
+
+    email.status = 'Sent'
+    email.sent_at = now()
+    email.save(update_fields=['status', 'sent_at'])
+    return True
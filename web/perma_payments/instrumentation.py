@@ -0,0 +1,166 @@
+"""
+Opt-in, per-request instrumentation.
+
+When settings.INSTRUMENT_REQUESTS is on, InstrumentationMiddleware records, for each request:
+how many database queries were made and how long they took, how long was spent in each
+function decorated with @timed (our crypto), how long templates took to render, and the total.
+The results go to a Server-Timing header (handy in the browser's dev tools), if
+settings.INSTRUMENTATION_SERVER_TIMING is on, and/or to one JSON log line per request,
+if settings.INSTRUMENTATION_LOG is on. Total time also goes to a histogram, by view: see metrics.py.
+
+Outside an instrumented request, @timed and timer() cost one context variable lookup.
+"""
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+from functools import wraps
+import json
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.template.backends import django as django_backend
+
+from .metrics import REQUEST_DURATION
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+_current_timings = ContextVar('request_timings', default=None)
+
+
+class RequestTimings:
+    """
+    How many times each named span ran during a request, and how long they took altogether, in seconds.
+    """
+    def __init__(self):
+        self.spans = {}
+        self.total = 0.0
+
+    def add(self, name, seconds):
+        span = self.spans.setdefault(name, [0, 0.0])
+        span[0] += 1
+        span[1] += seconds
+
+    def time_query(self, execute, sql, params, many, context):
+        """
+        A database execute_wrapper: https://docs.djangoproject.com/en/4.2/topics/db/instrumentation/
+        """
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.add('db', time.perf_counter() - start)
+
+    def server_timing(self):
+        metrics = ['{};dur={:.2f};desc="{}x"'.format(name, seconds * 1000, count) for name, (count, seconds) in self.spans.items()]
+        metrics.append('total;dur={:.2f}'.format(self.total * 1000))
+        return ', '.join(metrics)
+
+    def as_dict(self):
+        return {
+            'total_ms': round(self.total * 1000, 2),
+            **{
+                name: {'count': count, 'ms': round(seconds * 1000, 2)}
+                for name, (count, seconds) in self.spans.items()
+            }
+        }
+
+
+@contextmanager
+def timer(name):
+    """
+    Adds the time spent in the block to the current request's span `name`, if the request is being instrumented.
+    """
+    timings = _current_timings.get()
+    if timings is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - start)
+
+
+def timed(func):
+    """
+    Adds the time spent in the decorated function to the current request's span of the same name,
+    if the request is being instrumented.
+
+    Goes beneath @sensitive_variables(), so that its frame is scrubbed from error reports too.
+    """
+    name = func.__name__
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        timings = _current_timings.get()
+        if timings is None:
+            return func(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            timings.add(name, time.perf_counter() - start)
+    return wrapper
+
+
+class InstrumentationMiddleware:
+    """
+    Goes first in MIDDLEWARE, so that the total includes all the others.
+    """
+    def __init__(self, get_response):
+        if not settings.INSTRUMENT_REQUESTS:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        timings = RequestTimings()
+        token = _current_timings.set(timings)
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(timings.time_query))
+                start = time.perf_counter()
+                response = self.get_response(request)
+                timings.total = time.perf_counter() - start
+        finally:
+            _current_timings.reset(token)
+
+        view = request.resolver_match.view_name if request.resolver_match else None
+        REQUEST_DURATION.observe(timings.total, view=view or 'unresolved')
+        if settings.INSTRUMENTATION_SERVER_TIMING:
+            response['Server-Timing'] = timings.server_timing()
+        if settings.INSTRUMENTATION_LOG:
+            logger.info(json.dumps({
+                'view': view,
+                'method': request.method,
+                'status': response.status_code,
+                **timings.as_dict()
+            }))
+        return response
+
+
+#
+# Template rendering
+#
+
+class InstrumentedTemplate(django_backend.Template):
+
+    def render(self, context=None, request=None):
+        with timer('template'):
+            return super().render(context, request)
+
+
+class DjangoTemplates(django_backend.DjangoTemplates):
+    """
+    The standard Django template backend, but rendering is timed.
+    """
+
+    def from_string(self, template_code):
+        return InstrumentedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        template = super().get_template(template_name)
+        return InstrumentedTemplate(template.template, self)
@@ -0,0 +1,131 @@
+"""
+Re-sealing stored full responses under a new storage key.
+
+To rotate STORAGE_ENCRYPTION_KEYS: put the new keys in STORAGE_ENCRYPTION_KEYS, list the old ones,
+with their vault_secret_keys, in RETIRED_STORAGE_ENCRYPTION_KEYS, and run `invoke reencrypt-full-responses`.
+That should be done from a machine trusted with the vault secret keys, as for decrypt_from_storage.
+
+Rows are read in chunks, in id order, by keyset pagination: nothing holds a long transaction, and only one chunk
+is in memory at a time. Each chunk is decrypted and re-encrypted by a pool of worker processes, then written
+back in one bulk_update. Rows are only selected if their key is retired, so a run that stops partway can
+simply be started again; or, to skip straight to where it stopped, pass the last id it reported.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from nacl import encoding
+from nacl.exceptions import CryptoError
+import os
+import time
+
+from django.conf import settings
+from django.views.decorators.debug import sensitive_variables
+
+from .models import Response
+from .security import build_storage_decryption_box, build_storage_encryption_box
+
+import logging
+logger = logging.getLogger(__name__)
+
+# How many rows to read, re-seal and write back at once
+REENCRYPTION_CHUNK_SIZE = 500
+
+
+#
+# Worker processes
+#
+
+# per process: key id -> decryption box for each retired key, and the encryption box for the new key
+_retired_boxes = {}
+_current_box = None
+
+
+@sensitive_variables()
+def init_resealer(retired_keys, current_keys):
+    global _current_box
+    _retired_boxes.clear()
+    for keys in retired_keys:
+        _retired_boxes[keys['id']] = build_storage_decryption_box(keys, encoding.Base64Encoder)
+    _current_box = build_storage_encryption_box(current_keys, encoding.Base64Encoder)
+
+
+@sensitive_variables()
+def reseal(rows):
+    """
+    Takes (id, encryption_key_id, full_response) tuples; returns (id, new full_response) tuples.
+    The new full_response is None if the old one couldn't be decrypted.
+    """
+    resealed = []
+    for pk, key_id, full_response in rows:
+        try:
+            resealed.append((pk, _current_box.encrypt(_retired_boxes[key_id].decrypt(full_response))))
+        except CryptoError:
+            resealed.append((pk, None))
+    return resealed
+
+
+#
+# Coordination
+#
+
+def reencrypt_full_responses(after_id=0, chunk_size=REENCRYPTION_CHUNK_SIZE, processes=None, progress=None):
+    """
+    Re-seals the full response of every Response whose encryption_key_id is in RETIRED_STORAGE_ENCRYPTION_KEYS,
+    under STORAGE_ENCRYPTION_KEYS, starting after Response `after_id`.
+
+    Work is spread over `processes` worker processes (default: one per CPU); with processes=0, it is done here.
+    After each chunk, calls progress(summary) with the running totals, if given.
+    Rows that can't be decrypted are logged and left as they are.
+    """
+    retired_keys = settings.RETIRED_STORAGE_ENCRYPTION_KEYS
+    current_keys = settings.STORAGE_ENCRYPTION_KEYS
+    retired_ids = [keys['id'] for keys in retired_keys]
+    if current_keys['id'] in retired_ids:
+        raise ValueError("Key {} is both current and retired.".format(current_keys['id']))
+
+    rows = Response.objects.non_polymorphic().filter(
+        encryption_key_id__in=retired_ids,
+        full_response_pending=False
+    ).order_by('id')
+    summary = {'rows': 0, 'failed': [], 'last_id': after_id, 'seconds': 0.0, 'rows_per_second': 0.0}
+    start = time.perf_counter()
+
+    if processes is None:
+        processes = os.cpu_count()
+    if processes:
+        pool = ProcessPoolExecutor(processes, initializer=init_resealer, initargs=(retired_keys, current_keys))
+    else:
+        pool = None
+        init_resealer(retired_keys, current_keys)
+    try:
+        while True:
+            chunk = [
+                # the database hands back memoryviews, which can't be sent to other processes
+                (pk, key_id, bytes(full_response))
+                for pk, key_id, full_response in rows.filter(id__gt=summary['last_id']).values_list('id', 'encryption_key_id', 'full_response')[:chunk_size]
+            ]
+            if not chunk:
+                break
+            if pool is None:
+                resealed = reseal(chunk)
+            else:
+                batch_size = -(-len(chunk) // processes)
+                resealed = [row for batch in pool.map(reseal, [chunk[i:i + batch_size] for i in range(0, len(chunk), batch_size)]) for row in batch]
+
+            updated = []
+            for pk, full_response in resealed:
+                if full_response is None:
+                    logger.error("Couldn't decrypt the full response of Response {}: left under its old key.".format(pk))
+                    summary['failed'].append(pk)
+                else:
+                    updated.append(Response(id=pk, full_response=full_response, encryption_key_id=current_keys['id']))
+            Response.objects.non_polymorphic().bulk_update(updated, ['full_response', 'encryption_key_id'])
+
+            summary['rows'] += len(updated)
+            summary['last_id'] = chunk[-1][0]
+            summary['seconds'] = time.perf_counter() - start
+            summary['rows_per_second'] = summary['rows'] / summary['seconds']
+            if progress:
+                progress(summary)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return summary
@@ -0,0 +1,179 @@
+"""
+Payment flow metrics, exposed in the Prometheus text format at /metrics/:
+https://prometheus.io/docs/instrumenting/exposition_formats/#text-based-format
+
+Counters and histograms are kept in this process's memory, and count from when it started;
+Prometheus copes with restarts, and sums across processes at query time. They are not shared
+between processes, so they only make sense if each scrape target is one process: scraped
+through a load balancer over several workers, they describe whichever worker answered.
+Gauges describe the whole database: they come from aggregate queries, cached for
+METRICS_GAUGE_CACHE_SECONDS so that scraping stays cheap however often it happens.
+"""
+from collections import defaultdict
+import math
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+GAUGES_CACHE_KEY = 'metrics-gauges'
+
+REGISTRY = []
+
+
+def format_value(value):
+    return '+Inf' if value == math.inf else str(value)
+
+
+def escape_label_value(value):
+    return format_value(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def format_sample(name, labels, value):
+    if labels:
+        name = '{}{{{}}}'.format(name, ','.join('{}="{}"'.format(k, escape_label_value(v)) for k, v in labels.items()))
+    return '{} {}'.format(name, format_value(value))
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, help, labels=(), registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        registry.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.type)]
+        lines.extend(format_sample(name, labels, value) for name, labels, value in self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.values = defaultdict(float)
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] += amount
+
+    def value(self, **labels):
+        return self.values.get(self.key(labels), 0)
+
+    def samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        for key, value in values:
+            yield self.name, dict(zip(self.labels, key)), value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+    DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+    def __init__(self, *args, buckets=DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(buckets) + (math.inf,)
+        # per set of labels: a count for each bucket, and the sum of all observations
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self.values[key] = (counts, total + value)
+
+    def samples(self):
+        with self.lock:
+            values = sorted((key, (list(counts), total)) for key, (counts, total) in self.values.items())
+        for key, (counts, total) in values:
+            labels = dict(zip(self.labels, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield self.name + '_bucket', dict(labels, le=bound), cumulative
+            yield self.name + '_sum', labels, total
+            yield self.name + '_count', labels, cumulative
+
+
+#
+# The metrics
+#
+
+CYBERSOURCE_CALLBACKS = Counter(
+    'perma_payments_cybersource_callbacks_total',
+    'Validly signed replies from CyberSource, recorded, by decision and reason code. Duplicates are counted separately.',
+    ['decision', 'reason_code']
+)
+CYBERSOURCE_DUPLICATE_CALLBACKS = Counter(
+    'perma_payments_cybersource_duplicate_callbacks_total',
+    'Replies from CyberSource to requests whose reply had already been recorded, and so were ignored.'
+)
+INVALID_TRANSMISSIONS = Counter(
+    'perma_payments_invalid_transmissions_total',
+    'POSTs rejected before being acted on, by sender and reason.',
+    ['source', 'reason']
+)
+PERMA_DECRYPTIONS = Counter(
+    'perma_payments_perma_decryptions_total',
+    'Messages from Perma decrypted, by the id of the key pair that decrypted them.',
+    ['key_id']
+)
+REFERENCE_NUMBER_COLLISIONS = Counter(
+    'perma_payments_reference_number_collisions_total',
+    'Reference numbers drawn that were already taken, so had to be drawn again.'
+)
+REQUEST_DURATION = Histogram(
+    'perma_payments_request_duration_seconds',
+    'Time to respond, by view. Only recorded when INSTRUMENT_REQUESTS is on.',
+    ['view']
+)
+
+
+def gauges():
+    """
+    Renders the metrics that come from the database. Cached: see render_metrics.
+    """
+    from .models import PurchaseRequestResponse, Response, SubscriptionAgreement  #noqa
+
+    by_status = dict.fromkeys((status for status, _ in SubscriptionAgreement._meta.get_field('status').choices), 0)
+    by_status.update(
+        (row['status'], row['count'])
+        for row in SubscriptionAgreement.objects.order_by().values('status').annotate(count=Count('id'))
+    )
+    awaiting_acknowledgement = PurchaseRequestResponse.objects.filter(inform_perma=True, perma_acknowledged_at__isnull=True).count()
+    pending_cancellations = SubscriptionAgreement.objects.filter(cancellation_requested=True).exclude(status='Canceled').count()
+    full_responses_pending = Response.objects.non_polymorphic().filter(full_response_pending=True).count()
+
+    sections = [
+        ('perma_payments_subscriptions', 'Subscription agreements, by status.', [({'status': status}, count) for status, count in by_status.items()]),
+        ('perma_payments_purchases_awaiting_acknowledgement', 'Purchases Perma has been told about, but has not yet acknowledged.', [({}, awaiting_acknowledgement)]),
+        ('perma_payments_cancellation_requests_pending', 'Requested cancellations not yet carried out in CyberSource.', [({}, pending_cancellations)]),
+        ('perma_payments_full_responses_pending', 'CyberSource responses whose full response has not yet been encrypted and stored.', [({}, full_responses_pending)]),
+    ]
+    return '\n'.join(
+        '\n'.join(['# HELP {} {}'.format(name, help), '# TYPE {} gauge'.format(name)] + [format_sample(name, labels, value) for labels, value in samples])
+        for name, help, samples in sections
+    )
+
+
+def render_metrics(registry=REGISTRY):
+    return '\n'.join(
+        [metric.render() for metric in registry] +
+        [cache.get_or_set(GAUGES_CACHE_KEY, gauges, settings.METRICS_GAUGE_CACHE_SECONDS)]
+    ) + '\n'
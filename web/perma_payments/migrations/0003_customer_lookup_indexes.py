@@ -0,0 +1,27 @@
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # Build indexes without locking out writes: these tables are live.
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction.
+    atomic = False
+
+    dependencies = [
+        ('perma_payments', '0002_auto_20200817_1809'),
+    ]
+
+    operations = [
+        AddIndexConcurrently(
+            model_name='subscriptionagreement',
+            index=models.Index(condition=models.Q(('status__in', ['Current', 'Hold', 'Canceled'])), fields=['customer_type', 'customer_pk'], name='sa_standing_customer_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='purchaserequest',
+            index=models.Index(fields=['customer_type', 'customer_pk'], name='pr_customer_idx'),
+        ),
+        AddIndexConcurrently(
+            model_name='purchaserequestresponse',
+            index=models.Index(condition=models.Q(('inform_perma', True), ('perma_acknowledged_at__isnull', True)), fields=['related_request'], name='prr_unacknowledged_idx'),
+        ),
+    ]
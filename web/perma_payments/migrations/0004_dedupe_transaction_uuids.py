@@ -0,0 +1,34 @@
+import logging
+import uuid
+
+from django.db import migrations
+from django.db.models import Count
+
+logger = logging.getLogger(__name__)
+
+
+def dedupe_transaction_uuids(apps, schema_editor):
+    """
+    Keep the oldest transaction with any given transaction_uuid;
+    issue the others new ones, so that the field can be made unique.
+    """
+    OutgoingTransaction = apps.get_model('perma_payments', 'OutgoingTransaction')
+    duplicated = OutgoingTransaction.objects.values('transaction_uuid').annotate(
+        count=Count('id')
+    ).filter(count__gt=1).values_list('transaction_uuid', flat=True)
+    for transaction_uuid in duplicated:
+        for transaction in OutgoingTransaction.objects.filter(transaction_uuid=transaction_uuid).order_by('id')[1:]:
+            transaction.transaction_uuid = uuid.uuid4()
+            transaction.save(update_fields=['transaction_uuid'])
+            logger.warning("Reassigned duplicate transaction_uuid {} of OutgoingTransaction {}: now {}".format(transaction_uuid, transaction.id, transaction.transaction_uuid))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('perma_payments', '0003_customer_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_transaction_uuids, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+from django.db import migrations, models
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('perma_payments', '0004_dedupe_transaction_uuids'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='outgoingtransaction',
+            name='transaction_uuid',
+            field=models.UUIDField(default=uuid.uuid4, help_text="A unique ID for this 'transaction'. Intended to protect against duplicate transactions.", unique=True),
+        ),
+    ]
@@ -0,0 +1,45 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('perma_payments', '0006_statusupdatejob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReferenceNumber',
+            fields=[
+                ('reference_number', models.CharField(max_length=32, primary_key=True, serialize=False)),
+                ('created_date', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        # numbers are now allocated as requests are first saved (see models.allocate_reference_number),
+        # rather than by the field's default: no change to the database
+        migrations.AlterField(
+            model_name='purchaserequest',
+            name='reference_number',
+            field=models.CharField(blank=True, help_text="Unique ID for this purchase. Called 'Merchant Reference Number' in CyberSource Business Center. Allocated when first saved, if not supplied.", max_length=32),
+        ),
+        migrations.AlterField(
+            model_name='subscriptionrequest',
+            name='reference_number',
+            field=models.CharField(blank=True, help_text="Unique ID for this subscription. Subsequent charges, automatically made by CyberSource on the recurring schedule, will all be associated with this reference number. Called 'Merchant Reference Number' in CyberSource Business Center. Allocated when first saved, if not supplied.", max_length=32),
+        ),
+        # register every reference number already in use, as of when it was first used
+        migrations.RunSQL(
+            """
+            INSERT INTO perma_payments_referencenumber (reference_number, created_date)
+            SELECT r.reference_number, min(t.request_datetime)
+            FROM (
+                SELECT outgoingtransaction_ptr_id, reference_number FROM perma_payments_subscriptionrequest
+                UNION ALL
+                SELECT outgoingtransaction_ptr_id, reference_number FROM perma_payments_purchaserequest
+            ) r
+            JOIN perma_payments_outgoingtransaction t ON t.id = r.outgoingtransaction_ptr_id
+            GROUP BY r.reference_number;
+            """,
+            migrations.RunSQL.noop,
+        ),
+    ]
@@ -0,0 +1,29 @@
+from django.contrib.postgres.operations import AddIndexConcurrently
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    # Build the index without locking out writes: CyberSource may call back at any time.
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction.
+    atomic = False
+
+    dependencies = [
+        ('perma_payments', '0008_outgoingemail'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='response',
+            name='full_response_pending',
+            field=models.BooleanField(default=False, help_text='Whether full_response is still waiting to be encrypted and stored. See ENCRYPT_RESPONSES_IN_BACKGROUND.'),
+        ),
+        migrations.AddField(
+            model_name='response',
+            name='staged_full_response',
+            field=models.BinaryField(blank=True, default=b'', help_text='While full_response_pending, the full response, encrypted with RESPONSE_STAGING_KEY.'),
+        ),
+        AddIndexConcurrently(
+            model_name='response',
+            index=models.Index(condition=models.Q(('full_response_pending', True)), fields=['id'], name='response_pending_idx'),
+        ),
+    ]
@@ -0,0 +1,45 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('perma_payments', '0009_response_full_response_pending'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            # REFRESH ... CONCURRENTLY needs a unique index that covers every row
+            """
+            CREATE MATERIALIZED VIEW perma_payments_subscriptionsummary AS
+            SELECT
+                row_number() OVER (ORDER BY status, coalesce(current_frequency, ''), cancellation_requested) AS id,
+                status,
+                coalesce(current_frequency, '') AS frequency,
+                cancellation_requested,
+                count(*) AS subscriptions,
+                coalesce(sum(current_rate), 0) AS total_rate,
+                now() AS refreshed_at
+            FROM perma_payments_subscriptionagreement
+            GROUP BY status, coalesce(current_frequency, ''), cancellation_requested;
+            CREATE UNIQUE INDEX subscriptionsummary_group_idx ON perma_payments_subscriptionsummary (status, frequency, cancellation_requested);
+            """,
+            "DROP MATERIALIZED VIEW perma_payments_subscriptionsummary;"
+        ),
+        migrations.CreateModel(
+            name='SubscriptionSummary',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('status', models.CharField(max_length=20)),
+                ('frequency', models.CharField(max_length=20)),
+                ('cancellation_requested', models.BooleanField()),
+                ('subscriptions', models.IntegerField()),
+                ('total_rate', models.DecimalField(decimal_places=2, max_digits=19)),
+                ('refreshed_at', models.DateTimeField()),
+            ],
+            options={
+                'db_table': 'perma_payments_subscriptionsummary',
+                'managed': False,
+            },
+        ),
+    ]
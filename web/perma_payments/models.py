@@ -1,17 +1,24 @@
 import calendar
+from collections import Counter, defaultdict
 import datetime
 from dateutil.relativedelta import relativedelta
+from decimal import Decimal
 import random
 from uuid import uuid4
 from polymorphic.models import PolymorphicModel
 from pytz import timezone
 from simple_history.models import HistoricalRecords
+from simple_history.utils import bulk_update_with_history
 
 from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import IntegrityError, connection, models, transaction
 
-from .security import encrypt_for_storage, stringify_data
+from .metrics import REFERENCE_NUMBER_COLLISIONS
+from .routers import pin_to_primary
+from .security import encrypt_for_staging, encrypt_for_storage, stringify_data
 
 import logging
 logger = logging.getLogger(__name__)
@@ -22,8 +29,16 @@ logger = logging.getLogger(__name__)
 
 RN_SET = "0123456789"
 REFERENCE_NUMBER_PREFIX = "PERMA"
+# PERMA-NNNN-NNNN
+REFERENCE_NUMBER_KEYSPACE = len(RN_SET) ** 8
 STANDING_STATUSES = ['Current', 'Hold']
+# select_related plans for SubscriptionAgreement.customer_standing_subscription
+WITH_SUBSCRIPTION_REQUEST = ['subscription_request']
+WITH_SUBSCRIPTION_REQUEST_RESPONSE = ['subscription_request__subscription_request_response']
 CUSTOMER_TYPES = ['Registrar', 'Individual']
+# How many rows of a CyberSource subscription report to resolve and write at once
+STATUS_REPORT_CHUNK_SIZE = 500
+SUBSCRIPTION_SUMMARY_REFRESH_CACHE_KEY = 'subscription-summary-refreshed'
 
 
 #
@@ -34,8 +49,13 @@ def generate_reference_number():
     """
     Generate a unique, human-friendly reference number. Based on Perma GUID generation.
 
+    Numbers are allocated by claiming them in the ReferenceNumber registry,
+    which covers both SubscriptionRequests and PurchaseRequests: one INSERT per attempt,
+    retried with a fresh candidate if the number is taken.
+
     Only make 100 attempts:
     If there are frequent collisions, expand the keyspace or change the prefix.
+    See ReferenceNumber.occupancy.
     """
     # temp until we upgrade to 3.6 and random.choices is available
     def choices(chars, k):
@@ -47,15 +67,114 @@ def generate_reference_number():
             choices(RN_SET, k=4),
             choices(RN_SET, k=4)
         )
-        if is_ref_number_available(rn):
+        if reserve_reference_number(rn):
             break
     else:
         raise Exception("No valid reference_number found in 100 attempts.")
+    if i:
+        REFERENCE_NUMBER_COLLISIONS.inc(i)
+        logger.info("Allocated reference number after {} collisions".format(i))
     return rn
 
 
-def is_ref_number_available(rn):
-    return not SubscriptionRequest.objects.filter(reference_number=rn).exists() and not PurchaseRequest.objects.filter(reference_number=rn).exists()
+def reserve_reference_number(rn):
+    """
+    Claim a reference number in the registry. Returns False if it was already taken.
+    """
+    try:
+        # a savepoint, so that a collision doesn't break any enclosing transaction
+        with transaction.atomic():
+            ReferenceNumber.objects.create(reference_number=rn)
+    except IntegrityError:
+        return False
+    return True
+
+
+def allocate_reference_number(request):
+    """
+    Claim a SubscriptionRequest's or PurchaseRequest's reference number in the registry, as it is first saved,
+    generating one if it wasn't given one. Raises IntegrityError if the number it was given is already taken.
+    """
+    if not request.reference_number:
+        request.reference_number = generate_reference_number()
+    elif not reserve_reference_number(request.reference_number):
+        raise IntegrityError("Reference number {} is already taken.".format(request.reference_number))
+
+
+def customers_filter(customers, prefix=''):
+    """
+    Matches rows belonging to any of these (customer_pk, customer_type) pairs,
+    with one IN clause per customer type, so that lookups can use our customer indexes.
+    """
+    pks_by_type = defaultdict(set)
+    for customer_pk, customer_type in customers:
+        pks_by_type[customer_type].add(customer_pk)
+    q = models.Q(pk__in=[])
+    for customer_type, customer_pks in pks_by_type.items():
+        q |= models.Q(**{prefix + 'customer_type': customer_type, prefix + 'customer_pk__in': customer_pks})
+    return q
+
+
+def subscription_status_version_key(customer_pk, customer_type):
+    return 'subscription-status-version-{}-{}'.format(customer_type, customer_pk)
+
+
+def subscription_status_cache_keys(customers):
+    """
+    The keys under which to cache these (customer_pk, customer_type) pairs' /subscription/
+    statuses, by customer. Each includes the customer's current version, which
+    forget_subscription_statuses replaces: a status read before a change, but cached after
+    it was forgotten, lands under a key nobody will read again.
+
+    Get the keys before reading the statuses, not after.
+    """
+    customers = list(customers)
+    version_keys = {customer: subscription_status_version_key(*customer) for customer in customers}
+    versions = cache.get_many(version_keys.values())
+    new_versions = {key: uuid4().hex for key in version_keys.values() if key not in versions}
+    if new_versions:
+        # a concurrent request may be doing the same: first one wins
+        for key, version in new_versions.items():
+            cache.add(key, version, None)
+        versions.update(new_versions)
+        versions.update(cache.get_many(new_versions.keys()))
+    return {
+        customer: 'subscription-status-{}-{}-{}'.format(customer[1], customer[0], versions[version_keys[customer]])
+        for customer in customers
+    }
+
+
+def forget_subscription_statuses(customers):
+    """
+    Forget the cached /subscription/ responses for these (customer_pk, customer_type) pairs,
+    by giving them new versions (see subscription_status_cache_keys).
+    Until the read replicas (if any) catch up, their status is read from the primary.
+
+    Waits until the current transaction commits (if there is one):
+    any sooner, and a concurrent request could re-cache the old state.
+
+    Only processes sharing the default cache forget: with more than one, it must be shared (see CACHES).
+    """
+    customers = list(customers)
+    if customers:
+        def forget():
+            pin_to_primary(customers)
+            cache.set_many({subscription_status_version_key(*customer): uuid4().hex for customer in customers}, None)
+        transaction.on_commit(forget)
+
+
+def refresh_subscription_summary():
+    """
+    Refresh the SubscriptionSummary once the current transaction commits (if there is one),
+    unless that was already done in the last SUBSCRIPTION_SUMMARY_REFRESH_SECONDS: a burst of
+    changes refreshes it once, not once per change. Changes skipped this way show up at the next
+    refresh; `invoke refresh-subscription-summary`, run from cron, bounds how long that takes.
+    If refreshing fails, the summary is merely stale until the next refresh: don't fail the request.
+    """
+    def refresh():
+        if cache.add(SUBSCRIPTION_SUMMARY_REFRESH_CACHE_KEY, True, settings.SUBSCRIPTION_SUMMARY_REFRESH_SECONDS):
+            SubscriptionSummary.refresh()
+    transaction.on_commit(refresh, robust=True)
 
 
 def last_day_of_month(now):
@@ -117,6 +236,17 @@ class SubscriptionAgreement(SubscriptionAndPurchaseMixin):
     def __str__(self):
         return 'SubscriptionAgreement {}'.format(self.id)
 
+    class Meta:
+        indexes = [
+            # Supports customer_standing_subscription, which Perma hits on nearly every page view.
+            # Canceled subscriptions may still be standing, if paid through the future.
+            models.Index(
+                fields=['customer_type', 'customer_pk'],
+                condition=models.Q(status__in=STANDING_STATUSES + ['Canceled']),
+                name='sa_standing_customer_idx'
+            ),
+        ]
+
     history = HistoricalRecords()
     status = models.CharField(
         max_length=20,
@@ -174,27 +304,65 @@ class SubscriptionAgreement(SubscriptionAndPurchaseMixin):
         blank=True
     )
 
-    @classmethod
-    def customer_standing_subscription(cls, customer_pk, customer_type):
-        standing_filter = models.Q(customer_pk=customer_pk) & models.Q(customer_type=customer_type) & (
-            models.Q(status__in=STANDING_STATUSES) | (
-                models.Q(status="Canceled") &
-                models.Q(paid_through__gte=datetime.datetime.now(tz=timezone(settings.TIME_ZONE)))
-            )
+    @staticmethod
+    def standing_filter():
+        return models.Q(status__in=STANDING_STATUSES) | (
+            models.Q(status="Canceled") &
+            models.Q(paid_through__gte=datetime.datetime.now(tz=timezone(settings.TIME_ZONE)))
         )
 
+    @classmethod
+    def customer_standing_subscription(cls, customer_pk, customer_type, select_related=()):
+        """
+        Returns the customer's standing subscription, or None.
+
+        Pass select_related to load related objects along with it, in the same query:
+        e.g. WITH_SUBSCRIPTION_REQUEST or WITH_SUBSCRIPTION_REQUEST_RESPONSE.
+        """
+        standing_filter = models.Q(customer_pk=customer_pk) & models.Q(customer_type=customer_type) & cls.standing_filter()
+
         standing = cls.objects.filter(standing_filter).order_by('id')
-        count = len(standing)
-        if count == 0:
+        # two are enough to tell whether there is more than one
+        found = list(standing.select_related(*select_related)[:2]) if select_related else list(standing[:2])
+        if not found:
             return None
-        if count > 1:
-            logger.error("{} {} has multiple standing subscriptions ({})".format(customer_type, customer_pk, count))
+        if len(found) > 1:
+            logger.error("{} {} has multiple standing subscriptions ({})".format(customer_type, customer_pk, standing.count()))
             if settings.RAISE_IF_MULTIPLE_SUBSCRIPTIONS_FOUND:
                 raise cls.MultipleObjectsReturned
         # In the extremely unlikely (incorrect!) condition that a customer has multiple standing subscriptions,
         # return the oldest. Probably, something went wrong with an update request;
         # we should cancel/delete the new subscription(s), use the original, and if needed update the original one.
-        return standing[0]
+        return found[0]
+
+    @classmethod
+    def customers_standing_subscriptions(cls, customers):
+        """
+        Like customer_standing_subscription, for many customers at once, in one query:
+        returns a dict mapping each (customer_pk, customer_type) pair to its standing subscription,
+        with its subscription request loaded, or to None.
+
+        Where customer_standing_subscription would raise MultipleObjectsReturned, the customer is instead
+        mapped to an instance of it, so that one customer's bad data doesn't fail the whole batch.
+        """
+        customers = list(customers)
+        found = dict.fromkeys(customers)
+        counts = defaultdict(int)
+        standing = cls.objects.filter(customers_filter(customers) & cls.standing_filter()).select_related(*WITH_SUBSCRIPTION_REQUEST).order_by('id')
+        for sa in standing:
+            customer = (sa.customer_pk, sa.customer_type)
+            counts[customer] += 1
+            # as above, the oldest wins
+            if found.get(customer) is None:
+                found[customer] = sa
+        for (customer_pk, customer_type), count in counts.items():
+            if count > 1:
+                logger.error("{} {} has multiple standing subscriptions ({})".format(customer_type, customer_pk, count))
+                if settings.RAISE_IF_MULTIPLE_SUBSCRIPTIONS_FOUND:
+                    found[(customer_pk, customer_type)] = cls.MultipleObjectsReturned(
+                        "{} {} has multiple standing subscriptions ({})".format(customer_type, customer_pk, count)
+                    )
+        return found
 
 
     def can_be_altered(self):
@@ -232,6 +400,88 @@ class SubscriptionAgreement(SubscriptionAndPurchaseMixin):
         return self.paid_through
 
 
+    @classmethod
+    def apply_status_report(cls, rows, user=None):
+        """
+        Applies the statuses in a CyberSource Business Center subscription report to our records.
+
+        Takes an iterable of dicts with 'Merchant Reference Code' and 'Status' keys,
+        and yields a summary of what happened to each row, in order. Rows are handled
+        in chunks: each chunk's subscriptions are fetched with a single query, and only
+        those whose status or paid-through date actually changed are written (with history),
+        in bulk. Nothing is written until the results are consumed.
+        """
+        chunk = []
+        for index, row in enumerate(rows, start=1):
+            chunk.append((index, row))
+            if len(chunk) == STATUS_REPORT_CHUNK_SIZE:
+                yield from cls._apply_status_report_chunk(chunk, user)
+                chunk = []
+        if chunk:
+            yield from cls._apply_status_report_chunk(chunk, user)
+
+
+    @classmethod
+    def _apply_status_report_chunk(cls, chunk, user):
+        references = {row['Merchant Reference Code'] for _, row in chunk}
+        agreements = defaultdict(list)
+        for sa in cls.objects.filter(subscription_request__reference_number__in=references).annotate(
+            reference_number=models.F('subscription_request__reference_number')
+        ):
+            agreements[sa.reference_number].append(sa)
+
+        results = []
+        changed = {}
+        for index, row in chunk:
+            reference = row['Merchant Reference Code']
+            status = row['Status'].capitalize()
+            result = {'row': index, 'reference_number': reference, 'status': status}
+            results.append(result)
+
+            matches = agreements.get(reference, [])
+            if not matches:
+                if settings.RAISE_IF_SUBSCRIPTION_NOT_FOUND:
+                    log_level = logging.ERROR
+                else:
+                    log_level = logging.INFO
+                logger.log(log_level, "CyberSource reports a subscription {}: no corresponding record found".format(reference))
+                result['outcome'] = 'not found'
+                continue
+            if len(matches) > 1:
+                if settings.RAISE_IF_MULTIPLE_SUBSCRIPTIONS_FOUND:
+                    log_level = logging.ERROR
+                else:
+                    log_level = logging.INFO
+                logger.log(log_level, "Multiple subscription requests associated with {}.".format(reference))
+                result['outcome'] = 'duplicate'
+                continue
+
+            [sa] = matches
+            previous = (sa.status, sa.paid_through)
+            sa.status = status
+            sa.paid_through = sa.calculate_paid_through_date_from_reported_status(status)
+            try:
+                sa.full_clean()
+            except ValidationError as e:
+                sa.status, sa.paid_through = previous
+                logger.warning("Invalid status reported for {}: {}".format(reference, e))
+                result['outcome'] = 'invalid'
+                continue
+            if (sa.status, sa.paid_through) == previous:
+                result['outcome'] = 'unchanged'
+                continue
+            changed[sa.pk] = sa
+            result['outcome'] = 'updated'
+            logger.info("Updated subscription status for {} to {}".format(reference, status))
+
+        if changed:
+            with transaction.atomic():
+                bulk_update_with_history(list(changed.values()), cls, ['status', 'paid_through'], default_user=user)
+                forget_subscription_statuses((sa.customer_pk, sa.customer_type) for sa in changed.values())
+                refresh_subscription_summary()
+        return results
+
+
     def update_after_cs_decision(self, request, decision, redacted_response):
         link_limit = request.link_limit
         link_limit_effective_timestamp = request.link_limit_effective_timestamp
@@ -306,9 +556,71 @@ class SubscriptionAgreement(SubscriptionAndPurchaseMixin):
             self.current_frequency = mapped['current_frequency']
         self.paid_through = self.calculate_paid_through_date_from_reported_status(self.status)
         self.save(update_fields=['status', 'current_link_limit', 'current_link_limit_effective_timestamp', 'current_rate', 'current_frequency', 'paid_through'])
+        forget_subscription_statuses([(self.customer_pk, self.customer_type)])
+        refresh_subscription_summary()
         logger.log(mapped['log_level'], mapped['message'])
 
 
+class SubscriptionSummary(models.Model):
+    """
+    Counts of subscription agreements, and the sum of their current rates, by status, frequency and
+    whether cancellation has been requested: a handful of rows, however many agreements (and
+    however much history) there are, for the admin dashboard.
+
+    A Postgres materialized view (see migration 0010), refreshed (at most every SUBSCRIPTION_SUMMARY_REFRESH_SECONDS)
+    whenever CyberSource decides on a request, a status report is applied, or Perma requests a cancellation:
+    see refresh_subscription_summary. Anything else (e.g. edits in the admin) shows up at the next refresh;
+    `invoke refresh-subscription-summary` refreshes it on demand.
+    """
+    def __str__(self):
+        return 'SubscriptionSummary {}'.format(self.id)
+
+    id = models.BigIntegerField(primary_key=True)
+    status = models.CharField(max_length=20)
+    frequency = models.CharField(max_length=20)
+    cancellation_requested = models.BooleanField()
+    subscriptions = models.IntegerField()
+    total_rate = models.DecimalField(max_digits=19, decimal_places=2)
+    refreshed_at = models.DateTimeField()
+
+    class Meta:
+        managed = False
+        db_table = 'perma_payments_subscriptionsummary'
+
+    @classmethod
+    def refresh(cls):
+        # CONCURRENTLY: the dashboard can still be read while this runs
+        with connection.cursor() as cursor:
+            cursor.execute('REFRESH MATERIALIZED VIEW CONCURRENTLY {}'.format(cls._meta.db_table))
+
+    @classmethod
+    def dashboard(cls):
+        """
+        Subscription counts by status, standing subscriptions by frequency, monthly recurring revenue
+        from current subscriptions, and cancellations requested but not yet carried out.
+        """
+        rows = list(cls.objects.all())
+        by_status = Counter()
+        by_frequency = Counter()
+        monthly_recurring_revenue = Decimal(0)
+        for row in rows:
+            by_status[row.status] += row.subscriptions
+            if row.status in STANDING_STATUSES:
+                by_frequency[row.frequency or 'unknown'] += row.subscriptions
+            if row.status == 'Current':
+                if row.frequency == 'monthly':
+                    monthly_recurring_revenue += row.total_rate
+                elif row.frequency == 'annually':
+                    monthly_recurring_revenue += row.total_rate / 12
+        return {
+            'by_status': sorted(by_status.items()),
+            'by_frequency': sorted(by_frequency.items()),
+            'monthly_recurring_revenue': monthly_recurring_revenue.quantize(Decimal('0.01')),
+            'pending_cancellations': sum(row.subscriptions for row in rows if row.cancellation_requested and row.status != 'Canceled'),
+            'refreshed_at': rows[0].refreshed_at if rows else None,
+        }
+
+
 class OutgoingTransaction(PolymorphicModel):
     """
     Base model for all requests we send to CyberSource.
@@ -318,11 +630,44 @@ class OutgoingTransaction(PolymorphicModel):
 
     transaction_uuid = models.UUIDField(
         default=uuid4,
+        unique=True,
         help_text="A unique ID for this 'transaction'. " +
                   "Intended to protect against duplicate transactions."
     )
     request_datetime = models.DateTimeField(auto_now_add=True)
 
+    @classmethod
+    def get_by_transaction_uuid(cls, transaction_uuid, for_update=False):
+        """
+        Returns the concrete SubscriptionRequest, ChangeRequest, UpdateRequest or PurchaseRequest
+        with this transaction_uuid, with its subscription_agreement (if any) already loaded.
+        With for_update, the request's row is locked until the end of the transaction.
+
+        Costs two queries, where a polymorphic get() would cost one per subclass,
+        plus another for the subscription agreement.
+        """
+        ctype_id = cls.objects.non_polymorphic().filter(
+            transaction_uuid=transaction_uuid
+        ).values_list('polymorphic_ctype_id', flat=True).get()
+        model = ContentType.objects.get_for_id(ctype_id).model_class()
+        requests = model.objects.non_polymorphic()
+        if any(field.name == 'subscription_agreement' for field in model._meta.get_fields()):
+            requests = requests.select_related('subscription_agreement')
+        if for_update:
+            requests = requests.select_for_update(of=('self',))
+        return requests.get(transaction_uuid=transaction_uuid)
+
+    def response_recorded(self):
+        """
+        Whether CyberSource's reply to this request has already been saved.
+        Call on the concrete request: see get_by_transaction_uuid.
+        """
+        [relation] = [
+            relation for relation in self._meta.related_objects
+            if relation.one_to_one and issubclass(relation.related_model, Response)
+        ]
+        return relation.related_model.objects.filter(related_request=self).exists()
+
     def get_formatted_datetime(self):
         """
         Returns the request_datetime in the format required by CyberSource
@@ -417,11 +762,12 @@ class SubscriptionRequest(OutgoingTransaction, SubscriptionFields):
     )
     reference_number = models.CharField(
         max_length=32,
-        default=generate_reference_number,
+        blank=True,
         help_text="Unique ID for this subscription. " +
                   "Subsequent charges, automatically made by CyberSource on the recurring schedule, " +
                   "will all be associated with this reference number. " +
-                  "Called 'Merchant Reference Number' in CyberSource Business Center."
+                  "Called 'Merchant Reference Number' in CyberSource Business Center. " +
+                  "Allocated when first saved, if not supplied."
     )
     recurring_start_date = models.DateField(
         help_text="Date on which to commence charging recurring_amount"
@@ -446,6 +792,14 @@ class SubscriptionRequest(OutgoingTransaction, SubscriptionFields):
         """
         return self.recurring_start_date.strftime("%Y%m%d")
 
+    def save(self, *args, **kwargs):
+        if self._state.adding:
+            # if the insert fails, release the reference number
+            with transaction.atomic():
+                allocate_reference_number(self)
+                return super(SubscriptionRequest, self).save(*args, **kwargs)
+        return super(SubscriptionRequest, self).save(*args, **kwargs)
+
 
 class ChangeRequest(OutgoingTransaction, SubscriptionFields):
     """
@@ -510,18 +864,32 @@ class PurchaseRequest(SubscriptionAndPurchaseMixin, OutgoingTransaction, Purchas
     def __str__(self):
         return 'PurchaseRequest {}'.format(self.id)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['customer_type', 'customer_pk'], name='pr_customer_idx'),
+        ]
+
     transaction_type = models.CharField(
         max_length=30,
         default='sale'
     )
     reference_number = models.CharField(
         max_length=32,
-        default=generate_reference_number,
+        blank=True,
         help_text="Unique ID for this purchase. " +
-                  "Called 'Merchant Reference Number' in CyberSource Business Center."
+                  "Called 'Merchant Reference Number' in CyberSource Business Center. " +
+                  "Allocated when first saved, if not supplied."
     )
     link_quantity = models.PositiveIntegerField()
 
+    def save(self, *args, **kwargs):
+        if self._state.adding:
+            # if the insert fails, release the reference number
+            with transaction.atomic():
+                allocate_reference_number(self)
+                return super(PurchaseRequest, self).save(*args, **kwargs)
+        return super(PurchaseRequest, self).save(*args, **kwargs)
+
 
 class Response(PolymorphicModel):
     """
@@ -532,6 +900,17 @@ class Response(PolymorphicModel):
     def __str__(self):
         return 'Response {}'.format(self.id)
 
+    class Meta:
+        base_manager_name = 'objects'
+        indexes = [
+            # Supports finding responses whose encryption was deferred, and never happened.
+            models.Index(
+                fields=['id'],
+                condition=models.Q(full_response_pending=True),
+                name='response_pending_idx'
+            ),
+        ]
+
     def clean(self, *args, **kwargs):
         super(Response, self).clean(*args, **kwargs)
         if not self.full_response:
@@ -557,6 +936,16 @@ class Response(PolymorphicModel):
         help_text="The full response, encrypted, in case we ever need it."
     )
     encryption_key_id = models.IntegerField()
+    full_response_pending = models.BooleanField(
+        default=False,
+        help_text="Whether full_response is still waiting to be encrypted and stored. "
+                  "See ENCRYPT_RESPONSES_IN_BACKGROUND."
+    )
+    staged_full_response = models.BinaryField(
+        blank=True,
+        default=b'',
+        help_text="While full_response_pending, the full response, encrypted with RESPONSE_STAGING_KEY."
+    )
 
     @property
     def related_request(self):
@@ -591,12 +980,19 @@ class Response(PolymorphicModel):
         """
         Saves a new instance of type response_class, encrypting the
         'full_response' field
+
+        If settings.ENCRYPT_RESPONSES_IN_BACKGROUND is on, the full response is only
+        staged now, under the much cheaper RESPONSE_STAGING_KEY: it is encrypted for
+        storage once the current transaction commits. See response_encryption.py.
         """
+        deferred = settings.ENCRYPT_RESPONSES_IN_BACKGROUND
         data = {
             'encryption_key_id': settings.STORAGE_ENCRYPTION_KEYS['id'],
-            'full_response': encrypt_for_storage(
+            'full_response': b'' if deferred else encrypt_for_storage(
                 stringify_data(full_response)
-            )
+            ),
+            'full_response_pending': deferred,
+            'staged_full_response': encrypt_for_staging(stringify_data(full_response)) if deferred else b''
         }
         data.update(fields)
         response = response_class(**data)
@@ -608,6 +1004,9 @@ class Response(PolymorphicModel):
         #
         # response.full_clean()
         response.save()
+        if deferred:
+            from .response_encryption import queue_full_response  #noqa
+            transaction.on_commit(lambda: queue_full_response(response.pk))
         return response
 
 
@@ -701,6 +1100,17 @@ class PurchaseRequestResponse(Response):
     def __str__(self):
         return 'PurchaseRequestResponse {}'.format(self.id)
 
+    class Meta:
+        base_manager_name = 'objects'
+        indexes = [
+            # Supports customer_unacknowledged: only the handful of purchases Perma hasn't yet seen are indexed.
+            models.Index(
+                fields=['related_request'],
+                condition=models.Q(inform_perma=True, perma_acknowledged_at__isnull=True),
+                name='prr_unacknowledged_idx'
+            ),
+        ]
+
     related_request = models.OneToOneField(
         PurchaseRequest,
         related_name='purchase_request_response',
@@ -726,12 +1136,82 @@ class PurchaseRequestResponse(Response):
         return [{'id': purchase.pk, 'link_quantity': purchase.related_request.link_quantity} for purchase in purchases]
 
     @classmethod
-    def customer_history(cls, customer_pk, customer_type):
+    def customers_unacknowledged(cls, customers):
+        """
+        Like customer_unacknowledged, for many customers at once, in one query:
+        returns a dict mapping each (customer_pk, customer_type) pair to its list.
+        """
+        customers = list(customers)
+        found = {customer: [] for customer in customers}
+        purchases = cls.objects.filter(
+            customers_filter(customers, prefix='related_request__'),
+            inform_perma=True,
+            perma_acknowledged_at__isnull=True,
+        ).select_related('related_request').order_by('id')
+        for purchase in purchases:
+            found[(purchase.customer_pk, purchase.customer_type)].append(
+                {'id': purchase.pk, 'link_quantity': purchase.related_request.link_quantity}
+            )
+        return found
+
+    @classmethod
+    def acknowledge(cls, purchase_pks):
+        """
+        Records that Perma has acknowledged these purchases, in one transaction: returns a dict mapping
+        each pk to 'acknowledged', or to why it wasn't: 'not found', 'not acknowledgeable' or 'already acknowledged'.
+
+        The rows are locked with one SELECT ... FOR UPDATE, in pk order, so that overlapping calls
+        can't deadlock, and the acknowledgeable ones are stamped with one UPDATE.
+        """
+        results = {}
+        with transaction.atomic():
+            purchases = {
+                purchase.pk: purchase for purchase in
+                cls.objects.select_related('related_request').select_for_update(of=('self',)).filter(pk__in=purchase_pks).order_by('pk')
+            }
+            for pk in purchase_pks:
+                purchase = purchases.get(pk)
+                if not purchase:
+                    logger.warning('Perma attempted to acknowledge non-existent purchase {}'.format(pk))
+                    results[pk] = 'not found'
+                elif not purchase.inform_perma:
+                    logger.warning('Perma attempted to acknowledge unacknowledgeable purchase {}'.format(pk))
+                    results[pk] = 'not acknowledgeable'
+                elif purchase.perma_acknowledged_at:
+                    logger.warning('Perma attempted to acknowledge already-acknowledged purchase {}'.format(pk))
+                    results[pk] = 'already acknowledged'
+                else:
+                    results[pk] = 'acknowledged'
+
+            acknowledged = [pk for pk, result in results.items() if result == 'acknowledged']
+            if acknowledged:
+                cls.objects.filter(pk__in=acknowledged).update(perma_acknowledged_at=datetime.datetime.now(tz=timezone(settings.TIME_ZONE)))
+                forget_subscription_statuses({(purchases[pk].customer_pk, purchases[pk].customer_type) for pk in acknowledged})
+                logger.info("Purchases {} acknowledged by Perma".format(', '.join(str(pk) for pk in acknowledged)))
+        return results
+
+    @classmethod
+    def customer_history(cls, customer_pk, customer_type, after=None, since=None, limit=None):
+        """
+        A customer's accepted purchases, in order of (request_datetime, id). Optionally, only those
+        after the purchase with this (request_datetime, id), and/or requested since this datetime;
+        and at most `limit` of them.
+        """
         purchases = cls.objects.filter(
             inform_perma=True,
             related_request__customer_pk=customer_pk,
             related_request__customer_type=customer_type
-        ).select_related('related_request')
+        ).select_related('related_request').order_by('related_request__request_datetime', 'id')
+        if after:
+            after_datetime, after_id = after
+            purchases = purchases.filter(
+                models.Q(related_request__request_datetime__gt=after_datetime) |
+                models.Q(related_request__request_datetime=after_datetime, id__gt=after_id)
+            )
+        if since:
+            purchases = purchases.filter(related_request__request_datetime__gte=since)
+        if limit is not None:
+            purchases = purchases[:limit]
         return [
             {
                 'id': purchase.pk,
@@ -801,4 +1281,168 @@ class PurchaseRequestResponse(Response):
         })
         self.inform_perma = mapped['inform_perma']
         self.save(update_fields=['inform_perma'])
+        forget_subscription_statuses([(request.customer_pk, request.customer_type)])
         logger.log(mapped['log_level'], mapped['message'])
+
+
+class ReferenceNumber(models.Model):
+    """
+    Every reference number ever allocated to a SubscriptionRequest or PurchaseRequest, whether generated or
+    supplied, as the request was first saved. The primary key's unique index is what makes allocation race-free:
+    see allocate_reference_number.
+    """
+    def __str__(self):
+        return self.reference_number
+
+    reference_number = models.CharField(
+        max_length=32,
+        primary_key=True
+    )
+    created_date = models.DateTimeField(auto_now_add=True)
+
+    @classmethod
+    def occupancy(cls):
+        """
+        How crowded the reference number keyspace is, and so how many INSERTs
+        allocating a number should take, on average. When the expected number
+        of attempts starts to creep up, it's time to widen the format.
+        """
+        allocated = cls.objects.count()
+        occupancy = allocated / REFERENCE_NUMBER_KEYSPACE
+        return {
+            'allocated': allocated,
+            'keyspace': REFERENCE_NUMBER_KEYSPACE,
+            'occupancy': occupancy,
+            'expected_attempts': 1 / (1 - occupancy) if occupancy < 1 else float('inf'),
+            'exhaustion_probability': occupancy ** 100,
+        }
+
+
+class StatusUpdateJob(models.Model):
+    """
+    A CyberSource Business Center subscription report, uploaded by staff,
+    to be applied to our records in the background. See status_reports.py.
+
+    Applying a report only writes changes, so a failed job can safely be run again from the top;
+    so can a job whose worker died, once it has recorded no progress for STATUS_UPDATE_JOB_LEASE_SECONDS.
+    """
+    def __str__(self):
+        return 'StatusUpdateJob {}'.format(self.id)
+
+    created_date = models.DateTimeField(auto_now_add=True)
+    created_by = models.ForeignKey(
+        settings.AUTH_USER_MODEL,
+        null=True,
+        blank=True,
+        related_name='+',
+        on_delete=models.SET_NULL
+    )
+    status = models.CharField(
+        max_length=20,
+        default='Queued',
+        choices=(
+            ('Queued', 'Queued'),
+            ('Running', 'Running'),
+            ('Completed', 'Completed'),
+            ('Failed', 'Failed'),
+        )
+    )
+    started_at = models.DateTimeField(null=True, blank=True)
+    last_progress_at = models.DateTimeField(
+        null=True,
+        blank=True,
+        help_text="When the worker applying this job last recorded progress."
+    )
+    finished_at = models.DateTimeField(null=True, blank=True)
+    rows_processed = models.PositiveIntegerField(default=0)
+    updated = models.PositiveIntegerField(default=0)
+    unchanged = models.PositiveIntegerField(default=0)
+    not_found = models.PositiveIntegerField(default=0)
+    duplicates = models.PositiveIntegerField(default=0)
+    invalid = models.PositiveIntegerField(default=0)
+    problems = models.JSONField(
+        default=list,
+        blank=True,
+        help_text="The first STATUS_UPDATE_MAX_PROBLEMS rows of the report that could not be applied."
+    )
+    error = models.TextField(blank=True, default='')
+
+    @staticmethod
+    def abandoned_filter():
+        """
+        Running jobs whose worker has recorded no progress for STATUS_UPDATE_JOB_LEASE_SECONDS:
+        presumably killed, e.g. by a restart.
+        """
+        cutoff = datetime.datetime.now(tz=timezone(settings.TIME_ZONE)) - datetime.timedelta(seconds=settings.STATUS_UPDATE_JOB_LEASE_SECONDS)
+        return models.Q(status='Running') & (models.Q(last_progress_at__lt=cutoff) | models.Q(last_progress_at__isnull=True))
+
+    def is_finished(self):
+        return self.status in ['Completed', 'Failed']
+
+    def is_abandoned(self):
+        return StatusUpdateJob.objects.filter(StatusUpdateJob.abandoned_filter(), pk=self.pk).exists()
+
+    def can_be_rerun(self):
+        return self.status == 'Failed' or self.is_abandoned()
+
+    def problems_not_shown(self):
+        return self.not_found + self.duplicates + self.invalid - len(self.problems)
+
+
+class StatusUpdateJobReportChunk(models.Model):
+    """
+    A piece of a StatusUpdateJob's report. Reports are stored and read back a piece at a time,
+    so that a large one is never held in memory whole: see status_reports.store_report.
+    """
+    def __str__(self):
+        return 'StatusUpdateJobReportChunk {}'.format(self.id)
+
+    job = models.ForeignKey(
+        StatusUpdateJob,
+        related_name='report_chunks',
+        on_delete=models.CASCADE
+    )
+    index = models.PositiveIntegerField()
+    data = models.BinaryField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['job', 'index'], name='report_chunk_unique'),
+        ]
+
+
+class OutgoingEmail(models.Model):
+    """
+    An email to ourselves, queued to be sent in the background, so that
+    no one waits on our SMTP relay, and a hiccup there can't interrupt a request. See email.py.
+    """
+    def __str__(self):
+        return 'OutgoingEmail {}'.format(self.id)
+
+    subject = models.CharField(max_length=998)
+    body = models.TextField()
+    from_email = models.CharField(max_length=254)
+    to = models.JSONField(default=list)
+    reply_to = models.JSONField(default=list, blank=True)
+    created_date = models.DateTimeField(auto_now_add=True)
+    status = models.CharField(
+        max_length=20,
+        default='Queued',
+        choices=(
+            ('Queued', 'Queued'),
+            ('Sent', 'Sent'),
+            ('Failed', 'Failed'),
+        )
+    )
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(
+        help_text="When the next attempt to send this email is due. " +
+                  "While an attempt is underway, pushed back far enough that no one else tries too."
+    )
+    sent_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default='')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['next_attempt_at'], condition=models.Q(status='Queued'), name='email_queued_idx'),
+        ]
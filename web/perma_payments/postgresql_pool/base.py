@@ -0,0 +1,87 @@
+"""
+The PostgreSQL backend, with connections borrowed from a pool shared by the threads of each process,
+rather than opened for each request.
+
+Django 4.2 has no connection pool of its own. To use this one:
+    DJANGO__DATABASES__default__ENGINE=perma_payments.postgresql_pool
+    DJANGO__INT__DATABASES__default__CONN_MAX_AGE=0
+and, optionally, DJANGO__INT__DATABASES__default__POOL__MIN_SIZE and ...__POOL__MAX_SIZE.
+
+When Django closes a connection (by default, at the end of each request) it goes back to the pool.
+Up to MIN_SIZE idle connections are kept open; any more are closed when returned. No more than MAX_SIZE
+are ever open at once: past that, asking for one is an error, so MAX_SIZE should be at least the number
+of threads serving requests. With CONN_HEALTH_CHECKS, each connection is checked as it is borrowed, and
+replaced if the database has dropped it.
+"""
+import os
+import threading
+
+import psycopg2
+import psycopg2.extras
+from psycopg2.pool import ThreadedConnectionPool
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.postgresql import base
+from django.db.backends.postgresql.psycopg_any import IsolationLevel
+
+POOL_MIN_SIZE = 2
+POOL_MAX_SIZE = 20
+
+# (process id, alias, connection parameters) -> pool:
+# a forked process mustn't share its parent's connections
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def close_pools():
+    """
+    Closes every connection pooled by this process.
+    """
+    with _pools_lock:
+        for key in [key for key in _pools if key[0] == os.getpid()]:
+            _pools.pop(key).closeall()
+
+
+def is_alive(connection):
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        # without autocommit, as when new, that began a transaction
+        connection.rollback()
+    except psycopg2.Error:
+        return False
+    return True
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    connection_pool = None
+
+    def get_pool(self, conn_params):
+        if self.settings_dict['CONN_MAX_AGE'] != 0:
+            raise ImproperlyConfigured("Set CONN_MAX_AGE to 0 for {}: its connections are pooled, not kept.".format(self.alias))
+        if 'isolation_level' in self.settings_dict['OPTIONS']:
+            raise ImproperlyConfigured("Pooled connections use the default isolation level.")
+        key = (os.getpid(), self.alias, tuple(sorted(conn_params.items())))
+        with _pools_lock:
+            if key not in _pools:
+                options = self.settings_dict.get('POOL', {})
+                _pools[key] = ThreadedConnectionPool(options.get('MIN_SIZE', POOL_MIN_SIZE), options.get('MAX_SIZE', POOL_MAX_SIZE), **conn_params)
+            return _pools[key]
+
+    def get_new_connection(self, conn_params):
+        pool = self.get_pool(conn_params)
+        connection = pool.getconn()
+        while self.settings_dict['CONN_HEALTH_CHECKS'] and not is_alive(connection):
+            pool.putconn(connection, close=True)
+            connection = pool.getconn()
+        self.connection_pool = pool
+        # what the postgresql backend does with each new connection
+        self.isolation_level = IsolationLevel.READ_COMMITTED
+        psycopg2.extras.register_default_jsonb(conn_or_curs=connection, loads=lambda x: x)
+        return connection
+
+    def _close(self):
+        if self.connection is not None:
+            with self.wrap_database_errors:
+                # rolls back anything left open, and discards the connection if it has been lost
+                return self.connection_pool.putconn(self.connection)
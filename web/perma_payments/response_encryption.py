@@ -0,0 +1,121 @@
+"""
+Deferred encryption of CyberSource's full responses.
+
+Sealing a full response for storage costs a fresh ephemeral keypair per response. When
+settings.ENCRYPT_RESPONSES_IN_BACKGROUND is on, a callback instead saves the full response
+encrypted with RESPONSE_STAGING_KEY, a secret key (a cheap, symmetric cipher), in
+staged_full_response, with full_response_pending set. Once its transaction commits, the
+response's pk is handed to this module, which seals it for storage and clears the staged copy.
+
+The raw response is never written, unencrypted, to the database, the cache or the disk, and
+nothing is lost if the process is killed before its queue is drained, or if encryption fails:
+the staged copy stays in the database until it is sealed. `invoke encrypt-pending-full-responses`
+(see encrypt_pending_full_responses) seals anything left behind; the
+perma_payments_full_responses_pending metric says when there is some.
+On a normal exit, anything still queued is sealed first.
+"""
+import atexit
+import queue
+import threading
+
+from django.conf import settings
+from django.db import connections
+
+from .models import Response
+from .security import decrypt_from_staging, encrypt_for_storage
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+# One encryption thread per process, started the first time it is needed.
+_queue = queue.Queue()
+_encrypter_running = threading.Lock()
+
+
+def queue_full_response(pk):
+    """
+    Arranges for Response `pk`'s staged full response to be encrypted and stored.
+
+    If RESPONSE_ENCRYPTION_IN_THREAD is off, or RESPONSE_ENCRYPTION_QUEUE_LIMIT responses are
+    already waiting, it is done right away, before returning.
+    """
+    if not settings.RESPONSE_ENCRYPTION_IN_THREAD or _queue.qsize() >= settings.RESPONSE_ENCRYPTION_QUEUE_LIMIT:
+        encrypt_or_log(pk)
+        return
+    _queue.put(pk)
+    if _encrypter_running.acquire(blocking=False):
+        threading.Thread(target=run_encrypter_thread, name='response-encrypter', daemon=True).start()
+
+
+def run_encrypter_thread():
+    while True:
+        encrypt_next()
+        if _queue.empty():
+            # don't hold a database connection open while idle
+            connections.close_all()
+
+
+def encrypt_next(block=True):
+    """
+    Encrypts and stores the next queued response. Returns False if there was none.
+    """
+    try:
+        pk = _queue.get(block=block)
+    except queue.Empty:
+        return False
+    try:
+        encrypt_or_log(pk)
+    finally:
+        _queue.task_done()
+    return True
+
+
+def encrypt_or_log(pk):
+    """
+    Encrypts and stores the full response of Response `pk`. On failure, it stays staged, to be retried.
+    Returns whether it succeeded.
+    """
+    try:
+        encrypt_full_response(pk)
+    except Exception:
+        logger.exception("Failed to encrypt the full response of Response {}; it remains staged".format(pk))
+        return False
+    return True
+
+
+def encrypt_full_response(pk):
+    """
+    Seals Response `pk`'s staged full response for storage, and discards the staged copy.
+    Does nothing if that has already been done.
+    """
+    pending = Response.objects.non_polymorphic().filter(pk=pk, full_response_pending=True)
+    staged = pending.values_list('staged_full_response', flat=True).first()
+    if staged is None:
+        return
+    pending.update(
+        full_response=encrypt_for_storage(decrypt_from_staging(bytes(staged))),
+        encryption_key_id=settings.STORAGE_ENCRYPTION_KEYS['id'],
+        full_response_pending=False,
+        staged_full_response=b''
+    )
+
+
+def encrypt_pending_full_responses():
+    """
+    Encrypts and stores every full response still staged, e.g. by a process killed before it
+    caught up, or whose encryption failed. Safe to run alongside the web processes.
+    Returns the pks of any that failed again.
+    """
+    pks = list(Response.objects.non_polymorphic().filter(full_response_pending=True).order_by('id').values_list('id', flat=True))
+    return [pk for pk in pks if not encrypt_or_log(pk)]
+
+
+@atexit.register
+def drain():
+    """
+    Encrypts and stores everything still queued. Runs at exit, so that a normal
+    shutdown doesn't leave work for encrypt_pending_full_responses.
+    """
+    while encrypt_next(block=False):
+        pass
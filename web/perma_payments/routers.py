@@ -0,0 +1,103 @@
+"""
+Read replica routing.
+
+Reads go to a replica (one of the DATABASES aliases listed in settings.DATABASE_REPLICAS) only inside
+use_replica(), which wraps the database work of views that don't write: /subscription/, /subscriptions/,
+/purchase-history/ and the admin changelists. Everything else uses the primary, as if there were no replicas.
+
+Since a replica lags a little behind the primary:
+- once anything inside use_replica() writes, everything it reads afterwards comes from the primary;
+- reads inside a transaction on the primary stay on the primary, to see the transaction's own writes;
+- once a customer's subscription or purchases change (see forget_subscription_statuses), reads about
+  that customer stay on the primary for REPLICA_PIN_SECONDS, so that a stale answer isn't cached.
+  Pins are kept in the default cache, which must be shared: settings with replicas but a per-process
+  default cache fail at startup.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+import random
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+class ReplicaReads:
+    def __init__(self, alias):
+        self.alias = alias
+        self.pinned = False
+
+
+_replica_reads = ContextVar('replica_reads', default=None)
+
+
+def primary_pin_cache_key(customer_pk, customer_type):
+    return 'primary-pin-{}-{}'.format(customer_type, customer_pk)
+
+
+def pin_to_primary(customers):
+    """
+    Read about these (customer_pk, customer_type) pairs from the primary until the replicas have caught up.
+    """
+    if settings.DATABASE_REPLICAS:
+        cache.set_many({primary_pin_cache_key(*customer): True for customer in customers}, settings.REPLICA_PIN_SECONDS)
+
+
+@contextmanager
+def use_replica(customers=()):
+    """
+    Read from a replica inside this block, if there are any, unless we've recently written
+    about any of these (customer_pk, customer_type) pairs. Nested blocks share the outer block's choice.
+    """
+    if (
+        not settings.DATABASE_REPLICAS or
+        _replica_reads.get() is not None or
+        (customers and cache.get_many([primary_pin_cache_key(*customer) for customer in customers]))
+    ):
+        yield
+        return
+    token = _replica_reads.set(ReplicaReads(random.choice(settings.DATABASE_REPLICAS)))
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+def reads_from_replica(view):
+    """
+    Decorates a view whose GETs should read from a replica. Template responses are rendered
+    before leaving the block, so that any queries made while rendering go to the replica too.
+    """
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.method != 'GET':
+            return view(request, *args, **kwargs)
+        with use_replica():
+            response = view(request, *args, **kwargs)
+            if hasattr(response, 'render'):
+                response.render()
+            return response
+    return wrapper
+
+
+class ReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        reads = _replica_reads.get()
+        if reads is None or reads.pinned or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return None
+        return reads.alias
+
+    def db_for_write(self, model, **hints):
+        reads = _replica_reads.get()
+        if reads is not None:
+            reads.pinned = True
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replicas are copies of the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in settings.DATABASE_REPLICAS
@@ -6,17 +6,29 @@ import hashlib
 import hmac
 import json
 from nacl import encoding
+from nacl.exceptions import CryptoError
 from nacl.public import SealedBox, Box, PrivateKey, PublicKey
+from nacl.secret import SecretBox
+from nacl.utils import random as random_bytes
 import string
 
 from django.conf import settings
+from django.core.cache import caches
 from django.core.exceptions import ValidationError
 from django.core.serializers.json import DjangoJSONEncoder
+from django.dispatch import receiver
+from django.test.signals import setting_changed
 from django.views.decorators.debug import sensitive_variables
 
+from .instrumentation import timed
+from .metrics import INVALID_TRANSMISSIONS, PERMA_DECRYPTIONS
+
 import logging
 logger = logging.getLogger(__name__)
 
+# The cache recording the nonces of messages from Perma, to detect replays
+PERMA_NONCE_CACHE = 'perma_nonces'
+
 #
 # Classes
 #
@@ -26,6 +38,68 @@ class InvalidTransmissionException(Exception):
     pass
 
 
+class PermaKeyring(object):
+    """
+    A Box for each Perma key pair we accept, in the order to try them in.
+
+    Whichever pair decrypted a message most recently is tried first, so that
+    outside of a key rotation, every message is decrypted at the first attempt.
+    """
+
+    @sensitive_variables()
+    def __init__(self, keysets, encoder):
+        self.boxes = [(keys['id'], get_cached_box('perma', keys, build_perma_box, encoder)) for keys in keysets]
+
+    @sensitive_variables()
+    def decrypt(self, ciphertext, encoder):
+        """
+        Returns the id of the key pair that decrypted the ciphertext, and the plaintext.
+        Raises CryptoError if none could.
+        """
+        boxes = self.boxes
+        for i, (key_id, box) in enumerate(boxes):
+            try:
+                plaintext = box.decrypt(ciphertext, encoder=encoder)
+            except CryptoError as e:
+                error = e
+                continue
+            if i:
+                # Not locked: if two threads do this at once, one reordering is lost, which is harmless.
+                self.boxes = [boxes[i]] + boxes[:i] + boxes[i + 1:]
+            return key_id, plaintext
+        raise error
+
+
+class CyberSourceSigner(object):
+    """
+    Signs messages for CyberSource, and checks the signatures of its replies (HMAC-SHA256, base64-encoded).
+
+    An hmac is keyed once per secret: each message is hashed with a copy, so the key isn't
+    re-encoded and the padded key blocks aren't re-hashed for every message. Messages are signed
+    with the first secret, and signatures made with any of them are accepted.
+    """
+
+    @sensitive_variables()
+    def __init__(self, secrets):
+        self.keyed = [hmac.new(bytes(secret, 'utf-8'), digestmod=hashlib.sha256) for secret in secrets]
+
+    @sensitive_variables()
+    def sign(self, message):
+        signer = self.keyed[0].copy()
+        signer.update(message)
+        return base64.b64encode(signer.digest())
+
+    @sensitive_variables()
+    def is_valid(self, message, signature):
+        valid = False
+        # check every secret, so that how long this takes doesn't reveal which matched
+        for keyed in self.keyed:
+            signer = keyed.copy()
+            signer.update(message)
+            valid |= safe_str_cmp(signature, base64.b64encode(signer.digest()))
+        return valid
+
+
 class AlphaNumericValidator(object):
     """
     Password validator, adapted from https://djangosnippets.org/snippets/2551/
@@ -69,15 +143,14 @@ def prep_for_cybersource(signed_fields, unsigned_fields={}):
     Note: if additional fields are POSTed, or if any of these fields fail to be POSTed,
     CyberSource will reject the communication's signature and return 403 Forbidden.
     """
-    signed_fields = dict(
+    to_post = dict(
         signed_fields,
         unsigned_field_names=','.join(sorted(unsigned_fields)),
-        signed_field_names=','.join(sorted(list(signed_fields) + ['signed_field_names', 'unsigned_field_names']))
+        signed_field_names=','.join(sorted([*signed_fields, 'signed_field_names', 'unsigned_field_names']))
     )
-    to_post = {}
-    to_post.update(signed_fields)
+    signature = sign_data(stringify_for_signature(to_post)).decode('utf-8')
     to_post.update(unsigned_fields)
-    to_post['signature'] = sign_data(stringify_for_signature(signed_fields)).decode('utf-8')
+    to_post['signature'] = signature
     return to_post
 
 
@@ -94,12 +167,14 @@ def process_cybersource_transmission(transmitted_data, fields):
     except KeyError as e:
         msg = 'Incomplete POST to CyberSource callback route: missing {}'.format(e)
         logger.warning(msg)
+        INVALID_TRANSMISSIONS.inc(source='cybersource', reason='incomplete')
         raise InvalidTransmissionException(msg)
 
     # The signature must be valid
     if not is_valid_signature(signed_fields, signature):
         msg = 'Data with invalid signature POSTed to CyberSource callback route'
         logger.warning(msg)
+        INVALID_TRANSMISSIONS.inc(source='cybersource', reason='signature')
         raise InvalidTransmissionException(msg)
 
     # Great! Return the subset of fields we want
@@ -114,16 +189,18 @@ def prep_for_perma(dictionary):
 
 
 @sensitive_variables()
-def process_perma_transmission(transmitted_data, fields):
+def process_perma_transmission(transmitted_data, fields, optional_fields=()):
     # Transmitted data should contain a single field, 'encrypted_data', which
     # must be a JSON dict, encrypted by Perma and base64-encoded.
     encrypted_data = transmitted_data.get('encrypted_data', '')
     if not encrypted_data:
+        INVALID_TRANSMISSIONS.inc(source='perma', reason='incomplete')
         raise InvalidTransmissionException('No encrypted_data in POST.')
     try:
         post_data = unstringify_data(decrypt_from_perma(encrypted_data))
     except Exception as e:
         logger.warning('Problem with transmitted data. {}'.format(format_exception(e)))
+        INVALID_TRANSMISSIONS.inc(source='perma', reason='decryption')
         raise InvalidTransmissionException(format_exception(e))
 
     # The encrypted data must include a valid timestamp.
@@ -131,12 +208,20 @@ def process_perma_transmission(transmitted_data, fields):
         timestamp = post_data['timestamp']
     except KeyError:
         logger.warning('Missing timestamp in data.')
+        INVALID_TRANSMISSIONS.inc(source='perma', reason='timestamp')
         raise InvalidTransmissionException('Missing timestamp in data.')
     if not is_valid_timestamp(timestamp, settings.PERMA_TIMESTAMP_MAX_AGE_SECONDS):
         logger.warning('Expired timestamp in data.')
+        INVALID_TRANSMISSIONS.inc(source='perma', reason='timestamp')
         raise InvalidTransmissionException('Expired timestamp in data.')
 
-    return retrieve_fields(post_data, fields)
+    # And may only be acted on once.
+    if is_replay(encrypted_data, timestamp):
+        logger.warning('Replayed data.')
+        INVALID_TRANSMISSIONS.inc(source='perma', reason='replay')
+        raise InvalidTransmissionException('Replayed data.')
+
+    return retrieve_fields(post_data, fields, optional_fields)
 
 
 # Helpers
@@ -145,7 +230,7 @@ def format_exception(e):
 
 
 @sensitive_variables()
-def retrieve_fields(transmitted_data, fields):
+def retrieve_fields(transmitted_data, fields, optional_fields=()):
     try:
         data = {}
         for field in fields:
@@ -154,11 +239,29 @@ def retrieve_fields(transmitted_data, fields):
         msg = 'Incomplete data received: missing {}'.format(e)
         logger.warning(msg)
         raise InvalidTransmissionException(msg)
+    for field in optional_fields:
+        if field in transmitted_data:
+            data[field] = transmitted_data[field]
     return data
 
 
 def is_valid_timestamp(stamp, max_age):
-    return stamp <= (datetime.utcnow() + timedelta(seconds=max_age)).timestamp()
+    now = datetime.utcnow()
+    return (now - timedelta(seconds=max_age)).timestamp() <= stamp <= (now + timedelta(seconds=max_age)).timestamp()
+
+
+@sensitive_variables()
+def is_replay(encrypted_data, timestamp):
+    """
+    Records the nonce of a message from Perma, until its timestamp is no longer valid.
+    Returns True if it had already been recorded: i.e., this message has been received before.
+
+    Box.encrypt chooses a random nonce for every message, and the nonce can't be altered
+    without the message failing to decrypt, so the nonce identifies the message.
+    """
+    nonce = encoding.Base64Encoder.decode(encrypted_data)[:Box.NONCE_SIZE]
+    timeout = timestamp + settings.PERMA_TIMESTAMP_MAX_AGE_SECONDS - datetime.utcnow().timestamp()
+    return not caches[PERMA_NONCE_CACHE].add('perma-nonce-{}'.format(nonce.hex()), True, max(timeout, 1))
 
 
 @sensitive_variables()
@@ -189,18 +292,16 @@ def stringify_for_signature(data, sort=True):
         raise TypeError('OrderedDict() required.')
     elif not isinstance(data, Mapping):
         raise TypeError
-    return ','.join('{}={}'.format(key, data[key]) for key in (sorted(data) if sort else data))
+    return ','.join([f'{key}={data[key]}' for key in (sorted(data) if sort else data)])
 
 
 @sensitive_variables()
+@timed
 def sign_data(data_string):
     """
     Sign with HMAC sha256 and base64 encode
     """
-    message = bytes(data_string, 'utf-8')
-    secret = bytes(settings.CS_SECRET_KEY, 'utf-8')
-    hash = hmac.new(secret, message, hashlib.sha256)
-    return base64.b64encode(hash.digest())
+    return get_cybersource_signer().sign(data_string.encode('utf-8'))
 
 
 @sensitive_variables()
@@ -223,7 +324,7 @@ def safe_str_cmp(a: str, b: str) -> bool:
 @sensitive_variables()
 def is_valid_signature(data, signature):
     data_to_sign = stringify_for_signature(data, sort=False)
-    return safe_str_cmp(signature, sign_data(data_to_sign))
+    return get_cybersource_signer().is_valid(data_to_sign.encode('utf-8'), signature)
 
 
 @sensitive_variables()
@@ -245,16 +346,95 @@ def generate_public_private_keys():
 
 
 @sensitive_variables()
+def generate_staging_key():
+    """
+    A new key for RESPONSE_STAGING_KEY.
+    """
+    return base64.b64encode(random_bytes(SecretBox.KEY_SIZE))
+
+
+# Key material
+
+# Box and SealedBox instances, built from settings once per process and keyed by key id,
+# and the CyberSource signer. A Box precomputes the shared key, and the signer its keyed hmacs,
+# so there's no sense in rebuilding them for every message.
+_boxes = {}
+
+
+@receiver(setting_changed)
+def clear_cached_boxes(setting, **kwargs):
+    if setting in ('PERMA_ENCRYPTION_KEYS', 'ACCEPTED_PERMA_ENCRYPTION_KEYS', 'STORAGE_ENCRYPTION_KEYS'):
+        _boxes.clear()
+    if setting in ('CS_SECRET_KEY', 'ACCEPTED_CS_SECRET_KEYS'):
+        _boxes.pop('cybersource_signer', None)
+    if setting == 'RESPONSE_STAGING_KEY':
+        _boxes.pop('staging', None)
+
+
+@sensitive_variables()
+def get_cybersource_signer():
+    """
+    Returns the signer for CS_SECRET_KEY and ACCEPTED_CS_SECRET_KEYS, building it on first use.
+    """
+    signer = _boxes.get('cybersource_signer')
+    if signer is None:
+        signer = _boxes['cybersource_signer'] = CyberSourceSigner([settings.CS_SECRET_KEY, *settings.ACCEPTED_CS_SECRET_KEYS])
+    return signer
+
+
+@sensitive_variables()
+def get_cached_box(purpose, keys, build, encoder=encoding.Base64Encoder):
+    """
+    Returns the box for (purpose, keys['id']), building it with build(keys, encoder) on first use.
+    """
+    cache_key = (purpose, keys['id'], encoder)
+    box = _boxes.get(cache_key)
+    if box is None:
+        box = _boxes[cache_key] = build(keys, encoder)
+    return box
+
+
+@sensitive_variables()
+def get_perma_keyring(encoder=encoding.Base64Encoder):
+    """
+    Returns the keyring of PERMA_ENCRYPTION_KEYS and ACCEPTED_PERMA_ENCRYPTION_KEYS, building it on first use.
+    """
+    cache_key = ('perma_keyring', encoder)
+    keyring = _boxes.get(cache_key)
+    if keyring is None:
+        keyring = _boxes[cache_key] = PermaKeyring(
+            [settings.PERMA_ENCRYPTION_KEYS, *settings.ACCEPTED_PERMA_ENCRYPTION_KEYS],
+            encoder
+        )
+    return keyring
+
+
+@sensitive_variables()
+def build_storage_encryption_box(keys, encoder):
+    return SealedBox(PublicKey(keys['vault_public_key'], encoder=encoder))
+
+
+@sensitive_variables()
+def build_storage_decryption_box(keys, encoder):
+    return SealedBox(PrivateKey(keys['vault_secret_key'], encoder=encoder))
+
+
+@sensitive_variables()
+def build_perma_box(keys, encoder):
+    return Box(
+        PrivateKey(keys['perma_payments_secret_key'], encoder=encoder),
+        PublicKey(keys['perma_public_key'], encoder=encoder)
+    )
+
+
+@sensitive_variables()
+@timed
 def encrypt_for_storage(message, encoder=encoding.Base64Encoder):
     """
     Public sealed box.
     http://pynacl.readthedocs.io/en/latest/public/#nacl-public-sealedbox
     """
-    box = SealedBox(
-        PublicKey(
-            settings.STORAGE_ENCRYPTION_KEYS['vault_public_key'], encoder=encoder
-        )
-    )
+    box = get_cached_box('storage_encrypt', settings.STORAGE_ENCRYPTION_KEYS, build_storage_encryption_box, encoder)
     return box.encrypt(message)
 
 
@@ -272,41 +452,52 @@ def decrypt_from_storage(ciphertext, encoder=encoding.Base64Encoder):
         >>> resp = SubscriptionRequestResponse.objects.get(pk=????????)
         >>> decrypt_from_storage(bytes(resp.full_response))
     """
-    box = SealedBox(
-        PrivateKey(
-            settings.STORAGE_ENCRYPTION_KEYS['vault_secret_key'], encoder=encoder
-        )
-    )
+    box = get_cached_box('storage_decrypt', settings.STORAGE_ENCRYPTION_KEYS, build_storage_decryption_box, encoder)
     return box.decrypt(ciphertext)
 
 
 @sensitive_variables()
+def get_staging_box():
+    """
+    Returns the SecretBox for RESPONSE_STAGING_KEY, building it on first use.
+    """
+    box = _boxes.get('staging')
+    if box is None:
+        box = _boxes['staging'] = SecretBox(settings.RESPONSE_STAGING_KEY, encoder=encoding.Base64Encoder)
+    return box
+
+
+@sensitive_variables()
+def encrypt_for_staging(message):
+    """
+    Secret key encryption, for holding a full response in the database just until it is
+    encrypted for storage: much cheaper than a sealed box, but the key is kept online.
+    http://pynacl.readthedocs.io/en/latest/secret/
+    """
+    return get_staging_box().encrypt(message)
+
+
+@sensitive_variables()
+def decrypt_from_staging(ciphertext):
+    return get_staging_box().decrypt(ciphertext)
+
+
+@sensitive_variables()
+@timed
 def encrypt_for_perma(message, encoder=encoding.Base64Encoder):
     """
     Basic public key encryption ala pynacl.
     """
-    box = Box(
-        PrivateKey(
-            settings.PERMA_ENCRYPTION_KEYS['perma_payments_secret_key'], encoder=encoder
-        ),
-        PublicKey(
-            settings.PERMA_ENCRYPTION_KEYS['perma_public_key'], encoder=encoder
-        )
-    )
+    box = get_cached_box('perma', settings.PERMA_ENCRYPTION_KEYS, build_perma_box, encoder)
     return box.encrypt(message, encoder=encoder)
 
 
 @sensitive_variables()
+@timed
 def decrypt_from_perma(ciphertext, encoder=encoding.Base64Encoder):
     """
-    Decrypt bytes encrypted by perma.cc
+    Decrypt bytes encrypted by perma.cc, with any of the key pairs we accept.
     """
-    box = Box(
-        PrivateKey(
-            settings.PERMA_ENCRYPTION_KEYS['perma_payments_secret_key'], encoder=encoder
-        ),
-        PublicKey(
-            settings.PERMA_ENCRYPTION_KEYS['perma_public_key'], encoder=encoder
-        )
-    )
-    return box.decrypt(ciphertext, encoder=encoder)
+    key_id, plaintext = get_perma_keyring(encoder).decrypt(ciphertext, encoder)
+    PERMA_DECRYPTIONS.inc(key_id=key_id)
+    return plaintext
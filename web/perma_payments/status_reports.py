@@ -0,0 +1,204 @@
+import csv
+from datetime import datetime
+import io
+from pytz import timezone
+import threading
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Q
+
+from .models import STATUS_REPORT_CHUNK_SIZE, StatusUpdateJob, StatusUpdateJobReportChunk, SubscriptionAgreement
+from .security import format_exception
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Number of lines of preamble CyberSource puts above the column headers in its reports
+REPORT_PREAMBLE_LINES = 4
+# How many bytes of a report to store in (and read back from) each StatusUpdateJobReportChunk
+REPORT_CHUNK_BYTES = 1024 * 1024
+
+# Which StatusUpdateJob counter to bump for each outcome reported by SubscriptionAgreement.apply_status_report
+OUTCOME_COUNTERS = {
+    'updated': 'updated',
+    'unchanged': 'unchanged',
+    'not found': 'not_found',
+    'duplicate': 'duplicates',
+    'invalid': 'invalid',
+}
+PROGRESS_FIELDS = ['rows_processed', 'problems', 'last_progress_at'] + list(OUTCOME_COUNTERS.values())
+# Outcomes worth listing row by row, not just counting
+PROBLEM_OUTCOMES = ['not found', 'duplicate', 'invalid']
+
+
+#
+# Reading reports
+#
+
+def skip_lines(csv_file, lines):
+    """
+    Given a file object, advances the read/write head <lines> number of lines.
+    Useful for skipping over undesired lines of a file before processing.
+    Returns None.
+    """
+    for i in range(lines):
+        csv_file.readline()
+
+
+def uploaded_csv_to_dict_reader(csv_file, skip=0):
+    """
+    Yields the rows of a CSV file opened in binary mode (e.g. an upload) as dicts,
+    after skipping the first <skip> lines.
+
+    Django keeps small uploads in memory and spools large ones to a temporary file on disk;
+    either way, the file is decoded and parsed a buffer at a time as rows are consumed,
+    rather than read, decoded and copied in full up front.
+    https://docs.djangoproject.com/en/4.2/ref/files/uploads/
+    """
+    text = io.TextIOWrapper(csv_file, encoding='utf-8', newline='')
+    try:
+        skip_lines(text, skip)
+        yield from csv.DictReader(text)
+    finally:
+        # don't close the underlying file along with the wrapper
+        text.detach()
+
+
+#
+# Storing reports
+#
+
+def store_report(job, csv_file):
+    """
+    Saves an uploaded report to the database a chunk at a time, without reading it into memory whole.
+    """
+    for index, data in enumerate(csv_file.chunks(REPORT_CHUNK_BYTES)):
+        StatusUpdateJobReportChunk(job=job, index=index, data=data).save()
+
+
+class StoredReport(io.RawIOBase):
+    """
+    A read-only, binary file object over a job's stored report, which fetches
+    one chunk from the database at a time, as it is read.
+    """
+    def __init__(self, job):
+        self.chunk_pks = list(job.report_chunks.order_by('index').values_list('pk', flat=True))
+        self.chunk = b''
+        self.offset = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while self.offset == len(self.chunk):
+            if not self.chunk_pks:
+                return 0
+            self.chunk = bytes(StatusUpdateJobReportChunk.objects.values_list('data', flat=True).get(pk=self.chunk_pks.pop(0)))
+            self.offset = 0
+        size = min(len(buffer), len(self.chunk) - self.offset)
+        buffer[:size] = self.chunk[self.offset:self.offset + size]
+        self.offset += size
+        return size
+
+
+#
+# Background jobs
+#
+
+def enqueue_status_update_job(csv_file, user=None):
+    """
+    Stores an uploaded report, and arranges for it to be applied once the current transaction commits.
+    """
+    job = StatusUpdateJob(created_by=user)
+    job.save()
+    store_report(job, csv_file)
+    transaction.on_commit(start_status_update_worker)
+    logger.info("Queued {}".format(job))
+    return job
+
+
+def rerun_status_update_job(job):
+    """
+    Queues a failed or abandoned job to be applied again, from the top.
+    """
+    if not job.can_be_rerun():
+        raise ValueError("Only failed or abandoned jobs can be re-run; {} is {}.".format(job, job.status))
+    job.status = 'Queued'
+    job.save(update_fields=['status'])
+    transaction.on_commit(start_status_update_worker)
+    logger.info("Re-queued {}".format(job))
+
+
+def start_status_update_worker():
+    if settings.STATUS_UPDATE_JOBS_IN_THREAD:
+        threading.Thread(target=run_status_update_worker_thread, name='status-update-worker', daemon=True).start()
+    else:
+        process_status_update_jobs()
+
+
+def run_status_update_worker_thread():
+    try:
+        process_status_update_jobs()
+    finally:
+        # each thread gets its own database connections: don't leak them
+        connections.close_all()
+
+
+def process_status_update_jobs():
+    """
+    Applies queued jobs, oldest first, until none are left; abandoned jobs are picked up too.
+    Any number of workers can run at once: each job is claimed by exactly one.
+    """
+    while True:
+        job = claim_status_update_job()
+        if job is None:
+            return
+        run_status_update_job(job)
+
+
+def claim_status_update_job():
+    with transaction.atomic():
+        job = StatusUpdateJob.objects.select_for_update(skip_locked=True).filter(
+            Q(status='Queued') | StatusUpdateJob.abandoned_filter()
+        ).order_by('id').first()
+        if job is None:
+            return None
+        if job.status == 'Running':
+            logger.warning("Reclaiming abandoned {}, last progress at {}".format(job, job.last_progress_at))
+        job.status = 'Running'
+        job.started_at = datetime.now(tz=timezone(settings.TIME_ZONE))
+        job.last_progress_at = job.started_at
+        job.finished_at = None
+        job.error = ''
+        job.rows_processed = 0
+        job.problems = []
+        for counter in OUTCOME_COUNTERS.values():
+            setattr(job, counter, 0)
+        job.save()
+    return job
+
+
+def run_status_update_job(job):
+    """
+    Applies a claimed job's report, recording progress after every chunk of rows is written.
+    """
+    try:
+        rows = uploaded_csv_to_dict_reader(io.BufferedReader(StoredReport(job)), skip=REPORT_PREAMBLE_LINES)
+        for result in SubscriptionAgreement.apply_status_report(rows, user=job.created_by):
+            job.rows_processed += 1
+            counter = OUTCOME_COUNTERS[result['outcome']]
+            setattr(job, counter, getattr(job, counter) + 1)
+            if result['outcome'] in PROBLEM_OUTCOMES and len(job.problems) < settings.STATUS_UPDATE_MAX_PROBLEMS:
+                job.problems.append(result)
+            if job.rows_processed % STATUS_REPORT_CHUNK_SIZE == 0:
+                job.last_progress_at = datetime.now(tz=timezone(settings.TIME_ZONE))
+                job.save(update_fields=PROGRESS_FIELDS)
+        job.status = 'Completed'
+        logger.info("{} completed: {} rows processed".format(job, job.rows_processed))
+    except Exception as e:
+        job.status = 'Failed'
+        job.error = format_exception(e)
+        logger.exception("{} failed after {} rows".format(job, job.rows_processed))
+    job.finished_at = datetime.now(tz=timezone(settings.TIME_ZONE))
+    job.save(update_fields=PROGRESS_FIELDS + ['status', 'error', 'finished_at'])
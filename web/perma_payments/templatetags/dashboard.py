@@ -0,0 +1,13 @@
+from django import template
+
+from ..models import SubscriptionSummary
+
+register = template.Library()
+
+
+@register.simple_tag
+def subscription_summary():
+    """
+    The admin dashboard's subscription numbers: see SubscriptionSummary.dashboard.
+    """
+    return SubscriptionSummary.dashboard()
@@ -0,0 +1,61 @@
+import pytest
+
+from perma_payments.benchmarks import SCENARIOS, seed, benchmark_endpoint, summarize, compare
+from perma_payments.models import PurchaseRequestResponse, SubscriptionAgreement
+
+
+#
+# FIXTURES
+#
+
+@pytest.fixture()
+def customers():
+    return seed(customers=3, purchases_per_customer=2)
+
+
+#
+# TESTS
+#
+
+@pytest.mark.django_db
+def test_seed(customers):
+    assert len(customers) == 3
+    for customer_pk, customer_type in customers:
+        sa = SubscriptionAgreement.customer_standing_subscription(customer_pk, customer_type)
+        assert sa.can_be_altered()
+        assert sa.subscription_request.subscription_request_response.payment_token
+        assert len(PurchaseRequestResponse.customer_history(customer_pk, customer_type)) == 2
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('endpoint', SCENARIOS)
+def test_benchmark_endpoint_requests_succeed(endpoint, customers, caplog):
+    result = benchmark_endpoint(endpoint, customers, requests=4)
+    assert result['requests'] == 4
+    assert result['errors'] == 0, caplog.text
+    assert result['requests_per_second'] > 0
+    assert 0 < result['latency_ms']['p50'] <= result['latency_ms']['p95'] <= result['latency_ms']['p99'] <= result['latency_ms']['max']
+    assert result['queries_per_request']['mean'] > 0
+
+
+def test_summarize():
+    samples = [(i / 1000, 2, i != 100) for i in range(1, 101)]
+    result = summarize(samples, wall_time=2)
+    assert result['requests'] == 100
+    assert result['errors'] == 1
+    assert result['requests_per_second'] == 50
+    assert result['latency_ms'] == {'p50': 50.5, 'p95': 95.05, 'p99': 99.01, 'max': 100}
+    assert result['queries_per_request'] == {'mean': 2, 'max': 2}
+
+
+def test_compare():
+    def result(p50, rps):
+        return {'latency_ms': {'p50': p50, 'p99': p50 * 2}, 'requests_per_second': rps, 'queries_per_request': {'mean': 3}}
+    baseline = {'endpoints': {'purchase': result(10, 100), 'retired': result(1, 1)}}
+    results = {'endpoints': {'purchase': result(5, 200), 'new': result(1, 1)}}
+    assert compare(baseline, results) == [
+        ('purchase', 'p50', 10, 5, -50),
+        ('purchase', 'p99', 20, 10, -50),
+        ('purchase', 'rps', 100, 200, 100),
+        ('purchase', 'queries', 3, 3, 0),
+    ]
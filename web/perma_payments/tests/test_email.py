@@ -1,10 +1,22 @@
+from datetime import timedelta
+import socket
+
 from django.conf import settings
 from django.http import HttpRequest
 from django.test.utils import override_settings
 
 import pytest
 
-from perma_payments.email import send_self_email
+from perma_payments.email import (send_self_email, queue_email, claim_email, send_queued_emails, start_email_sender,
+    run_email_sender_thread, now)
+from perma_payments.models import OutgoingEmail
+
+from .utils import FakeSMTPServer
+
+
+#
+# FIXTURES
+#
 
 @pytest.fixture()
 def email():
@@ -13,8 +25,49 @@ def email():
        'message': "the message has an apostrophe in it: '"
     }
 
-def test_send_self_email(email, mailoutbox):
-    send_self_email(email['subject'], HttpRequest(), context={'message': email['message']})
+
+@pytest.fixture()
+def smtp_server(settings):
+    with FakeSMTPServer() as server:
+        settings.EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+        settings.EMAIL_HOST = '127.0.0.1'
+        settings.EMAIL_PORT = server.port
+        settings.EMAIL_HOST_USER = ''
+        settings.EMAIL_HOST_PASSWORD = ''
+        settings.EMAIL_USE_TLS = False
+        settings.EMAIL_TIMEOUT = 5
+        yield server
+
+
+@pytest.fixture()
+def unreachable_smtp_server(settings):
+    # find a port that nothing is listening on
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    settings.EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+    settings.EMAIL_HOST = '127.0.0.1'
+    settings.EMAIL_PORT = port
+    settings.EMAIL_USE_TLS = False
+    settings.EMAIL_TIMEOUT = 5
+
+
+@pytest.fixture()
+def queued_emails():
+    return [
+        OutgoingEmail.objects.create(subject='email {}'.format(i), body='body', from_email='from@example.com', to=['to@example.com'], next_attempt_at=now())
+        for i in range(3)
+    ]
+
+
+#
+# TESTS
+#
+
+@pytest.mark.django_db
+def test_send_self_email(email, mailoutbox, django_capture_on_commit_callbacks):
+    with django_capture_on_commit_callbacks(execute=True):
+        send_self_email(email['subject'], HttpRequest(), context={'message': email['message']})
     assert len(mailoutbox) == 1
     m = mailoutbox[0]
     assert m.subject == email['subject']
@@ -22,9 +75,12 @@ def test_send_self_email(email, mailoutbox):
     assert m.from_email == settings.DEFAULT_FROM_EMAIL
     assert m.to == [settings.ADMINS[0][1]]
 
+
+@pytest.mark.django_db
 @override_settings(DEFAULT_REPLYTO_EMAIL='from@example.com')
-def test_send_self_email_everybody(email, mailoutbox):
-    send_self_email(email['subject'], HttpRequest(), context={'message': email['message']}, devs_only=False)
+def test_send_self_email_everybody(email, mailoutbox, django_capture_on_commit_callbacks):
+    with django_capture_on_commit_callbacks(execute=True):
+        send_self_email(email['subject'], HttpRequest(), context={'message': email['message']}, devs_only=False)
     assert len(mailoutbox) == 1
     m = mailoutbox[0]
     assert m.subject == email['subject']
@@ -32,3 +88,130 @@ def test_send_self_email_everybody(email, mailoutbox):
     assert m.from_email == settings.DEFAULT_FROM_EMAIL
     assert m.to == [settings.DEFAULT_FROM_EMAIL]
     assert m.reply_to == ['from@example.com']
+
+
+@pytest.mark.django_db
+def test_queue_email_waits_for_commit(email, mailoutbox, django_capture_on_commit_callbacks):
+    with django_capture_on_commit_callbacks() as callbacks:
+        queued = queue_email(email['subject'], email['message'], 'from@example.com', ['to@example.com'])
+    assert len(mailoutbox) == 0
+    assert queued.status == 'Queued'
+    assert callbacks == [start_email_sender]
+
+
+@pytest.mark.django_db
+def test_start_email_sender_starts_one_thread(settings, mocker):
+    settings.EMAIL_QUEUE_IN_THREAD = True
+    thread = mocker.patch('perma_payments.email.threading.Thread', autospec=True)
+    lock = mocker.patch('perma_payments.email._sender_running', autospec=True)
+    lock.acquire.side_effect = [True, False]
+    start_email_sender()
+    start_email_sender()
+    assert thread.call_count == 1
+
+
+def test_email_sender_thread_rechecks_after_releasing(mocker):
+    lock = mocker.patch('perma_payments.email._sender_running', autospec=True)
+    wake = mocker.patch('perma_payments.email._wake_sender', autospec=True)
+    send = mocker.patch('perma_payments.email.send_queued_emails', autospec=True, return_value=None)
+    mocker.patch('perma_payments.email.connections', autospec=True)
+    # an email is queued, and start_email_sender called, just after the queue is found empty,
+    # but before the lock is released
+    wake.is_set.side_effect = [False, True, False, False]
+    lock.acquire.return_value = True
+    run_email_sender_thread()
+    assert send.call_count == 2
+    assert lock.release.call_count == 2
+
+
+def test_email_sender_thread_leaves_wakeups_to_new_sender(mocker):
+    lock = mocker.patch('perma_payments.email._sender_running', autospec=True)
+    wake = mocker.patch('perma_payments.email._wake_sender', autospec=True)
+    send = mocker.patch('perma_payments.email.send_queued_emails', autospec=True, return_value=None)
+    mocker.patch('perma_payments.email.connections', autospec=True)
+    wake.is_set.side_effect = [False, True]
+    lock.acquire.return_value = False
+    run_email_sender_thread()
+    assert send.call_count == 1
+    assert lock.release.call_count == 1
+
+
+@pytest.mark.django_db
+def test_send_queued_emails_shares_one_connection(smtp_server, queued_emails):
+    assert send_queued_emails() is None
+    assert smtp_server.connections == 1
+    assert len(smtp_server.messages) == 3
+    assert b'Subject: email 0' in smtp_server.messages[0]
+    for queued in queued_emails:
+        queued.refresh_from_db()
+        assert queued.status == 'Sent'
+        assert queued.attempts == 1
+        assert queued.sent_at
+
+
+@pytest.mark.django_db
+def test_send_queued_emails_backs_off_and_retries(smtp_server, queued_emails, settings, mocker):
+    settings.EMAIL_QUEUE_RETRY_DELAY_SECONDS = 60
+    warning = mocker.patch('perma_payments.email.logger.warning', autospec=True)
+    smtp_server.refuse = 1
+
+    delay = send_queued_emails()
+
+    failed = queued_emails[0]
+    failed.refresh_from_db()
+    assert failed.status == 'Queued'
+    assert failed.attempts == 1
+    assert '451' in failed.last_error
+    assert 55 < delay <= 60
+    assert warning.call_count == 1
+    # the others were sent over a fresh connection
+    assert smtp_server.connections == 2
+    assert len(smtp_server.messages) == 2
+
+    # the second failure waits twice as long
+    failed.next_attempt_at = now()
+    failed.save()
+    smtp_server.refuse = 1
+    assert 115 < send_queued_emails() <= 120
+    failed.refresh_from_db()
+    assert failed.attempts == 2
+
+    # and once due, it goes out
+    failed.next_attempt_at = now()
+    failed.save()
+    assert send_queued_emails() is None
+    failed.refresh_from_db()
+    assert failed.status == 'Sent'
+    assert failed.attempts == 3
+
+
+@pytest.mark.django_db
+def test_send_queued_emails_gives_up(unreachable_smtp_server, queued_emails, settings, mocker):
+    settings.EMAIL_QUEUE_RETRY_DELAY_SECONDS = 0
+    settings.EMAIL_QUEUE_MAX_ATTEMPTS = 2
+    mocker.patch('perma_payments.email.logger.warning', autospec=True)
+    error = mocker.patch('perma_payments.email.logger.error', autospec=True)
+
+    # with no delay, retries are due at once
+    assert send_queued_emails() is None
+    for queued in queued_emails:
+        queued.refresh_from_db()
+        assert queued.status == 'Failed'
+        assert queued.attempts == 2
+        assert queued.last_error
+    assert error.call_count == 3
+
+
+@pytest.mark.django_db
+def test_claim_email_takes_a_lease(queued_emails, settings):
+    settings.EMAIL_QUEUE_LEASE_SECONDS = 300
+    claimed = [claim_email() for i in range(4)]
+    assert [c.pk for c in claimed[:3]] == [e.pk for e in queued_emails]
+    assert claimed[3] is None
+    assert claimed[0].next_attempt_at > now() + timedelta(seconds=290)
+
+    # a sender that died holding the lease is retried once it is up
+    OutgoingEmail.objects.filter(pk=claimed[0].pk).update(next_attempt_at=now())
+    reclaimed = claim_email()
+    assert reclaimed.pk == claimed[0].pk
+    assert reclaimed.attempts == 2
@@ -0,0 +1,113 @@
+import json
+import logging
+
+from django.template import engines
+from django.urls import reverse
+from django.views.debug import SafeExceptionReporterFilter
+
+import pytest
+
+from perma_payments.benchmarks import encode_for_perma_payments
+from perma_payments.instrumentation import RequestTimings, _current_timings, timed, timer
+from perma_payments.security import decrypt_from_perma
+
+
+#
+# FIXTURES
+#
+
+@pytest.fixture()
+def instrumented(settings):
+    settings.INSTRUMENT_REQUESTS = True
+    settings.INSTRUMENTATION_SERVER_TIMING = True
+    settings.INSTRUMENTATION_LOG = True
+
+
+@pytest.fixture()
+def subscription_post():
+    return encode_for_perma_payments({'customer_pk': 1, 'customer_type': 'Registrar'})
+
+
+#
+# TESTS
+#
+
+def test_timed_outside_a_request():
+    @timed
+    def double(x):
+        return x * 2
+    assert _current_timings.get() is None
+    assert double(2) == 4
+
+
+def test_timed_and_timer_add_up():
+    @timed
+    def double(x):
+        return x * 2
+    timings = RequestTimings()
+    token = _current_timings.set(timings)
+    try:
+        double(1)
+        double(2)
+        with timer('block'):
+            pass
+    finally:
+        _current_timings.reset(token)
+    assert timings.spans['double'][0] == 2
+    assert timings.spans['block'][0] == 1
+    assert set(timings.as_dict()) == {'total_ms', 'double', 'block'}
+
+
+def test_timed_frames_still_scrubbed_from_error_reports(rf):
+    try:
+        decrypt_from_perma('not a secret worth leaking')
+    except Exception as e:
+        tb = e.__traceback__
+    frames = []
+    while tb is not None:
+        frames.append(tb.tb_frame)
+        tb = tb.tb_next
+    wrapper = next(frame for frame in frames if frame.f_code.co_name == 'wrapper')
+    variables = dict(SafeExceptionReporterFilter().get_traceback_frame_variables(rf.get('/'), wrapper))
+    assert 'not a secret worth leaking' not in repr(variables)
+
+
+def test_templates_still_render():
+    assert engines['django'].from_string('{{ x }}').render({'x': 'hello'}) == 'hello'
+
+
+@pytest.mark.django_db
+def test_not_instrumented_by_default(client, subscription_post):
+    response = client.post(reverse('subscription'), subscription_post)
+    assert response.status_code == 200
+    assert 'Server-Timing' not in response
+
+
+@pytest.mark.django_db
+def test_server_timing(client, instrumented, subscription_post):
+    response = client.post(reverse('subscription'), subscription_post)
+    assert response.status_code == 200
+    metrics = {metric.split(';')[0]: metric for metric in response['Server-Timing'].split(', ')}
+    assert set(metrics) == {'db', 'decrypt_from_perma', 'encrypt_for_perma', 'total'}
+    assert 'desc="2x"' in metrics['db']
+
+
+@pytest.mark.django_db
+def test_template_timing(client, instrumented):
+    response = client.get(reverse('purchase'))
+    assert 'template;dur=' in response['Server-Timing']
+
+
+@pytest.mark.django_db
+def test_log_line(client, settings, instrumented, subscription_post, caplog):
+    settings.INSTRUMENTATION_SERVER_TIMING = False
+    with caplog.at_level(logging.INFO, logger='perma_payments.instrumentation'):
+        response = client.post(reverse('subscription'), subscription_post)
+    assert 'Server-Timing' not in response
+    [record] = [record for record in caplog.records if record.name == 'perma_payments.instrumentation']
+    logged = json.loads(record.getMessage())
+    assert logged['view'] == 'subscription'
+    assert logged['status'] == 200
+    assert logged['db']['count'] == 2
+    assert logged['decrypt_from_perma']['count'] == 1
+    assert logged['total_ms'] >= logged['db']['ms']
@@ -0,0 +1,117 @@
+from nacl import encoding
+from nacl.public import PrivateKey
+
+from django.conf import settings as django_settings
+
+import pytest
+from pytest_factoryboy import register
+
+from perma_payments.key_rotation import reencrypt_full_responses
+from perma_payments.security import decrypt_from_storage, encrypt_for_storage
+
+from .factories import PurchaseRequestResponseFactory
+
+register(PurchaseRequestResponseFactory)
+
+
+#
+# FIXTURES
+#
+
+@pytest.fixture()
+def old_keys():
+    return dict(django_settings.STORAGE_ENCRYPTION_KEYS)
+
+
+@pytest.fixture()
+def sealed_responses(old_keys, purchase_request_response_factory):
+    return [
+        purchase_request_response_factory(full_response=encrypt_for_storage('response {}'.format(i).encode()), encryption_key_id=old_keys['id'])
+        for i in range(5)
+    ]
+
+
+@pytest.fixture()
+def rotated(settings, old_keys):
+    new_secret_key = PrivateKey.generate()
+    settings.STORAGE_ENCRYPTION_KEYS = {
+        'id': old_keys['id'] + 1,
+        'vault_secret_key': new_secret_key.encode(encoding.Base64Encoder).decode(),
+        'vault_public_key': new_secret_key.public_key.encode(encoding.Base64Encoder).decode(),
+    }
+    settings.RETIRED_STORAGE_ENCRYPTION_KEYS = [old_keys]
+    return settings.STORAGE_ENCRYPTION_KEYS
+
+
+def contents(response):
+    response.refresh_from_db()
+    return response.encryption_key_id, decrypt_from_storage(bytes(response.full_response))
+
+
+#
+# TESTS
+#
+
+@pytest.mark.django_db
+def test_reencrypt_in_chunks(sealed_responses, rotated):
+    progress = []
+    summary = reencrypt_full_responses(chunk_size=2, processes=0, progress=lambda s: progress.append(dict(s)))
+    assert summary['rows'] == 5
+    assert summary['failed'] == []
+    assert summary['last_id'] == sealed_responses[-1].id
+    assert [p['rows'] for p in progress] == [2, 4, 5]
+    assert all(p['rows_per_second'] > 0 for p in progress)
+    for i, response in enumerate(sealed_responses):
+        assert contents(response) == (rotated['id'], 'response {}'.format(i).encode())
+
+
+@pytest.mark.django_db
+def test_reencrypt_with_process_pool(sealed_responses, rotated):
+    assert reencrypt_full_responses(chunk_size=3, processes=2)['rows'] == 5
+    for i, response in enumerate(sealed_responses):
+        assert contents(response) == (rotated['id'], 'response {}'.format(i).encode())
+
+
+@pytest.mark.django_db
+def test_reencrypt_resumes_after_id(sealed_responses, rotated, old_keys):
+    summary = reencrypt_full_responses(after_id=sealed_responses[2].id, processes=0)
+    assert summary['rows'] == 2
+    for response in sealed_responses:
+        response.refresh_from_db()
+    assert [r.encryption_key_id for r in sealed_responses] == [old_keys['id']] * 3 + [rotated['id']] * 2
+
+
+@pytest.mark.django_db
+def test_reencrypt_is_idempotent(sealed_responses, rotated):
+    reencrypt_full_responses(processes=0)
+    assert reencrypt_full_responses(processes=0)['rows'] == 0
+
+
+@pytest.mark.django_db
+def test_reencrypt_skips_other_keys_and_pending(sealed_responses, rotated, purchase_request_response_factory):
+    other = purchase_request_response_factory(full_response=b'unknown', encryption_key_id=99)
+    pending = purchase_request_response_factory(full_response=b'', full_response_pending=True, encryption_key_id=sealed_responses[0].encryption_key_id)
+    assert reencrypt_full_responses(processes=0)['rows'] == 5
+    for response in (other, pending):
+        before = bytes(response.full_response), response.encryption_key_id
+        response.refresh_from_db()
+        assert (bytes(response.full_response), response.encryption_key_id) == before
+
+
+@pytest.mark.django_db
+def test_reencrypt_undecryptable_left_alone(sealed_responses, rotated, old_keys, caplog):
+    corrupt = sealed_responses[1]
+    corrupt.full_response = b'not a sealed box'
+    corrupt.save()
+    summary = reencrypt_full_responses(processes=0)
+    assert summary['rows'] == 4
+    assert summary['failed'] == [corrupt.id]
+    assert "Couldn't decrypt the full response of Response {}".format(corrupt.id) in caplog.text
+    corrupt.refresh_from_db()
+    assert corrupt.encryption_key_id == old_keys['id']
+
+
+def test_reencrypt_refuses_to_retire_current_key(settings, old_keys):
+    settings.RETIRED_STORAGE_ENCRYPTION_KEYS = [old_keys]
+    with pytest.raises(ValueError):
+        reencrypt_full_responses(processes=0)
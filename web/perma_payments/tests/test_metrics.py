@@ -0,0 +1,199 @@
+from django.core.cache import cache
+from django.urls import reverse
+
+import pytest
+from pytest_factoryboy import register
+
+from perma_payments.benchmarks import encode_for_perma_payments, encode_from_cybersource
+from perma_payments.metrics import (CONTENT_TYPE, CYBERSOURCE_CALLBACKS, CYBERSOURCE_DUPLICATE_CALLBACKS, INVALID_TRANSMISSIONS,
+    REFERENCE_NUMBER_COLLISIONS, REQUEST_DURATION, Counter, Histogram, render_metrics)
+from perma_payments.models import generate_reference_number
+
+from .factories import PurchaseRequestFactory, PurchaseRequestResponseFactory, SubscriptionAgreementFactory
+
+register(PurchaseRequestFactory)
+register(PurchaseRequestResponseFactory)
+register(SubscriptionAgreementFactory)
+
+
+#
+# FIXTURES
+#
+
+@pytest.fixture
+def locmem_cache(settings):
+    settings.CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+    cache.clear()
+    yield cache
+    cache.clear()
+
+
+@pytest.fixture
+def database_state(subscription_agreement_factory, purchase_request_response_factory):
+    subscription_agreement_factory(status='Current')
+    subscription_agreement_factory(status='Current', cancellation_requested=True)
+    subscription_agreement_factory(status='Canceled', cancellation_requested=True)
+    purchase_request_response_factory(inform_perma=True)
+    purchase_request_response_factory(inform_perma=False)
+
+
+#
+# TESTS
+#
+
+def test_counter_exposition():
+    counter = Counter('things_total', 'Things.', ['kind'], registry=[])
+    counter.inc(kind='a')
+    counter.inc(2, kind='b "quoted"')
+    counter.inc(kind='a')
+    assert counter.value(kind='a') == 2
+    assert counter.render() == '\n'.join([
+        '# HELP things_total Things.',
+        '# TYPE things_total counter',
+        'things_total{kind="a"} 2.0',
+        'things_total{kind="b \\"quoted\\""} 2.0',
+    ])
+
+
+def test_histogram_exposition():
+    histogram = Histogram('latency_seconds', 'Latency.', ['view'], buckets=(0.1, 1), registry=[])
+    for value in (0.05, 0.5, 5):
+        histogram.observe(value, view='v')
+    assert histogram.render() == '\n'.join([
+        '# HELP latency_seconds Latency.',
+        '# TYPE latency_seconds histogram',
+        'latency_seconds_bucket{view="v",le="0.1"} 1',
+        'latency_seconds_bucket{view="v",le="1"} 2',
+        'latency_seconds_bucket{view="v",le="+Inf"} 3',
+        'latency_seconds_sum{view="v"} 5.55',
+        'latency_seconds_count{view="v"} 3',
+    ])
+
+
+@pytest.mark.django_db
+def test_gauges(database_state):
+    rendered = render_metrics(registry=[])
+    assert 'perma_payments_subscriptions{status="Current"} 2' in rendered
+    assert 'perma_payments_subscriptions{status="Canceled"} 1' in rendered
+    assert 'perma_payments_subscriptions{status="Pending"} 0' in rendered
+    assert 'perma_payments_purchases_awaiting_acknowledgement 1' in rendered
+    assert 'perma_payments_cancellation_requests_pending 1' in rendered
+    assert 'perma_payments_full_responses_pending 0' in rendered
+
+
+@pytest.mark.django_db
+def test_gauges_cached(database_state, locmem_cache, subscription_agreement_factory, django_assert_num_queries):
+    with django_assert_num_queries(4):
+        render_metrics(registry=[])
+    subscription_agreement_factory(status='Current')
+    with django_assert_num_queries(0):
+        rendered = render_metrics(registry=[])
+    assert 'perma_payments_subscriptions{status="Current"} 2' in rendered
+
+
+@pytest.mark.django_db
+def test_callbacks_counted(client, purchase_request, django_capture_on_commit_callbacks):
+    before = CYBERSOURCE_CALLBACKS.value(decision='DECLINE', reason_code='481')
+    data = encode_from_cybersource({
+        'req_transaction_uuid': purchase_request.transaction_uuid,
+        'decision': 'DECLINE',
+        'reason_code': '481',
+        'message': 'Declined.',
+    })
+    with django_capture_on_commit_callbacks(execute=True):
+        response = client.post(reverse('cybersource_callback'), data)
+    assert response.status_code == 200
+    assert CYBERSOURCE_CALLBACKS.value(decision='DECLINE', reason_code='481') == before + 1
+
+    # duplicates are counted separately
+    before_duplicates = CYBERSOURCE_DUPLICATE_CALLBACKS.value()
+    with django_capture_on_commit_callbacks(execute=True):
+        client.post(reverse('cybersource_callback'), data)
+    assert CYBERSOURCE_CALLBACKS.value(decision='DECLINE', reason_code='481') == before + 1
+    assert CYBERSOURCE_DUPLICATE_CALLBACKS.value() == before_duplicates + 1
+
+
+@pytest.mark.django_db
+def test_callbacks_not_counted_if_rolled_back(client, purchase_request, mocker, django_capture_on_commit_callbacks):
+    mocker.patch('perma_payments.views.Response.save_new_with_encrypted_full_response', autospec=True, side_effect=Exception('boom'))
+    client.raise_request_exception = False
+    before = CYBERSOURCE_CALLBACKS.value(decision='DECLINE', reason_code='481')
+    with django_capture_on_commit_callbacks(execute=True) as callbacks:
+        response = client.post(reverse('cybersource_callback'), encode_from_cybersource({
+            'req_transaction_uuid': purchase_request.transaction_uuid,
+            'decision': 'DECLINE',
+            'reason_code': '481',
+            'message': 'Declined.',
+        }))
+    assert response.status_code == 500
+    assert not callbacks
+    assert CYBERSOURCE_CALLBACKS.value(decision='DECLINE', reason_code='481') == before
+
+
+@pytest.mark.django_db
+def test_invalid_signatures_counted(client, purchase_request):
+    before = INVALID_TRANSMISSIONS.value(source='cybersource', reason='signature')
+    data = encode_from_cybersource({'req_transaction_uuid': purchase_request.transaction_uuid, 'decision': 'ACCEPT', 'reason_code': '100', 'message': 'OK'})
+    data['decision'] = 'REVIEW'
+    assert client.post(reverse('cybersource_callback'), data).status_code == 400
+    assert INVALID_TRANSMISSIONS.value(source='cybersource', reason='signature') == before + 1
+
+
+@pytest.mark.django_db
+def test_undecryptable_perma_transmissions_counted(client):
+    before = INVALID_TRANSMISSIONS.value(source='perma', reason='decryption')
+    data = encode_for_perma_payments({'customer_pk': 1, 'customer_type': 'Registrar'})
+    data['encrypted_data'] = data['encrypted_data'][:-8] + 'AAAAAAA='
+    assert client.post(reverse('subscription'), data).status_code == 400
+    assert INVALID_TRANSMISSIONS.value(source='perma', reason='decryption') == before + 1
+
+
+@pytest.mark.django_db
+def test_reference_number_collisions_counted(mocker):
+    mocker.patch('perma_payments.models.reserve_reference_number', autospec=True, side_effect=[False, False, True])
+    before = REFERENCE_NUMBER_COLLISIONS.value()
+    generate_reference_number()
+    assert REFERENCE_NUMBER_COLLISIONS.value() == before + 2
+
+
+@pytest.mark.django_db
+def test_request_duration_observed_when_instrumented(client, settings):
+    settings.INSTRUMENT_REQUESTS = True
+    client.get(reverse('purchase'))
+    assert 'perma_payments_request_duration_seconds_count{view="purchase"}' in REQUEST_DURATION.render()
+
+
+@pytest.mark.django_db
+def test_metrics_route_anonymous(client):
+    assert client.get(reverse('metrics')).status_code == 403
+
+
+@pytest.mark.django_db
+def test_metrics_route_staff(admin_client):
+    response = admin_client.get(reverse('metrics'))
+    assert response.status_code == 200
+    assert response['Content-Type'] == CONTENT_TYPE
+    content = response.content.decode()
+    for name in ['perma_payments_cybersource_callbacks_total', 'perma_payments_invalid_transmissions_total', 'perma_payments_perma_decryptions_total',
+                 'perma_payments_reference_number_collisions_total', 'perma_payments_request_duration_seconds',
+                 'perma_payments_subscriptions', 'perma_payments_purchases_awaiting_acknowledgement',
+                 'perma_payments_cancellation_requests_pending', 'perma_payments_full_responses_pending']:
+        assert '# TYPE {} '.format(name) in content
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('authorization, status', [
+    ('Bearer the-token', 200),
+    ('Bearer the-wrong-token', 403),
+    ('the-token', 403),
+    ('', 403),
+])
+def test_metrics_route_token(client, settings, authorization, status):
+    settings.METRICS_TOKEN = 'the-token'
+    assert client.get(reverse('metrics'), HTTP_AUTHORIZATION=authorization).status_code == status
+
+
+@pytest.mark.django_db
+def test_metrics_route_no_token_configured(client, settings):
+    settings.METRICS_TOKEN = None
+    assert client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer ').status_code == 403
@@ -1,21 +1,28 @@
 import datetime
+from decimal import Decimal
 from dateutil.relativedelta import relativedelta
 from pytz import timezone
 import random
 
 from django.apps import apps
 from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, connection, transaction
 from django.http import QueryDict
+from django.template import engines
+from django.test.utils import CaptureQueriesContext
 
 import pytest
 
 from perma_payments.constants import CS_DECISIONS
-from perma_payments.models import (STANDING_STATUSES, REFERENCE_NUMBER_PREFIX,
-    RN_SET, generate_reference_number, is_ref_number_available, SubscriptionAgreement, SubscriptionRequest,
+from perma_payments.models import (STANDING_STATUSES, REFERENCE_NUMBER_PREFIX, WITH_SUBSCRIPTION_REQUEST,
+    RN_SET, generate_reference_number, reserve_reference_number, ReferenceNumber,
+    forget_subscription_statuses, subscription_status_cache_keys, SubscriptionAgreement, SubscriptionRequest,
     SubscriptionRequestResponse, UpdateRequest, UpdateRequestResponse,
-    ChangeRequest, ChangeRequestResponse, PurchaseRequest, PurchaseRequestResponse, OutgoingTransaction, Response)
+    ChangeRequest, ChangeRequestResponse, PurchaseRequest, PurchaseRequestResponse, OutgoingTransaction, Response,
+    SubscriptionSummary, refresh_subscription_summary)
 
-from .utils import GENESIS, SENTINEL, absent_required_fields_raise_validation_error, autopopulated_fields_present
+from .utils import GENESIS, SENTINEL, absent_required_fields_raise_validation_error, autopopulated_fields_present, query_plans
 
 
 #
@@ -319,41 +326,157 @@ def spoof_django_post_object():
 # Helpers
 
 def test_generate_reference_number_valid(mocker):
-    available = mocker.patch('perma_payments.models.is_ref_number_available', autospec=True, return_value=True)
+    reserve = mocker.patch('perma_payments.models.reserve_reference_number', autospec=True, return_value=True)
 
     rn = generate_reference_number()
-    available.assert_called_once_with(rn)
+    reserve.assert_called_once_with(rn)
     prefix, first, second = rn.split('-')
     assert prefix == REFERENCE_NUMBER_PREFIX
     for char in first + second:
         assert char in RN_SET
 
 
+def test_generate_reference_number_retries_collisions(mocker):
+    reserve = mocker.patch('perma_payments.models.reserve_reference_number', autospec=True, side_effect=[False, False, True])
+    rn = generate_reference_number()
+    assert reserve.call_count == 3
+    assert reserve.call_args[0][0] == rn
+
+
 def test_generate_reference_number_fails_after_100_tries(mocker):
-    available = mocker.patch('perma_payments.models.is_ref_number_available', autospec=True, return_value=False)
+    reserve = mocker.patch('perma_payments.models.reserve_reference_number', autospec=True, return_value=False)
     with pytest.raises(Exception) as excinfo:
         generate_reference_number()
     assert "No valid reference_number found" in str(excinfo)
-    assert available.call_count == 100
+    assert reserve.call_count == 100
+
+
+@pytest.mark.django_db
+def test_generate_reference_number_one_query_per_attempt(mocker):
+    ReferenceNumber.objects.create(reference_number='PERMA-0000-0000')
+    mocker.patch('perma_payments.models.random.choice', side_effect=['0'] * 8 + ['1'] * 8)
+    with CaptureQueriesContext(connection) as context:
+        rn = generate_reference_number()
+    assert rn == 'PERMA-1111-1111'
+    inserts = [query['sql'] for query in context.captured_queries if query['sql'].startswith('INSERT')]
+    assert len(inserts) == 2
+    # the rest are savepoint bookkeeping: no lookups
+    assert not [query['sql'] for query in context.captured_queries if query['sql'].startswith('SELECT')]
+    assert ReferenceNumber.objects.filter(reference_number=rn).exists()
+
+
+def test_instantiating_requests_allocates_no_reference_number(mocker):
+    generate = mocker.patch('perma_payments.models.generate_reference_number', autospec=True)
+    reserve = mocker.patch('perma_payments.models.reserve_reference_number', autospec=True)
+    assert SubscriptionRequest().reference_number == ''
+    assert PurchaseRequest().reference_number == ''
+    assert not generate.called and not reserve.called
+
+
+@pytest.mark.django_db
+def test_saving_request_allocates_reference_number(purchase_request):
+    assert purchase_request.reference_number.startswith(REFERENCE_NUMBER_PREFIX)
+    assert ReferenceNumber.objects.filter(reference_number=purchase_request.reference_number).exists()
+    purchase_request.save()
+    assert ReferenceNumber.objects.count() == 1
+
+
+@pytest.mark.django_db
+def test_saving_request_reserves_supplied_reference_number():
+    def purchase_request(reference_number):
+        return PurchaseRequest(
+            customer_pk=SENTINEL['customer_pk'],
+            customer_type=SENTINEL['customer_type'],
+            amount=SENTINEL['amount'],
+            link_quantity=SENTINEL['link_quantity'],
+            reference_number=reference_number
+        )
+    purchase_request('PERMA-1234-5678').save()
+    assert ReferenceNumber.objects.filter(reference_number='PERMA-1234-5678').exists()
+    with pytest.raises(IntegrityError):
+        with transaction.atomic():
+            purchase_request('PERMA-1234-5678').save()
+    assert PurchaseRequest.objects.count() == 1
+
+
+@pytest.mark.django_db
+def test_failed_insert_releases_reference_number(mocker):
+    mocker.patch('perma_payments.models.OutgoingTransaction.save', autospec=True, side_effect=IntegrityError)
+    with pytest.raises(IntegrityError):
+        PurchaseRequest(reference_number='PERMA-1234-5678').save()
+    assert not ReferenceNumber.objects.exists()
+
+
+@pytest.mark.django_db
+def test_reserve_reference_number_considers_subscription_agreements(complete_current_sa):
+    assert not reserve_reference_number(complete_current_sa.subscription_request.reference_number)
+
+
+@pytest.mark.django_db
+def test_reserve_reference_number_considers_purchase_requests(purchase_request):
+    assert not reserve_reference_number(purchase_request.reference_number)
+
+
+@pytest.mark.django_db(transaction=True)
+def test_reserve_reference_number_collision_leaves_transaction_usable():
+    with transaction.atomic():
+        assert reserve_reference_number('PERMA-1234-5678')
+        assert not reserve_reference_number('PERMA-1234-5678')
+        assert ReferenceNumber.objects.count() == 1
 
 
 @pytest.mark.django_db
-def test_is_ref_number_available_considers_subscription_agreements(complete_current_sa):
-    assert not is_ref_number_available(complete_current_sa.subscription_request.reference_number)
+def test_forget_subscription_statuses_waits_for_commit(settings, django_capture_on_commit_callbacks):
+    settings.CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+    customer = (1, 'Registrar')
+    key = subscription_status_cache_keys([customer])[customer]
+    cache.set(key, 'cached')
+    with django_capture_on_commit_callbacks() as callbacks:
+        forget_subscription_statuses([customer, (2, 'Individual')])
+        assert cache.get(subscription_status_cache_keys([customer])[customer]) == 'cached'
+    assert len(callbacks) == 1
+    callbacks[0]()
+    assert subscription_status_cache_keys([customer])[customer] != key
+    assert cache.get(subscription_status_cache_keys([customer])[customer]) is None
 
 
 @pytest.mark.django_db
-def test_is_ref_number_available_considers_purchase_requests(purchase_request):
-    assert not is_ref_number_available(purchase_request.reference_number)
+def test_forget_subscription_statuses_beats_slow_readers(settings, django_capture_on_commit_callbacks):
+    settings.CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+    customer = (1, 'Registrar')
+    # a reader takes its key, and reads the status...
+    key = subscription_status_cache_keys([customer])[customer]
+    # ...the status changes and is forgotten...
+    with django_capture_on_commit_callbacks(execute=True):
+        forget_subscription_statuses([customer])
+    # ...and then the reader caches what it read
+    cache.set(key, 'stale')
+    assert cache.get(subscription_status_cache_keys([customer])[customer]) is None
+
+
+def test_subscription_status_cache_keys_are_stable(settings):
+    settings.CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+    customers = [(1, 'Registrar'), (1, 'Individual')]
+    keys = subscription_status_cache_keys(customers)
+    assert keys == subscription_status_cache_keys(reversed(customers))
+    assert len(set(keys.values())) == 2
+
 
+@pytest.mark.django_db
+def test_reference_number_occupancy(mocker):
+    mocker.patch('perma_payments.models.REFERENCE_NUMBER_KEYSPACE', 4)
+    for rn in ['a', 'b', 'c']:
+        ReferenceNumber.objects.create(reference_number=rn)
+    occupancy = ReferenceNumber.occupancy()
+    assert occupancy['allocated'] == 3
+    assert occupancy['keyspace'] == 4
+    assert occupancy['occupancy'] == 0.75
+    assert occupancy['expected_attempts'] == 4
 
 
 # All Models
 
-def test_model_str_methods(mocker):
-    # Patch is_ref_number_available, called in initializing SubscriptionRequests,
-    # so that DB access isn't required. Not optimal; is there a better way to test this?
-    mocker.patch('perma_payments.models.is_ref_number_available', return_value=True)
+def test_model_str_methods():
     for model in apps.get_app_config('perma_payments').get_models():
         assert 'object' not in str(model())
 
@@ -450,6 +573,107 @@ def test_sa_customer_subscription_multiple_without_raise(settings, multiple_stan
     assert SubscriptionAgreement.customer_standing_subscription(multiple_standing_sa.customer_pk, multiple_standing_sa.customer_type) == multiple_standing_sa
 
 
+@pytest.mark.django_db
+def test_sa_customer_standing_subscription_fetches_at_most_two(standing_sa, django_assert_num_queries):
+    with django_assert_num_queries(1) as queries:
+        assert SubscriptionAgreement.customer_standing_subscription(standing_sa.customer_pk, standing_sa.customer_type) == standing_sa
+    assert 'LIMIT 2' in queries.captured_queries[0]['sql']
+
+
+@pytest.mark.django_db
+def test_sa_customer_standing_subscription_select_related(complete_current_sa, django_assert_num_queries):
+    with django_assert_num_queries(1):
+        sa = SubscriptionAgreement.customer_standing_subscription(
+            complete_current_sa.customer_pk,
+            complete_current_sa.customer_type,
+            select_related=WITH_SUBSCRIPTION_REQUEST
+        )
+        assert sa.subscription_request.reference_number == complete_current_sa.subscription_request.reference_number
+
+
+@pytest.mark.django_db
+def test_sa_customer_subscription_multiple_logs_count(settings, multiple_standing_sa, mocker):
+    settings.RAISE_IF_MULTIPLE_SUBSCRIPTIONS_FOUND = False
+    log = mocker.patch('perma_payments.models.logger.error', autospec=True)
+    SubscriptionAgreement.customer_standing_subscription(multiple_standing_sa.customer_pk, multiple_standing_sa.customer_type)
+    assert '({})'.format(SubscriptionAgreement.objects.count()) in log.call_args[0][0]
+
+
+@pytest.mark.django_db
+def test_sa_customers_standing_subscriptions(standing_sa, django_assert_num_queries):
+    other = SubscriptionAgreement(customer_pk=SENTINEL['customer_pk'] + 1, customer_type=SENTINEL['customer_type'], status='Superseded')
+    other.save()
+    customers = [(standing_sa.customer_pk, standing_sa.customer_type), (other.customer_pk, other.customer_type), (standing_sa.customer_pk, 'arbitrary non-matching string')]
+    with django_assert_num_queries(1):
+        found = SubscriptionAgreement.customers_standing_subscriptions(customers)
+    assert found == {customers[0]: standing_sa, customers[1]: None, customers[2]: None}
+
+
+@pytest.mark.django_db
+def test_sa_customers_standing_subscriptions_multiple_with_raise(settings, multiple_standing_sa):
+    settings.RAISE_IF_MULTIPLE_SUBSCRIPTIONS_FOUND = True
+    customer = (multiple_standing_sa.customer_pk, multiple_standing_sa.customer_type)
+    other = (SENTINEL['customer_pk'] + 1, SENTINEL['customer_type'])
+    found = SubscriptionAgreement.customers_standing_subscriptions([customer, other])
+    assert isinstance(found[customer], SubscriptionAgreement.MultipleObjectsReturned)
+    assert found[other] is None
+
+
+@pytest.mark.django_db
+def test_sa_customers_standing_subscriptions_multiple_without_raise(settings, multiple_standing_sa):
+    settings.RAISE_IF_MULTIPLE_SUBSCRIPTIONS_FOUND = False
+    customer = (multiple_standing_sa.customer_pk, multiple_standing_sa.customer_type)
+    assert SubscriptionAgreement.customers_standing_subscriptions([customer]) == {customer: multiple_standing_sa}
+
+
+@pytest.mark.django_db
+def test_sa_customer_standing_subscription_uses_index(standing_sa):
+    [plan] = query_plans(SubscriptionAgreement.customer_standing_subscription, standing_sa.customer_pk, standing_sa.customer_type)
+    assert 'sa_standing_customer_idx' in plan
+
+
+def subscriptions_and_status_report(count):
+    report = []
+    for i in range(count):
+        sa = SubscriptionAgreement(customer_pk=i, customer_type=SENTINEL['customer_type'], status='Current')
+        sa.save()
+        SubscriptionRequest(
+            subscription_agreement=sa,
+            reference_number='{}-{}'.format(count, i),
+            amount=SENTINEL['amount'],
+            recurring_amount=SENTINEL['recurring_amount'],
+            recurring_start_date=GENESIS,
+            recurring_frequency='monthly',
+            link_limit=SENTINEL['link_limit'],
+            link_limit_effective_timestamp=GENESIS
+        ).save()
+        report.append({'Merchant Reference Code': '{}-{}'.format(count, i), 'Status': 'HOLD'})
+    return report
+
+
+@pytest.mark.django_db
+def test_sa_apply_status_report_queries_do_not_scale_with_rows():
+    few = subscriptions_and_status_report(2)
+    many = subscriptions_and_status_report(20)
+    with CaptureQueriesContext(connection) as few_queries:
+        assert [result['outcome'] for result in SubscriptionAgreement.apply_status_report(few)] == ['updated'] * 2
+    with CaptureQueriesContext(connection) as many_queries:
+        assert [result['outcome'] for result in SubscriptionAgreement.apply_status_report(many)] == ['updated'] * 20
+    assert len(few_queries) == len(many_queries)
+    assert SubscriptionAgreement.objects.filter(status='Hold').count() == 22
+    assert SubscriptionAgreement.history.filter(status='Hold').count() == 22
+
+
+@pytest.mark.django_db
+def test_sa_apply_status_report_chunks(mocker):
+    mocker.patch('perma_payments.models.STATUS_REPORT_CHUNK_SIZE', 5)
+    report = subscriptions_and_status_report(12)
+    with CaptureQueriesContext(connection) as queries:
+        results = list(SubscriptionAgreement.apply_status_report(report))
+    assert [result['row'] for result in results] == list(range(1, 13))
+    assert len([query for query in queries if query['sql'].startswith('SELECT')]) == 3
+
+
 @pytest.mark.django_db
 def test_sa_can_be_altered_true(standing_sa):
     assert standing_sa.can_be_altered()
@@ -505,14 +729,128 @@ def test_sa_update_after_cs_decision_cr(decision, mocker, change_request):
     assert log.call_count == 1
 
 
+@pytest.mark.django_db
+def test_sa_update_after_cs_decision_forgets_cached_status(mocker, complete_subscription_request):
+    mocker.patch('perma_payments.models.logger.log', autospec=True)
+    forget = mocker.patch('perma_payments.models.forget_subscription_statuses', autospec=True)
+    sa = complete_subscription_request.subscription_agreement
+    sa.update_after_cs_decision(complete_subscription_request, 'ACCEPT', {})
+    forget.assert_called_once_with([(sa.customer_pk, sa.customer_type)])
+
+
 @pytest.mark.django_db
 def test_sa_calculate_paid_through_date_annual(complete_current_sa):
     # lame test just to pass through some of the code
     assert complete_current_sa.calculate_paid_through_date_from_reported_status('Current').tzinfo
 
 
+# SubscriptionSummary
+
+def subscription(status, frequency='monthly', rate='10.00', cancellation_requested=False):
+    return SubscriptionAgreement.objects.create(
+        customer_pk=random.randint(1, 1000000),
+        customer_type=SENTINEL['customer_type'],
+        status=status,
+        current_frequency=frequency,
+        current_rate=Decimal(rate) if rate else None,
+        cancellation_requested=cancellation_requested
+    )
+
+
+@pytest.mark.django_db
+def test_subscription_summary_dashboard():
+    subscription('Current', 'monthly', '10.00')
+    subscription('Current', 'monthly', '15.00', cancellation_requested=True)
+    subscription('Current', 'annually', '120.00')
+    subscription('Hold', 'annually', '120.00')
+    subscription('Canceled', 'monthly', '10.00', cancellation_requested=True)
+    subscription('Pending', None, None)
+    SubscriptionSummary.refresh()
+    dashboard = SubscriptionSummary.dashboard()
+    assert dashboard['by_status'] == [('Canceled', 1), ('Current', 3), ('Hold', 1), ('Pending', 1)]
+    assert dashboard['by_frequency'] == [('annually', 2), ('monthly', 2)]
+    assert dashboard['monthly_recurring_revenue'] == Decimal('35.00')
+    assert dashboard['pending_cancellations'] == 1
+    assert dashboard['refreshed_at']
+
+
+@pytest.mark.django_db
+def test_subscription_summary_reads_one_small_table(django_assert_num_queries):
+    for _ in range(10):
+        subscription('Current')
+    SubscriptionSummary.refresh()
+    assert SubscriptionSummary.objects.count() == 1
+    with django_assert_num_queries(1):
+        assert SubscriptionSummary.dashboard()['by_status'] == [('Current', 10)]
+
+
+@pytest.mark.django_db
+def test_subscription_summary_refreshed_after_cs_decision(django_capture_on_commit_callbacks):
+    sa = subscription('Pending', None, None)
+    sr = SubscriptionRequest.objects.create(
+        subscription_agreement=sa,
+        amount=SENTINEL['amount'],
+        recurring_amount=SENTINEL['recurring_amount'],
+        recurring_start_date=GENESIS,
+        recurring_frequency='monthly',
+        link_limit=SENTINEL['link_limit'],
+        link_limit_effective_timestamp=GENESIS
+    )
+    SubscriptionSummary.refresh()
+    assert SubscriptionSummary.dashboard()['by_status'] == [('Pending', 1)]
+    with django_capture_on_commit_callbacks(execute=True):
+        sa.update_after_cs_decision(sr, 'ACCEPT', {})
+    assert SubscriptionSummary.dashboard()['by_status'] == [('Current', 1)]
+
+
+@pytest.mark.django_db
+def test_subscription_summary_refreshed_after_status_report(django_capture_on_commit_callbacks):
+    sa = subscription('Current')
+    SubscriptionRequest.objects.create(
+        subscription_agreement=sa,
+        reference_number='PERMA-1111-2222',
+        amount=SENTINEL['amount'],
+        recurring_amount=SENTINEL['recurring_amount'],
+        recurring_start_date=GENESIS,
+        recurring_frequency='monthly',
+        link_limit=SENTINEL['link_limit'],
+        link_limit_effective_timestamp=GENESIS
+    )
+    SubscriptionSummary.refresh()
+    with django_capture_on_commit_callbacks(execute=True):
+        list(SubscriptionAgreement.apply_status_report([{'Merchant Reference Code': 'PERMA-1111-2222', 'Status': 'HOLD'}]))
+    assert SubscriptionSummary.dashboard()['by_status'] == [('Hold', 1)]
+
+
+@pytest.mark.django_db
+def test_subscription_summary_refresh_debounced(settings, mocker, django_capture_on_commit_callbacks):
+    settings.CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+    cache.clear()
+    refresh = mocker.patch('perma_payments.models.SubscriptionSummary.refresh', autospec=True)
+    with django_capture_on_commit_callbacks(execute=True):
+        refresh_subscription_summary()
+    with django_capture_on_commit_callbacks(execute=True):
+        refresh_subscription_summary()
+        refresh_subscription_summary()
+    assert refresh.call_count == 1
+    cache.clear()
+    with django_capture_on_commit_callbacks(execute=True):
+        refresh_subscription_summary()
+    assert refresh.call_count == 2
+    cache.clear()
+
+
+@pytest.mark.django_db
+def test_subscription_summary_template_tag():
+    subscription('Current', cancellation_requested=True)
+    SubscriptionSummary.refresh()
+    template = engines['django'].from_string('{% load dashboard %}{% subscription_summary as summary %}{{ summary.pending_cancellations }}')
+    assert template.render() == '1'
+
+
 # OutgoingTransaction
 
+@pytest.mark.django_db
 def test_outgoing_required_fields():
     # None yet!
     absent_required_fields_raise_validation_error(
@@ -534,15 +872,85 @@ def test_outgoing_get_formatted_datetime(blank_outgoing_transaction):
     assert blank_outgoing_transaction.get_formatted_datetime() == '1970-01-01T00:00:00Z'
 
 
+@pytest.mark.django_db
+def test_outgoing_transaction_uuid_unique(blank_outgoing_transaction):
+    with pytest.raises(IntegrityError):
+        OutgoingTransaction(transaction_uuid=blank_outgoing_transaction.transaction_uuid).save()
+
+
+def found_with_subscription_agreement(outgoing, django_assert_num_queries):
+    with django_assert_num_queries(2):
+        found = OutgoingTransaction.get_by_transaction_uuid(outgoing.transaction_uuid)
+        assert type(found) is type(outgoing)
+        assert found.pk == outgoing.pk
+        assert found.subscription_agreement.pk == outgoing.subscription_agreement.pk
+
+
+@pytest.mark.django_db
+def test_outgoing_get_by_transaction_uuid_subscription_request(complete_subscription_request, django_assert_num_queries):
+    found_with_subscription_agreement(complete_subscription_request, django_assert_num_queries)
+
+
+@pytest.mark.django_db
+def test_outgoing_get_by_transaction_uuid_change_request(change_request, django_assert_num_queries):
+    change_request.save()
+    found_with_subscription_agreement(change_request, django_assert_num_queries)
+
+
+@pytest.mark.django_db
+def test_outgoing_get_by_transaction_uuid_update_request(barebones_update_request, django_assert_num_queries):
+    barebones_update_request.save()
+    found_with_subscription_agreement(barebones_update_request, django_assert_num_queries)
+
+
+@pytest.mark.django_db
+def test_outgoing_get_by_transaction_uuid_purchase_request(purchase_request, django_assert_num_queries):
+    with django_assert_num_queries(2):
+        found = OutgoingTransaction.get_by_transaction_uuid(purchase_request.transaction_uuid)
+        assert type(found) is PurchaseRequest
+        assert found.pk == purchase_request.pk
+
+
+@pytest.mark.django_db
+def test_outgoing_get_by_transaction_uuid_for_update(change_request):
+    change_request.save()
+    with CaptureQueriesContext(connection) as queries:
+        OutgoingTransaction.get_by_transaction_uuid(change_request.transaction_uuid, for_update=True)
+    assert queries.captured_queries[-1]['sql'].endswith('FOR UPDATE OF "perma_payments_changerequest"')
+
+
+@pytest.mark.django_db
+def test_outgoing_response_recorded_change_request(change_request_response):
+    change_request = change_request_response.related_request
+    change_request.save()
+    assert not change_request.response_recorded()
+    change_request_response.full_response = b'someencryptedbytes'
+    change_request_response.encryption_key_id = 1
+    change_request_response.save()
+    assert change_request.response_recorded()
+
+
+@pytest.mark.django_db
+def test_outgoing_response_recorded_purchase_request(purchase_request):
+    assert not purchase_request.response_recorded()
+    PurchaseRequestResponse(related_request=purchase_request, full_response=b'someencryptedbytes', encryption_key_id=1).save()
+    assert purchase_request.response_recorded()
+
+
+@pytest.mark.django_db
+def test_outgoing_get_by_transaction_uuid_not_found():
+    with pytest.raises(OutgoingTransaction.DoesNotExist):
+        OutgoingTransaction.get_by_transaction_uuid(SENTINEL['req_transaction_uuid'])
+
+
 # SubscriptionRequest
 
 def test_sr_inherits_from_outgoing_transaction():
     assert issubclass(SubscriptionRequest, OutgoingTransaction)
 
 
-def test_sr_required_fields(mocker):
-    # Mocked to avoid hitting DB
-    mocker.patch('perma_payments.models.is_ref_number_available', return_value=True)
+@pytest.mark.django_db
+def test_sr_required_fields():
     absent_required_fields_raise_validation_error(
         SubscriptionRequest(), [
             'subscription_agreement',
@@ -556,9 +964,7 @@ def test_sr_required_fields(mocker):
     )
 
 
-def test_sr_autopopulated_fields(mocker):
-    # Mocked to avoid hitting DB
-    mocker.patch('perma_payments.models.is_ref_number_available', return_value=True)
+def test_sr_autopopulated_fields():
     autopopulated_fields_present(
         SubscriptionRequest(), [
             'currency',
@@ -586,9 +992,8 @@ def test_cr_inherits_from_outgoing_transaction():
     assert issubclass(SubscriptionRequest, OutgoingTransaction)
 
 
-def test_cr_required_fields(mocker):
-    # Mocked to avoid hitting DB
-    mocker.patch('perma_payments.models.is_ref_number_available', return_value=True)
+@pytest.mark.django_db
+def test_cr_required_fields():
     absent_required_fields_raise_validation_error(
         ChangeRequest(), [
             'subscription_agreement',
@@ -600,9 +1005,7 @@ def test_cr_required_fields(mocker):
     )
 
 
-def test_cr_autopopulated_fields(mocker):
-    # Mocked to avoid hitting DB
-    mocker.patch('perma_payments.models.is_ref_number_available', return_value=True)
+def test_cr_autopopulated_fields():
     autopopulated_fields_present(
         ChangeRequest(), [
             'currency',
@@ -635,6 +1038,7 @@ def test_update_inherits_from_outgoing_transaction():
     assert issubclass(UpdateRequest, OutgoingTransaction)
 
 
+@pytest.mark.django_db
 def test_update_required_fields():
     absent_required_fields_raise_validation_error(
         UpdateRequest(), [
@@ -825,6 +1229,27 @@ def test_prr_act_on_cs_decision(mocker, purchase_request_response):
     assert log.call_count == 1
 
 
+@pytest.mark.django_db
+def test_prr_act_on_cs_decision_forgets_cached_status(mocker, purchase_request_response):
+    mocker.patch('perma_payments.models.logger.log', autospec=True)
+    forget = mocker.patch('perma_payments.models.forget_subscription_statuses', autospec=True)
+    purchase_request_response.act_on_cs_decision({})
+    forget.assert_called_once_with([(SENTINEL['customer_pk'], SENTINEL['customer_type'])])
+
+
+@pytest.mark.django_db
+def test_prr_customers_unacknowledged(mocker, processed_purchase_request_response, django_assert_num_queries):
+    prr = processed_purchase_request_response
+    customer = (prr.customer_pk, prr.customer_type)
+    other = (prr.customer_pk + 1, prr.customer_type)
+    with django_assert_num_queries(1):
+        found = PurchaseRequestResponse.customers_unacknowledged([customer, other])
+    assert found == {
+        customer: PurchaseRequestResponse.customer_unacknowledged(*customer),
+        other: []
+    }
+
+
 @pytest.mark.django_db
 def test_prr_customer_unacknowledged(mocker, processed_purchase_request_response):
     prr = processed_purchase_request_response
@@ -848,6 +1273,20 @@ def test_prr_customer_history(mocker, processed_purchase_request_response):
         assert not PurchaseRequestResponse.customer_history(prr.customer_pk, prr.customer_type)
 
 
+@pytest.mark.django_db
+def test_prr_customer_unacknowledged_uses_index(processed_purchase_request_response):
+    prr = processed_purchase_request_response
+    [plan] = query_plans(PurchaseRequestResponse.customer_unacknowledged, prr.customer_pk, prr.customer_type)
+    assert 'prr_unacknowledged_idx' in plan
+
+
+@pytest.mark.django_db
+def test_prr_customer_history_uses_index(processed_purchase_request_response):
+    prr = processed_purchase_request_response
+    [plan] = query_plans(PurchaseRequestResponse.customer_history, prr.customer_pk, prr.customer_type)
+    assert 'pr_customer_idx' in plan
+
+
 # SubscriptionRequestResponse
 
 def test_srr_inherits_from_outgoing_transaction():
@@ -0,0 +1,81 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.db import Error, connections
+
+import pytest
+
+from perma_payments.postgresql_pool.base import DatabaseWrapper, close_pools
+
+
+#
+# FIXTURES
+#
+
+@pytest.fixture()
+def pooled():
+    """
+    Makes connections to the test database through the pool, as Django would for each thread.
+    """
+    wrappers = []
+
+    def make(**settings):
+        wrappers.append(DatabaseWrapper({**connections['default'].settings_dict, 'CONN_MAX_AGE': 0, **settings}, 'pooled'))
+        return wrappers[-1]
+    yield make
+    for wrapper in wrappers:
+        wrapper.close()
+    close_pools()
+
+
+def backend_pid(wrapper):
+    with wrapper.cursor() as cursor:
+        cursor.execute('SELECT pg_backend_pid()')
+        return cursor.fetchone()[0]
+
+
+#
+# TESTS
+#
+
+@pytest.mark.django_db
+def test_closed_connections_are_reused(pooled):
+    wrapper = pooled()
+    pid = backend_pid(wrapper)
+    wrapper.close()
+    assert wrapper.connection is None
+    assert backend_pid(wrapper) == pid
+    assert backend_pid(pooled()) != pid
+
+
+@pytest.mark.django_db
+def test_open_transaction_rolled_back_when_returned(pooled):
+    wrapper = pooled()
+    wrapper.set_autocommit(False)
+    with wrapper.cursor() as cursor:
+        cursor.execute('CREATE TEMPORARY TABLE rolled_back (id integer)')
+    wrapper.close()
+    with wrapper.cursor() as cursor:
+        cursor.execute("SELECT to_regclass('pg_temp.rolled_back')")
+        assert cursor.fetchone()[0] is None
+
+
+@pytest.mark.django_db
+def test_health_checks_replace_dropped_connections(pooled):
+    wrapper = pooled(CONN_HEALTH_CHECKS=True)
+    pid = backend_pid(wrapper)
+    wrapper.close()
+    with connections['default'].cursor() as cursor:
+        cursor.execute('SELECT pg_terminate_backend(%s)', [pid])
+    assert backend_pid(wrapper) not in (None, pid)
+
+
+@pytest.mark.django_db
+def test_pool_max_size(pooled):
+    backend_pid(pooled(POOL={'MIN_SIZE': 1, 'MAX_SIZE': 1}))
+    with pytest.raises(Error, match='exhausted'):
+        backend_pid(pooled(POOL={'MIN_SIZE': 1, 'MAX_SIZE': 1}))
+
+
+@pytest.mark.django_db
+def test_persistent_connections_not_pooled(pooled):
+    with pytest.raises(ImproperlyConfigured):
+        pooled(CONN_MAX_AGE=60).ensure_connection()
@@ -0,0 +1,177 @@
+from django.http import QueryDict
+from django.urls import reverse
+
+from config.settings.utils.post_processing import post_process_settings
+
+import pytest
+from pytest_factoryboy import register
+
+from perma_payments import response_encryption
+from perma_payments.benchmarks import encode_from_cybersource
+from perma_payments.models import PurchaseRequestResponse, Response
+from perma_payments.response_encryption import _queue, drain, encrypt_next, encrypt_pending_full_responses, queue_full_response
+from perma_payments.security import decrypt_from_storage, encrypt_for_staging, stringify_data, unstringify_data
+
+from .factories import PurchaseRequestFactory, PurchaseRequestResponseFactory
+
+register(PurchaseRequestFactory)
+register(PurchaseRequestResponseFactory)
+
+
+#
+# FIXTURES
+#
+
+@pytest.fixture()
+def in_background(settings):
+    settings.ENCRYPT_RESPONSES_IN_BACKGROUND = True
+
+
+@pytest.fixture()
+def full_response():
+    return QueryDict('decision=ACCEPT&reason_code=100&message=OK')
+
+
+@pytest.fixture()
+def pending_responses(purchase_request_response_factory, full_response):
+    return [
+        purchase_request_response_factory(full_response=b'', full_response_pending=True, staged_full_response=encrypt_for_staging(stringify_data(full_response)))
+        for _ in range(3)
+    ]
+
+
+def stored(response):
+    response.refresh_from_db()
+    return unstringify_data(decrypt_from_storage(bytes(response.full_response)))
+
+
+#
+# TESTS
+#
+
+@pytest.mark.django_db
+def test_encrypted_immediately_by_default(purchase_request, full_response, django_capture_on_commit_callbacks):
+    with django_capture_on_commit_callbacks() as callbacks:
+        response = Response.save_new_with_encrypted_full_response(PurchaseRequestResponse, full_response, {'related_request': purchase_request})
+    assert not callbacks
+    assert not response.full_response_pending
+    assert stored(response)['decision'] == 'ACCEPT'
+
+
+@pytest.mark.django_db
+def test_encryption_deferred_until_commit(in_background, purchase_request, full_response, django_capture_on_commit_callbacks):
+    with django_capture_on_commit_callbacks() as callbacks:
+        response = Response.save_new_with_encrypted_full_response(
+            PurchaseRequestResponse, full_response, {'related_request': purchase_request, 'decision': 'ACCEPT'}
+        )
+    response.refresh_from_db()
+    assert response.decision == 'ACCEPT'
+    assert response.full_response_pending
+    assert bytes(response.full_response) == b''
+    # staged, but not in the clear
+    assert bytes(response.staged_full_response)
+    assert b'ACCEPT' not in bytes(response.staged_full_response)
+
+    callbacks[0]()
+    assert stored(response) == {'decision': 'ACCEPT', 'reason_code': '100', 'message': 'OK'}
+    assert not response.full_response_pending
+    assert bytes(response.staged_full_response) == b''
+
+
+@pytest.mark.django_db
+def test_callback_in_background_mode(client, in_background, purchase_request, django_capture_on_commit_callbacks):
+    with django_capture_on_commit_callbacks(execute=True):
+        response = client.post(reverse('cybersource_callback'), encode_from_cybersource({
+            'req_transaction_uuid': purchase_request.transaction_uuid,
+            'decision': 'DECLINE',
+            'reason_code': '481',
+            'message': 'Declined.',
+        }))
+    assert response.status_code == 200
+    prr = PurchaseRequestResponse.objects.get(related_request=purchase_request)
+    assert prr.decision == 'DECLINE'
+    assert stored(prr)['req_transaction_uuid'] == str(purchase_request.transaction_uuid)
+    assert not prr.full_response_pending
+
+
+@pytest.mark.django_db(transaction=True)
+def test_encrypted_in_thread(settings, pending_responses, full_response):
+    settings.RESPONSE_ENCRYPTION_IN_THREAD = True
+    for response in pending_responses:
+        queue_full_response(response.pk)
+    _queue.join()
+    for response in pending_responses:
+        assert stored(response)['message'] == 'OK'
+        assert not response.full_response_pending
+
+
+@pytest.mark.django_db
+def test_encrypted_synchronously_when_queue_full(settings, pending_responses, full_response, mocker):
+    settings.RESPONSE_ENCRYPTION_IN_THREAD = True
+    settings.RESPONSE_ENCRYPTION_QUEUE_LIMIT = 0
+    thread = mocker.patch('perma_payments.response_encryption.threading.Thread', autospec=True)
+    queue_full_response(pending_responses[0].pk)
+    assert not thread.called
+    assert _queue.empty()
+    assert stored(pending_responses[0])['message'] == 'OK'
+
+
+@pytest.mark.django_db
+def test_drain(pending_responses, full_response):
+    for response in pending_responses:
+        _queue.put(response.pk)
+    drain()
+    assert _queue.empty()
+    for response in pending_responses:
+        assert stored(response)['message'] == 'OK'
+
+
+@pytest.mark.django_db
+def test_failure_logged_and_left_staged(pending_responses, full_response, mocker, caplog):
+    mocker.patch('perma_payments.response_encryption.encrypt_for_storage', autospec=True, side_effect=[Exception('boom'), b'encrypted'])
+    for response in pending_responses[:2]:
+        _queue.put(response.pk)
+    assert encrypt_next(block=False)
+    assert encrypt_next(block=False)
+    assert not encrypt_next(block=False)
+    assert 'Failed to encrypt the full response of Response {}'.format(pending_responses[0].pk) in caplog.text
+    pending_responses[0].refresh_from_db()
+    pending_responses[1].refresh_from_db()
+    assert pending_responses[0].full_response_pending
+    assert not pending_responses[1].full_response_pending
+    assert bytes(pending_responses[0].staged_full_response)
+
+    # and can be recovered
+    mocker.stopall()
+    assert encrypt_pending_full_responses() == []
+    assert stored(pending_responses[0])['message'] == 'OK'
+
+
+@pytest.mark.django_db
+def test_encrypt_pending_full_responses(pending_responses, mocker):
+    # e.g. the process that saved them was killed before encrypting them
+    mocker.patch('perma_payments.response_encryption.encrypt_for_storage', autospec=True, side_effect=[Exception('boom'), b'encrypted', b'encrypted'])
+    assert encrypt_pending_full_responses() == [pending_responses[0].pk]
+    mocker.stopall()
+    assert encrypt_pending_full_responses() == []
+    for response in pending_responses:
+        response.refresh_from_db()
+        assert not response.full_response_pending
+        assert bytes(response.staged_full_response) == b''
+    assert stored(pending_responses[0])['message'] == 'OK'
+    assert encrypt_pending_full_responses() == []
+
+
+@pytest.mark.django_db
+def test_encrypt_full_response_only_once(pending_responses, mocker):
+    encrypt = mocker.spy(response_encryption, 'encrypt_for_storage')
+    queue_full_response(pending_responses[0].pk)
+    queue_full_response(pending_responses[0].pk)
+    assert encrypt.call_count == 1
+
+
+def test_background_encryption_requires_staging_key():
+    settings = {'SECRET_KEY': 'secret', 'DATABASES': {'default': {}}, 'CACHES': {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}, 'ENCRYPT_RESPONSES_IN_BACKGROUND': True, 'RESPONSE_STAGING_KEY': None}
+    with pytest.raises(AssertionError, match='RESPONSE_STAGING_KEY'):
+        post_process_settings(settings)
+    post_process_settings(dict(settings, RESPONSE_STAGING_KEY='key'))
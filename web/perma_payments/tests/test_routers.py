@@ -0,0 +1,175 @@
+from django.core.cache import cache
+from django.db import connections, transaction
+from django.template import engines
+from django.template.response import TemplateResponse
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+import pytest
+from pytest_factoryboy import register
+
+from config.settings.utils.post_processing import post_process_settings
+from perma_payments.benchmarks import encode_for_perma_payments
+from perma_payments.models import SubscriptionAgreement, forget_subscription_statuses
+from perma_payments.routers import ReplicaRouter, pin_to_primary, reads_from_replica, use_replica
+
+from .factories import SubscriptionAgreementFactory
+
+register(SubscriptionAgreementFactory)
+
+# Outside of a transaction, as in production: inside one, reads stay on the primary.
+replica_db = pytest.mark.django_db(transaction=True, databases=['default', 'replica'])
+
+
+#
+# FIXTURES
+#
+
+@pytest.fixture()
+def replica(settings):
+    settings.DATABASE_REPLICAS = ['replica']
+    yield
+    # otherwise, the test database can't be dropped
+    connections['replica'].close()
+
+
+@pytest.fixture()
+def locmem_cache(settings):
+    settings.CACHES = {**settings.CACHES, 'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+    cache.clear()
+    yield cache
+    cache.clear()
+
+
+@pytest.fixture()
+def queries():
+    """
+    Captures the queries made on the primary and on the replica.
+    """
+    with CaptureQueriesContext(connections['default']) as primary, CaptureQueriesContext(connections['replica']) as replica:
+        yield {'primary': primary, 'replica': replica}
+
+
+def count(captured):
+    return {alias: len(queries) for alias, queries in captured.items()}
+
+
+#
+# TESTS
+#
+
+@replica_db
+def test_reads_use_primary_outside_use_replica(replica, queries):
+    SubscriptionAgreement.objects.count()
+    assert count(queries) == {'primary': 1, 'replica': 0}
+
+
+@replica_db
+def test_reads_use_replica_inside_use_replica(replica, queries):
+    with use_replica():
+        SubscriptionAgreement.objects.count()
+    assert count(queries) == {'primary': 0, 'replica': 1}
+
+
+@replica_db
+def test_no_replicas_configured(queries):
+    with use_replica():
+        SubscriptionAgreement.objects.count()
+    assert count(queries) == {'primary': 1, 'replica': 0}
+
+
+@replica_db
+def test_reads_stick_to_primary_after_a_write(replica, subscription_agreement):
+    with use_replica():
+        SubscriptionAgreement.objects.count()
+        subscription_agreement.save(update_fields=['status'])
+        with CaptureQueriesContext(connections['default']) as primary:
+            assert SubscriptionAgreement.objects.count() == 1
+    assert len(primary) == 1
+
+
+@replica_db
+def test_reads_stay_on_primary_inside_a_transaction(replica, queries):
+    with use_replica(), transaction.atomic():
+        SubscriptionAgreement.objects.count()
+    assert count(queries)['replica'] == 0
+
+
+@replica_db
+def test_recently_written_customers_read_from_primary(replica, locmem_cache, queries):
+    pin_to_primary([(1, 'Registrar')])
+    with use_replica(customers=[(2, 'Registrar'), (1, 'Registrar')]):
+        SubscriptionAgreement.objects.count()
+    with use_replica(customers=[(2, 'Registrar')]):
+        SubscriptionAgreement.objects.count()
+    assert count(queries) == {'primary': 1, 'replica': 1}
+
+
+@replica_db
+def test_forgetting_statuses_pins_customers_to_primary(replica, locmem_cache, queries, django_capture_on_commit_callbacks):
+    with django_capture_on_commit_callbacks(execute=True):
+        forget_subscription_statuses([(1, 'Registrar')])
+    with use_replica(customers=[(1, 'Registrar')]):
+        SubscriptionAgreement.objects.count()
+    assert count(queries)['replica'] == 0
+
+
+@replica_db
+@pytest.mark.parametrize('route, customers', [
+    ('subscription', {'customer_pk': 1, 'customer_type': 'Registrar'}),
+    ('subscriptions', {'customers': [[1, 'Registrar'], [2, 'Individual']]}),
+    ('purchase_history', {'customer_pk': 1, 'customer_type': 'Registrar'}),
+])
+def test_read_only_perma_routes_use_replica(client, replica, queries, route, customers):
+    response = client.post(reverse(route), encode_for_perma_payments(customers))
+    assert response.status_code == 200
+    assert count(queries)['primary'] == 0
+    assert count(queries)['replica'] > 0
+
+
+@replica_db
+def test_reads_from_replica_renders_templates_inside(rf, replica):
+    @reads_from_replica
+    def view(request):
+        return TemplateResponse(request, engines['django'].from_string('{{ agreements.count }}'), {'agreements': SubscriptionAgreement.objects.all()})
+
+    with CaptureQueriesContext(connections['replica']) as replica_queries:
+        response = view(rf.get('/'))
+    assert response.content == b'0'
+    assert len(replica_queries) == 1
+    with CaptureQueriesContext(connections['replica']) as replica_queries:
+        view(rf.post('/')).render()
+    assert len(replica_queries) == 0
+
+
+def test_replicas_not_migrated(replica):
+    router = ReplicaRouter()
+    assert router.allow_migrate('default', 'perma_payments') is True
+    assert router.allow_migrate('replica', 'perma_payments') is False
+
+
+def test_replicas_inherit_primary_settings():
+    settings = {
+        'SECRET_KEY': 'secret',
+        'DATABASES': {
+            'default': {'ENGINE': 'django.db.backends.postgresql', 'HOST': 'primary', 'CONN_MAX_AGE': 60},
+            'replica': {'HOST': 'replica'},
+        },
+        'DATABASE_REPLICAS': ['replica'],
+        'CACHES': {'default': {'BACKEND': 'django.core.cache.backends.db.DatabaseCache'}},
+    }
+    post_process_settings(settings)
+    assert settings['DATABASES']['replica'] == {'ENGINE': 'django.db.backends.postgresql', 'HOST': 'replica', 'CONN_MAX_AGE': 60}
+    assert settings['DATABASES']['default']['HOST'] == 'primary'
+
+
+@pytest.mark.parametrize('backend', ['django.core.cache.backends.locmem.LocMemCache', 'django.core.cache.backends.dummy.DummyCache'])
+def test_replicas_require_shared_cache(backend):
+    settings = {
+        'SECRET_KEY': 'secret',
+        'DATABASES': {'default': {}, 'replica': {'HOST': 'replica'}},
+        'DATABASE_REPLICAS': ['replica'],
+        'CACHES': {'default': {'BACKEND': backend}},
+    }
+    with pytest.raises(AssertionError, match='DATABASE_REPLICAS'):
+        post_process_settings(settings)
@@ -9,13 +9,19 @@ These are integration tests covering:
 
 import csv
 import io
-from datetime import datetime
+from datetime import datetime, timedelta
 import logging
+import threading
+import time
 
 from django.conf import settings
 from django.contrib.auth.models import User
-from django.core.exceptions import ValidationError, ObjectDoesNotExist, MultipleObjectsReturned
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import DatabaseError, connections
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
 from django.utils.timezone import make_aware
 
 
@@ -23,10 +29,12 @@ import pytest
 from pytest_factoryboy import register
 from unittest.mock import Mock
 
+from config.settings.utils.post_processing import post_process_settings
+from perma_payments.benchmarks import encode_from_cybersource
 from perma_payments.constants import CS_SUBSCRIPTION_SEARCH_URL
-from perma_payments.models import (STANDING_STATUSES,
-    SubscriptionAgreement, UpdateRequestResponse, ChangeRequestResponse,
-    SubscriptionRequestResponse, PurchaseRequestResponse)
+from perma_payments.models import (STANDING_STATUSES, WITH_SUBSCRIPTION_REQUEST, WITH_SUBSCRIPTION_REQUEST_RESPONSE, StatusUpdateJob, OutgoingEmail,
+    subscription_status_cache_keys, SubscriptionAgreement, SubscriptionRequest, UpdateRequestResponse, ChangeRequestResponse,
+    SubscriptionRequestResponse, PurchaseRequest, PurchaseRequestResponse)
 from perma_payments.security import InvalidTransmissionException
 from perma_payments.views import (FIELDS_REQUIRED_FROM_PERMA,
     FIELDS_REQUIRED_FOR_CYBERSOURCE, FIELDS_REQUIRED_FROM_CYBERSOURCE, redact)
@@ -95,6 +103,19 @@ def acknowledge_purchase():
     return data
 
 
+@pytest.fixture
+def acknowledge_purchases():
+    data = {
+        'route': '/acknowledge-purchases/',
+        'valid_data': {
+            'purchase_pks': [SENTINEL['purchase_pk']],
+        }
+    }
+    for field in FIELDS_REQUIRED_FROM_PERMA['acknowledge_purchases']:
+        assert field in data['valid_data']
+    return data
+
+
 @pytest.fixture
 def purchase_history():
     return {
@@ -209,6 +230,18 @@ def subscription():
     }
 
 
+@pytest.fixture
+def subscriptions():
+    return {
+        'route': '/subscriptions/',
+        'valid_data': {
+            'customers': [
+                [SENTINEL['customer_pk'], SENTINEL['customer_type']],
+            ],
+        }
+    }
+
+
 @pytest.fixture
 def cancel_request():
     return {
@@ -339,6 +372,39 @@ def get_prr_for_user(purchase_request_response_factory):
 
 
 
+@pytest.fixture
+@pytest.mark.django_db
+def get_sa_with_reference_number(subscription_request_factory):
+    def factory(reference_number, status='Current'):
+        sr = subscription_request_factory(subscription_agreement__status=status)
+        # bypass the registry, so that duplicates (which predate it) can be set up
+        SubscriptionRequest.objects.filter(pk=sr.pk).update(reference_number=reference_number)
+        return sr.subscription_agreement
+    return factory
+
+
+@pytest.fixture
+def locmem_cache(settings):
+    # one process, so a per-process cache is fine
+    settings.CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+    settings.SUBSCRIPTION_STATUS_CACHE_TIMEOUT = 60
+    cache.clear()
+    yield cache
+    cache.clear()
+
+
+@pytest.fixture
+@pytest.mark.django_db
+def get_standing_sa_for_user(subscription_request_response_factory):
+    def factory(customer_pk, customer_type):
+        return subscription_request_response_factory(
+            related_request__subscription_agreement__customer_pk=customer_pk,
+            related_request__subscription_agreement__customer_type=customer_type,
+            related_request__subscription_agreement__status='Current'
+        ).subscription_agreement
+    return factory
+
+
 @pytest.fixture()
 @pytest.mark.django_db
 def non_admin():
@@ -505,6 +571,32 @@ def test_acknowledge_purchase(client, acknowledge_purchase, purchase_request_res
     assert prr.perma_acknowledged_at
 
 
+@pytest.mark.django_db
+def test_acknowledge_purchase_pk_as_string(client, acknowledge_purchase, purchase_request_response_factory, mocker):
+    mocker.patch('perma_payments.views.process_perma_transmission', autospec=True, return_value={'purchase_pk': str(SENTINEL['purchase_pk'])})
+    prr = purchase_request_response_factory(
+        id=SENTINEL['purchase_pk'],
+        inform_perma=True
+    )
+
+    # request
+    response = client.post(acknowledge_purchase['route'])
+
+    # assertions
+    assert response.status_code == 200
+    prr.refresh_from_db()
+    assert prr.perma_acknowledged_at
+
+
+@pytest.mark.django_db
+def test_acknowledge_purchase_invalid_pk(client, acknowledge_purchase, mocker):
+    mocker.patch('perma_payments.views.process_perma_transmission', autospec=True, return_value={'purchase_pk': 'not a pk'})
+    acknowledge = mocker.patch('perma_payments.views.PurchaseRequestResponse.acknowledge', autospec=True)
+    response = client.post(acknowledge_purchase['route'])
+    assert response.status_code == 400
+    assert not acknowledge.called
+
+
 @pytest.mark.django_db
 def test_acknowledge_unacknowledgeable_purchase(client, acknowledge_purchase, purchase_request_response_factory, mocker):
     mocker.patch('perma_payments.views.process_perma_transmission', autospec=True, return_value=acknowledge_purchase['valid_data'])
@@ -563,6 +655,67 @@ def test_acknowledge_purchase_other_methods(client, acknowledge_purchase):
     put_patch_delete_not_allowed(client, acknowledge_purchase['route'])
 
 
+# acknowledge-purchases
+
+@pytest.mark.django_db
+def test_acknowledge_purchases(client, acknowledge_purchases, purchase_request_response_factory, django_assert_num_queries, mocker):
+    process = mocker.patch('perma_payments.views.process_perma_transmission', autospec=True)
+    acknowledgeable = [purchase_request_response_factory(inform_perma=True) for _ in range(3)]
+    unacknowledgeable = purchase_request_response_factory(inform_perma=False)
+    acknowledged = purchase_request_response_factory(inform_perma=True, perma_acknowledged_at=GENESIS)
+    nonexistent = acknowledged.pk + 1
+    purchase_pks = [prr.pk for prr in acknowledgeable] + [unacknowledgeable.pk, acknowledged.pk, nonexistent]
+    process.return_value = {'purchase_pks': list(reversed(purchase_pks))}
+
+    # savepoint, one locking select, one update, release
+    with django_assert_num_queries(4):
+        response = client.post(acknowledge_purchases['route'])
+
+    assert response.status_code == 200
+    assert response.json() == {
+        'status': 'ok',
+        'purchases': {
+            **{str(prr.pk): 'acknowledged' for prr in acknowledgeable},
+            str(unacknowledgeable.pk): 'not acknowledgeable',
+            str(acknowledged.pk): 'already acknowledged',
+            str(nonexistent): 'not found',
+        }
+    }
+    for prr in acknowledgeable + [unacknowledgeable, acknowledged]:
+        prr.refresh_from_db()
+    assert all(prr.perma_acknowledged_at for prr in acknowledgeable)
+    assert not unacknowledgeable.perma_acknowledged_at
+    assert acknowledged.perma_acknowledged_at == GENESIS
+
+
+@pytest.mark.django_db
+def test_acknowledge_purchases_locks_in_pk_order(client, acknowledge_purchases, purchase_request_response_factory, mocker):
+    prrs = [purchase_request_response_factory(inform_perma=True) for _ in range(2)]
+    mocker.patch('perma_payments.views.process_perma_transmission', autospec=True, return_value={'purchase_pks': [prrs[1].pk, prrs[0].pk]})
+    with CaptureQueriesContext(connections['default']) as queries:
+        client.post(acknowledge_purchases['route'])
+    [locking] = [query['sql'] for query in queries if 'FOR UPDATE' in query['sql']]
+    assert 'ORDER BY' in locking
+
+
+@pytest.mark.parametrize('purchase_pks', [
+    'not a list',
+    ['not a pk'],
+    [[1]],
+    list(range(3)),
+])
+def test_acknowledge_purchases_invalid(client, settings, acknowledge_purchases, mocker, purchase_pks):
+    settings.MAX_PURCHASES_PER_REQUEST = 2
+    mocker.patch('perma_payments.views.process_perma_transmission', autospec=True, return_value={'purchase_pks': purchase_pks})
+    response = client.post(acknowledge_purchases['route'])
+    assert response.status_code == 400
+
+
+def test_acknowledge_purchases_other_methods(client, acknowledge_purchases):
+    get_not_allowed(client, acknowledge_purchases['route'])
+    put_patch_delete_not_allowed(client, acknowledge_purchases['route'])
+
+
 # subscribe
 
 def test_subscribe_post_invalid_perma_transmission(client, subscribe, mocker):
@@ -747,6 +900,16 @@ def test_subscribe_post_redirect_form_populated_correctly(client, subscribe, sub
         assert bytes('<input type="hidden" name="{0}" value="{0}">'.format(field), 'utf-8') in response.content
 
 
+@pytest.mark.django_db
+def test_subscribe_post_already_subscribed_query_count(client, subscribe, get_standing_sa_for_user, django_assert_num_queries, mocker):
+    mocker.patch('perma_payments.views.process_perma_transmission', autospec=True, return_value=subscribe['valid_data'])
+    get_standing_sa_for_user(SENTINEL['customer_pk'], SENTINEL['customer_type'])
+
+    with django_assert_num_queries(1):
+        response = client.post(subscribe['route'])
+    assert response.status_code == 200
+
+
 def test_subscribe_other_methods(client, subscribe):
     put_patch_delete_not_allowed(client, subscribe['route'])
 
@@ -792,7 +955,7 @@ def test_change_post_no_standing_subscription(client, change, mocker):
     assert response.status_code == 200
     expected_template_used(response, 'generic.html')
     assert b"can't find any active subscriptions" in response.content
-    sa.customer_standing_subscription.assert_called_once_with(change['valid_data']['customer_pk'], change['valid_data']['customer_type'])
+    sa.customer_standing_subscription.assert_called_once_with(change['valid_data']['customer_pk'], change['valid_data']['customer_type'], select_related=WITH_SUBSCRIPTION_REQUEST_RESPONSE)
     assert not cr_instance.save.called
 
 
@@ -941,6 +1104,19 @@ def test_change_post_redirect_form_populated_correctly(client, change, change_re
         assert bytes('<input type="hidden" name="{0}" value="{0}">'.format(field), 'utf-8') in response.content
 
 
+@pytest.mark.django_db
+def test_change_post_query_count(client, change, get_standing_sa_for_user, django_assert_num_queries, mocker):
+    mocker.patch('perma_payments.views.process_perma_transmission', autospec=True, return_value=change['valid_data'])
+    get_standing_sa_for_user(SENTINEL['customer_pk'], SENTINEL['customer_type'])
+
+    # the subscription, its request and response, in one query;
+    # validating the change request (2 queries) and saving it (2)
+    with django_assert_num_queries(5) as queries:
+        response = client.post(change['route'])
+    assert response.status_code == 200
+    assert 'perma_payments_subscriptionrequestresponse' in queries.captured_queries[0]['sql']
+
+
 def test_change_other_methods(client, change):
     get_not_allowed(client, change['route'])
     put_patch_delete_not_allowed(client, change['route'])
@@ -980,7 +1156,7 @@ def test_update_post_no_standing_subscription(client, update, mocker):
     assert response.status_code == 200
     expected_template_used(response, 'generic.html')
     assert b"can't find any active subscriptions" in response.content
-    sa.customer_standing_subscription.assert_called_once_with(update['valid_data']['customer_pk'], update['valid_data']['customer_type'])
+    sa.customer_standing_subscription.assert_called_once_with(update['valid_data']['customer_pk'], update['valid_data']['customer_type'], select_related=WITH_SUBSCRIPTION_REQUEST_RESPONSE)
     assert not ur_instance.save.called
 
 
@@ -1122,6 +1298,19 @@ def test_update_post_redirect_form_populated_correctly(client, update, update_re
         assert bytes('<input type="hidden" name="{0}" value="{0}">'.format(field), 'utf-8') in response.content
 
 
+@pytest.mark.django_db
+def test_update_post_query_count(client, update, get_standing_sa_for_user, django_assert_num_queries, mocker):
+    mocker.patch('perma_payments.views.process_perma_transmission', autospec=True, return_value=update['valid_data'])
+    get_standing_sa_for_user(SENTINEL['customer_pk'], SENTINEL['customer_type'])
+
+    # the subscription, its request and response, in one query;
+    # validating the update request (2 queries) and saving it (2)
+    with django_assert_num_queries(5) as queries:
+        response = client.post(update['route'])
+    assert response.status_code == 200
+    assert 'perma_payments_subscriptionrequestresponse' in queries.captured_queries[0]['sql']
+
+
 def test_update_other_methods(client, update):
     get_not_allowed(client, update['route'])
     put_patch_delete_not_allowed(client, update['route'])
@@ -1147,7 +1336,7 @@ def test_cybersource_callback_post_invalid_transmission(client, cybersource_call
 def test_cybersource_callback_post_update_request(client, cybersource_callback, update_request, mocker):
     mocker.patch('perma_payments.views.process_cybersource_transmission', autospec=True, return_value=cybersource_callback['valid_data'])
     get_request = mocker.patch(
-        'perma_payments.views.OutgoingTransaction.objects.get',
+        'perma_payments.views.OutgoingTransaction.get_by_transaction_uuid',
         autospec=True,
         return_value = update_request
     )
@@ -1157,7 +1346,7 @@ def test_cybersource_callback_post_update_request(client, cybersource_callback,
     response = client.post(cybersource_callback['route'], cybersource_callback['valid_data'])
 
     # assertions
-    get_request.assert_called_once_with(transaction_uuid=cybersource_callback['valid_data']['req_transaction_uuid'])
+    get_request.assert_called_once_with(cybersource_callback['valid_data']['req_transaction_uuid'], for_update=True)
     r.save_new_with_encrypted_full_response.assert_called_once_with(
         UpdateRequestResponse,
         dict_to_querydict(cybersource_callback['valid_data']),
@@ -1177,7 +1366,7 @@ def test_cybersource_callback_post_update_request(client, cybersource_callback,
 def test_cybersource_callback_post_change_request(client, cybersource_callback, change_request, mocker):
     mocker.patch('perma_payments.views.process_cybersource_transmission', autospec=True, return_value=cybersource_callback['valid_data'])
     get_request = mocker.patch(
-        'perma_payments.views.OutgoingTransaction.objects.get',
+        'perma_payments.views.OutgoingTransaction.get_by_transaction_uuid',
         autospec=True,
         return_value = change_request
     )
@@ -1188,7 +1377,7 @@ def test_cybersource_callback_post_change_request(client, cybersource_callback,
     response = client.post(cybersource_callback['route'], cybersource_callback['valid_data'])
 
     # assertions
-    get_request.assert_called_once_with(transaction_uuid=cybersource_callback['valid_data']['req_transaction_uuid'])
+    get_request.assert_called_once_with(cybersource_callback['valid_data']['req_transaction_uuid'], for_update=True)
     r.save_new_with_encrypted_full_response.assert_called_once_with(
         ChangeRequestResponse,
         dict_to_querydict(cybersource_callback['valid_data']),
@@ -1213,7 +1402,7 @@ def test_cybersource_callback_post_change_request(client, cybersource_callback,
 def test_cybersource_callback_post_subscription_request(client, cybersource_callback, pending_sa, mocker):
     mocker.patch('perma_payments.views.process_cybersource_transmission', autospec=True, return_value=cybersource_callback['valid_data'])
     get_request = mocker.patch(
-        'perma_payments.views.OutgoingTransaction.objects.get',
+        'perma_payments.views.OutgoingTransaction.get_by_transaction_uuid',
         autospec=True,
         return_value = pending_sa.subscription_request
     )
@@ -1224,7 +1413,7 @@ def test_cybersource_callback_post_subscription_request(client, cybersource_call
     response = client.post(cybersource_callback['route'], cybersource_callback['valid_data'])
 
     # assertions
-    get_request.assert_called_once_with(transaction_uuid=cybersource_callback['valid_data']['req_transaction_uuid'])
+    get_request.assert_called_once_with(cybersource_callback['valid_data']['req_transaction_uuid'], for_update=True)
     r.save_new_with_encrypted_full_response.assert_called_once_with(
         SubscriptionRequestResponse,
         dict_to_querydict(cybersource_callback['valid_data']),
@@ -1249,7 +1438,8 @@ def test_cybersource_callback_post_subscription_request(client, cybersource_call
 @pytest.mark.django_db
 def test_cybersource_callback_payment_token_invalid(client, cybersource_callback, mocker):
     mocker.patch('perma_payments.views.process_cybersource_transmission', autospec=True, return_value=cybersource_callback['data_w_invalid_payment_token'])
-    mocker.patch('perma_payments.views.OutgoingTransaction', autospec=True)
+    ot = mocker.patch('perma_payments.views.OutgoingTransaction', autospec=True)
+    ot.get_by_transaction_uuid.return_value.response_recorded.return_value = False
     mocker.patch('perma_payments.views.isinstance', side_effect=[False, False, True])  # force isinstance to return True third, for SubscriptionRequest
     mocker.patch('perma_payments.views.Response', autospec=True)
     log = mocker.patch('perma_payments.views.logger.error', autospec=True)
@@ -1264,10 +1454,12 @@ def test_cybersource_callback_post_purchase_request(client, cybersource_callback
     mocker.patch('perma_payments.views.process_cybersource_transmission', autospec=True, return_value=cybersource_callback['valid_data'])
     purchase_request = purchase_request_response.related_request
     get_request = mocker.patch(
-        'perma_payments.views.OutgoingTransaction.objects.get',
+        'perma_payments.views.OutgoingTransaction.get_by_transaction_uuid',
         autospec=True,
         return_value = purchase_request
     )
+    # the response is a stand-in for the one we're about to save
+    mocker.patch.object(purchase_request, 'response_recorded', return_value=False)
     r = mocker.patch('perma_payments.views.Response', autospec=True)
     r.save_new_with_encrypted_full_response.return_value = purchase_request_response
     purchase_request_response.act_on_cs_decision = Mock()
@@ -1276,7 +1468,7 @@ def test_cybersource_callback_post_purchase_request(client, cybersource_callback
     response = client.post(cybersource_callback['route'], cybersource_callback['valid_data'])
 
     # assertions
-    get_request.assert_called_once_with(transaction_uuid=cybersource_callback['valid_data']['req_transaction_uuid'])
+    get_request.assert_called_once_with(cybersource_callback['valid_data']['req_transaction_uuid'], for_update=True)
     r.save_new_with_encrypted_full_response.assert_called_once_with(
         PurchaseRequestResponse,
         dict_to_querydict(cybersource_callback['valid_data']),
@@ -1298,12 +1490,86 @@ def test_cybersource_callback_post_purchase_request(client, cybersource_callback
 @pytest.mark.django_db
 def test_cybersource_callback_post_type_not_handled(client, cybersource_callback, mocker):
     mocker.patch('perma_payments.views.process_cybersource_transmission', autospec=True, return_value=cybersource_callback['valid_data'])
-    mocker.patch('perma_payments.views.OutgoingTransaction', autospec=True)
+    ot = mocker.patch('perma_payments.views.OutgoingTransaction', autospec=True)
+    ot.get_by_transaction_uuid.return_value.response_recorded.return_value = False
     mocker.patch('perma_payments.views.isinstance', return_value=False)
     with pytest.raises(NotImplementedError):
         client.post(cybersource_callback['route'])
 
 
+@pytest.fixture
+def signed_callback():
+    def sign(outgoing, decision='ACCEPT'):
+        return encode_from_cybersource({
+            'req_transaction_uuid': outgoing.transaction_uuid,
+            'decision': decision,
+            'reason_code': '100',
+            'message': 'Request was processed successfully.',
+            'payment_token': SENTINEL['payment_token'],
+        })
+    return sign
+
+
+@pytest.mark.django_db
+def test_cybersource_callback_duplicate_ignored(client, cybersource_callback, purchase_request, signed_callback, mocker):
+    act = mocker.spy(PurchaseRequestResponse, 'act_on_cs_decision')
+    first = client.post(cybersource_callback['route'], signed_callback(purchase_request))
+    duplicate = client.post(cybersource_callback['route'], signed_callback(purchase_request, decision='DECLINE'))
+    assert first.status_code == duplicate.status_code == 200
+    assert b'OK' in duplicate.content
+    assert PurchaseRequestResponse.objects.get(related_request=purchase_request).decision == 'ACCEPT'
+    assert act.call_count == 1
+
+
+@pytest.mark.django_db
+def test_cybersource_callback_locks_related_request(client, cybersource_callback, change_request, signed_callback, django_assert_num_queries):
+    with django_assert_num_queries(9) as queries:
+        client.post(cybersource_callback['route'], signed_callback(change_request))
+    lock = next(query['sql'] for query in queries.captured_queries if 'FOR UPDATE' in query['sql'])
+    assert 'FROM "perma_payments_changerequest"' in lock
+    assert lock.endswith('FOR UPDATE OF "perma_payments_changerequest"')
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.parametrize('kind', ['purchase', 'subscription'])
+def test_cybersource_callback_concurrent_duplicates(kind, cybersource_callback, purchase_request_factory, subscription_request_factory, signed_callback, mocker):
+    if kind == 'purchase':
+        outgoing = purchase_request_factory()
+        responses = PurchaseRequestResponse.objects.filter(related_request=outgoing)
+        act = mocker.spy(PurchaseRequestResponse, 'act_on_cs_decision')
+    else:
+        outgoing = subscription_request_factory()
+        responses = SubscriptionRequestResponse.objects.filter(related_request=outgoing)
+        act = mocker.spy(SubscriptionAgreement, 'update_after_cs_decision')
+    data = signed_callback(outgoing)
+
+    # widen the window for a race: whoever gets in first dawdles over saving the response
+    encrypt = mocker.patch('perma_payments.models.encrypt_for_storage', autospec=True, return_value=b'encrypted')
+    encrypt.side_effect = lambda *args, **kwargs: time.sleep(0.2) or b'encrypted'
+
+    deliveries = 4
+    barrier = threading.Barrier(deliveries)
+    status_codes = []
+
+    def deliver():
+        try:
+            barrier.wait()
+            status_codes.append(Client().post(cybersource_callback['route'], data).status_code)
+        finally:
+            connections.close_all()
+
+    threads = [threading.Thread(target=deliver) for _ in range(deliveries)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert status_codes == [200] * deliveries
+    assert responses.count() == 1
+    assert act.call_count == 1
+    assert encrypt.call_count == 1
+
+
 def test_cybersource_callback_other_methods(client, cybersource_callback):
     get_not_allowed(client, cybersource_callback['route'])
     put_patch_delete_not_allowed(client, cybersource_callback['route'])
@@ -1341,7 +1607,7 @@ def test_subscription_post_no_standing_subscription(client, subscription, mocker
 
     assert response.status_code == 200
     assert d.utcnow.return_value.timestamp.call_count == 1
-    sa.assert_called_once_with(subscription['valid_data']['customer_pk'], subscription['valid_data']['customer_type'])
+    sa.assert_called_once_with(subscription['valid_data']['customer_pk'], subscription['valid_data']['customer_type'], select_related=WITH_SUBSCRIPTION_REQUEST)
     prepped.assert_called_once_with({
         'customer_pk': subscription['valid_data']['customer_pk'],
         'customer_type': subscription['valid_data']['customer_type'],
@@ -1370,7 +1636,7 @@ def test_subscription_post_standard_standing_subscription(client, subscription,
     response = client.post(subscription['route'])
 
     assert response.status_code == 200
-    sa.assert_called_once_with(subscription['valid_data']['customer_pk'], subscription['valid_data']['customer_type'])
+    sa.assert_called_once_with(subscription['valid_data']['customer_pk'], subscription['valid_data']['customer_type'], select_related=WITH_SUBSCRIPTION_REQUEST)
     prepped.assert_called_once_with({
         'customer_pk': subscription['valid_data']['customer_pk'],
         'customer_type': subscription['valid_data']['customer_type'],
@@ -1464,11 +1730,227 @@ def test_subscription_multiple_purchases_to_acknowledge(client, subscription, ge
     }]
 
 
+@pytest.mark.django_db
+def test_subscription_cached(client, subscription, locmem_cache, get_standing_sa_for_user, get_prr_for_user, django_assert_num_queries, mocker):
+    mocker.patch('perma_payments.views.process_perma_transmission', autospec=True, return_value=subscription['valid_data'])
+    prepped = mocker.patch('perma_payments.views.prep_for_perma', autospec=True, return_value=SENTINEL['bytes'])
+    get_standing_sa_for_user(SENTINEL['customer_pk'], SENTINEL['customer_type'])
+    get_prr_for_user(SENTINEL['customer_pk'], SENTINEL['customer_type'])
+
+    client.post(subscription['route'])
+    with django_assert_num_queries(0):
+        response = client.post(subscription['route'])
+
+    assert response.status_code == 200
+    first, second = [call[1][0] for call in prepped.mock_calls]
+    assert first['subscription']['status'] == 'Current'
+    assert len(first['purchases']) == 1
+    assert {k: v for k, v in second.items() if k != 'timestamp'} == {k: v for k, v in first.items() if k != 'timestamp'}
+
+
+@pytest.mark.django_db
+def test_subscription_cache_expires(client, subscription, locmem_cache, settings, mocker):
+    mocker.patch('perma_payments.views.process_perma_transmission', autospec=True, return_value=subscription['valid_data'])
+    mocker.patch('perma_payments.views.prep_for_perma', autospec=True, return_value=SENTINEL['bytes'])
+    settings.SUBSCRIPTION_STATUS_CACHE_TIMEOUT = 0
+    status = mocker.patch('perma_payments.views.customer_subscription_status', autospec=True, return_value={'subscription': None, 'purchases': []})
+    client.post(subscription['route'])
+    client.post(subscription['route'])
+    assert status.call_count == 2
+
+
+@pytest.mark.parametrize('backend, timeout, expected', [
+    ('django.core.cache.backends.locmem.LocMemCache', None, 0),
+    ('django.core.cache.backends.db.DatabaseCache', None, 60),
+    ('django.core.cache.backends.db.DatabaseCache', 5, 5),
+    ('django.core.cache.backends.locmem.LocMemCache', 0, 0),
+])
+def test_subscription_cache_timeout_defaults_by_backend(backend, timeout, expected):
+    settings = {'SECRET_KEY': 'secret', 'DATABASES': {'default': {}}, 'CACHES': {'default': {'BACKEND': backend}}, 'SUBSCRIPTION_STATUS_CACHE_TIMEOUT': timeout}
+    post_process_settings(settings)
+    assert settings['SUBSCRIPTION_STATUS_CACHE_TIMEOUT'] == expected
+
+
+def test_subscription_cache_timeout_requires_shared_cache():
+    settings = {'SECRET_KEY': 'secret', 'DATABASES': {'default': {}}, 'CACHES': {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}, 'SUBSCRIPTION_STATUS_CACHE_TIMEOUT': 60}
+    with pytest.raises(AssertionError, match='shared default cache'):
+        post_process_settings(settings)
+
+
+@pytest.mark.django_db
+def test_subscription_cache_cleared_by_acknowledge_purchase(client, subscription, acknowledge_purchase, locmem_cache, purchase_request_response_factory, django_capture_on_commit_callbacks, mocker):
+    process = mocker.patch('perma_payments.views.process_perma_transmission', autospec=True, return_value=subscription['valid_data'])
+    prepped = mocker.patch('perma_payments.views.prep_for_perma', autospec=True, return_value=SENTINEL['bytes'])
+    purchase_request_response_factory(
+        id=SENTINEL['purchase_pk'],
+        related_request__customer_pk=SENTINEL['customer_pk'],
+        related_request__customer_type=SENTINEL['customer_type'],
+        inform_perma=True
+    )
+    client.post(subscription['route'])
+
+    process.return_value = acknowledge_purchase['valid_data']
+    with django_capture_on_commit_callbacks(execute=True):
+        assert client.post(acknowledge_purchase['route']).status_code == 200
+
+    process.return_value = subscription['valid_data']
+    client.post(subscription['route'])
+    assert [len(call[1][0]['purchases']) for call in prepped.mock_calls] == [1, 0]
+
+
+@pytest.mark.django_db
+def test_subscription_cache_cleared_by_cancel_request(client, subscription, cancel_request, locmem_cache, get_standing_sa_for_user, django_capture_on_commit_callbacks, mocker):
+    mocker.patch('perma_payments.views.process_perma_transmission', autospec=True, return_value=subscription['valid_data'])
+    mocker.patch('perma_payments.views.send_self_email', autospec=True)
+    prepped = mocker.patch('perma_payments.views.prep_for_perma', autospec=True, return_value=SENTINEL['bytes'])
+    get_standing_sa_for_user(SENTINEL['customer_pk'], SENTINEL['customer_type'])
+
+    client.post(subscription['route'])
+    with django_capture_on_commit_callbacks(execute=True):
+        client.post(cancel_request['route'])
+    client.post(subscription['route'])
+    assert [call[1][0]['subscription']['status'] for call in prepped.mock_calls] == ['Current', 'Cancellation Requested']
+
+
+@pytest.mark.django_db
+def test_subscription_cache_cleared_by_update_statuses(client, admin_client, subscription, update_statuses, locmem_cache, get_standing_sa_for_user, django_capture_on_commit_callbacks, mocker):
+    mocker.patch('perma_payments.views.process_perma_transmission', autospec=True, return_value=subscription['valid_data'])
+    mocker.patch('perma_payments.status_reports.skip_lines', autospec=True)
+    prepped = mocker.patch('perma_payments.views.prep_for_perma', autospec=True, return_value=SENTINEL['bytes'])
+    sa = get_standing_sa_for_user(SENTINEL['customer_pk'], SENTINEL['customer_type'])
+    sa.subscription_request.reference_number = 'ref1'
+    sa.subscription_request.save()
+
+    client.post(subscription['route'])
+    with django_capture_on_commit_callbacks(execute=True):
+        admin_client.post(update_statuses['route'], update_statuses['valid_data'])
+    client.post(subscription['route'])
+    assert [call[1][0]['subscription'] for call in prepped.mock_calls][1] is None  # superseded subscriptions aren't standing
+
+
+@pytest.mark.django_db
+def test_subscription_post_query_count(client, subscription, get_standing_sa_for_user, django_assert_num_queries, mocker):
+    mocker.patch('perma_payments.views.process_perma_transmission', autospec=True, return_value=subscription['valid_data'])
+    get_standing_sa_for_user(SENTINEL['customer_pk'], SENTINEL['customer_type'])
+
+    # the subscription and its request, in one query; unacknowledged purchases
+    with django_assert_num_queries(2) as queries:
+        response = client.post(subscription['route'])
+    assert response.status_code == 200
+    assert 'perma_payments_subscriptionrequest' in queries.captured_queries[0]['sql']
+
+
 def test_subscription_other_methods(client, subscription):
     get_not_allowed(client, subscription['route'])
     put_patch_delete_not_allowed(client, subscription['route'])
 
 
+# subscriptions
+
+def test_subscriptions_post_invalid_transmission(client, subscriptions, mocker):
+    process = mocker.patch('perma_payments.views.process_perma_transmission', autospec=True, side_effect=InvalidTransmissionException)
+
+    # request
+    response = client.post(subscriptions['route'], subscriptions['valid_data'])
+
+    # assertions
+    assert response.status_code == 400
+    assert process.call_args[0][1] == FIELDS_REQUIRED_FROM_PERMA['subscriptions']
+
+
+@pytest.mark.parametrize('customers', [
+    'Registrar 1',
+    [[1, 'Registrar', 'extra']],
+    [['one', 'Registrar']],
+    [None],
+])
+def test_subscriptions_post_invalid_customers(client, subscriptions, customers, mocker):
+    mocker.patch('perma_payments.views.process_perma_transmission', autospec=True, return_value={'customers': customers})
+    response = client.post(subscriptions['route'])
+    assert response.status_code == 400
+
+
+def test_subscriptions_post_too_many_customers(client, subscriptions, settings, mocker):
+    settings.MAX_CUSTOMERS_PER_REQUEST = 2
+    mocker.patch('perma_payments.views.process_perma_transmission', autospec=True, return_value={'customers': [[1, 'Registrar'], [2, 'Registrar'], [3, 'Registrar']]})
+    response = client.post(subscriptions['route'])
+    assert response.status_code == 400
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('count', [3, 30])
+def test_subscriptions_post_matches_subscription(client, subscriptions, count, get_standing_sa_for_user, get_prr_for_user, django_assert_num_queries, mocker):
+    customers = [[pk, customer_type] for pk in range(1, count // 2 + 2) for customer_type in ['Registrar', 'Individual']][:count]
+    for i, (pk, customer_type) in enumerate(customers):
+        if i % 3:
+            sa = get_standing_sa_for_user(pk, customer_type)
+            if i % 3 == 2:
+                sa.cancellation_requested = True
+                sa.save()
+        if i % 2:
+            get_prr_for_user(pk, customer_type)
+    process = mocker.patch('perma_payments.views.process_perma_transmission', autospec=True, return_value={'customers': customers})
+    d = mocker.patch('perma_payments.views.datetime', autospec=True)
+    d.utcnow.return_value.timestamp.return_value = mocker.sentinel.timestamp
+    prepped = mocker.patch('perma_payments.views.prep_for_perma', autospec=True, return_value=SENTINEL['bytes'])
+
+    # request
+    with django_assert_num_queries(2):
+        response = client.post(subscriptions['route'])
+
+    # assertions
+    assert response.status_code == 200
+    assert response.json() == {'encrypted_data': SENTINEL['bytes'].decode('utf-8')}
+    sent = prepped.call_args[0][0]
+    assert sent['timestamp'] == mocker.sentinel.timestamp
+    assert len(sent['subscriptions']) == count
+    for (pk, customer_type), status in zip(customers, sent['subscriptions']):
+        process.return_value = {'customer_pk': pk, 'customer_type': customer_type}
+        client.post('/subscription/')
+        single = prepped.call_args[0][0]
+        del single['timestamp']
+        assert status == single
+    assert [status['subscription'] is not None for status in sent['subscriptions']] == [bool(i % 3) for i in range(count)]
+
+
+@pytest.mark.django_db
+def test_subscriptions_post_uses_and_fills_cache(client, subscriptions, locmem_cache, get_standing_sa_for_user, django_assert_num_queries, mocker):
+    get_standing_sa_for_user(1, 'Registrar')
+    prepped = mocker.patch('perma_payments.views.prep_for_perma', autospec=True, return_value=SENTINEL['bytes'])
+    process = mocker.patch('perma_payments.views.process_perma_transmission', autospec=True, return_value={'customer_pk': 1, 'customer_type': 'Registrar'})
+    client.post('/subscription/')
+
+    process.return_value = {'customers': [[1, 'Registrar'], [2, 'Registrar']]}
+    with django_assert_num_queries(2):
+        client.post(subscriptions['route'])
+    with django_assert_num_queries(0):
+        client.post(subscriptions['route'])
+    assert [status['subscription']['status'] if status['subscription'] else None for status in prepped.call_args[0][0]['subscriptions']] == ['Current', None]
+
+
+@pytest.mark.django_db
+def test_subscriptions_post_reports_multiple_standing_per_customer(client, subscriptions, locmem_cache, get_standing_sa_for_user, settings, mocker):
+    settings.RAISE_IF_MULTIPLE_SUBSCRIPTIONS_FOUND = True
+    get_standing_sa_for_user(1, 'Registrar')
+    get_standing_sa_for_user(1, 'Registrar')
+    get_standing_sa_for_user(2, 'Registrar')
+    error = mocker.patch('perma_payments.models.logger.error', autospec=True)
+    prepped = mocker.patch('perma_payments.views.prep_for_perma', autospec=True, return_value=SENTINEL['bytes'])
+    mocker.patch('perma_payments.views.process_perma_transmission', autospec=True, return_value={'customers': [[1, 'Registrar'], [2, 'Registrar']]})
+    response = client.post(subscriptions['route'])
+    assert response.status_code == 200
+    sent = prepped.call_args[0][0]['subscriptions']
+    assert sent[0] == {'customer_pk': 1, 'customer_type': 'Registrar', 'error': 'Multiple standing subscriptions found.'}
+    assert sent[1]['subscription']['status'] == 'Current'
+    assert 'Registrar 1' in error.call_args[0][0]
+    assert cache.get(subscription_status_cache_keys([(1, 'Registrar')])[(1, 'Registrar')]) is None
+
+
+def test_subscriptions_other_methods(client, subscriptions):
+    get_not_allowed(client, subscriptions['route'])
+    put_patch_delete_not_allowed(client, subscriptions['route'])
+
+
 # purchase history
 
 @pytest.mark.django_db
@@ -1516,6 +1998,83 @@ def test_multiple_purchases_in_history(client, purchase_history, get_prr_for_use
     }]
 
 
+@pytest.mark.django_db
+def test_purchase_history_in_pages(client, purchase_history, get_prr_for_user, mocker):
+    process = mocker.patch('perma_payments.views.process_perma_transmission', autospec=True)
+    prepped = mocker.patch('perma_payments.views.prep_for_perma', autospec=True, return_value=SENTINEL['bytes'])
+    prrs = [get_prr_for_user(SENTINEL['customer_pk'], SENTINEL['customer_type']) for _ in range(3)]
+    # same date: ordered by id
+    PurchaseRequest.objects.filter(pk__in=[prr.related_request.pk for prr in prrs[1:]]).update(request_datetime=prrs[1].related_request.request_datetime)
+
+    def page(**fields):
+        process.return_value = {**purchase_history['valid_data'], **fields}
+        response = client.post(purchase_history['route'])
+        assert response.status_code == 200
+        sent = prepped.call_args[0][0]
+        return [purchase['id'] for purchase in sent['purchase_history']], sent['cursor'], sent['has_more']
+
+    ids, cursor, has_more = page(limit=2)
+    assert (ids, has_more) == ([prrs[0].id, prrs[1].id], True)
+    ids, cursor, has_more = page(limit=2, after=cursor)
+    assert (ids, has_more) == ([prrs[2].id], False)
+    # nothing new: the cursor stays put, ready for next time
+    assert page(after=cursor) == ([], cursor, False)
+    new = get_prr_for_user(SENTINEL['customer_pk'], SENTINEL['customer_type'])
+    assert page(after=cursor)[0] == [new.id]
+
+
+@pytest.mark.django_db
+def test_purchase_history_since(client, purchase_history, get_prr_for_user, mocker):
+    old = get_prr_for_user(SENTINEL['customer_pk'], SENTINEL['customer_type'])
+    PurchaseRequest.objects.filter(pk=old.related_request.pk).update(request_datetime=make_aware(datetime.now() - timedelta(days=2)))
+    recent = get_prr_for_user(SENTINEL['customer_pk'], SENTINEL['customer_type'])
+    mocker.patch('perma_payments.views.process_perma_transmission', autospec=True, return_value={
+        **purchase_history['valid_data'],
+        'since': (datetime.now() - timedelta(days=1)).timestamp()
+    })
+    prepped = mocker.patch('perma_payments.views.prep_for_perma', autospec=True, return_value=SENTINEL['bytes'])
+    client.post(purchase_history['route'])
+    assert [purchase['id'] for purchase in prepped.call_args[0][0]['purchase_history']] == [recent.id]
+
+
+@pytest.mark.django_db
+def test_purchase_history_page_size_capped(client, settings, purchase_history, get_prr_for_user, mocker):
+    settings.PURCHASE_HISTORY_PAGE_SIZE = 2
+    for _ in range(3):
+        get_prr_for_user(SENTINEL['customer_pk'], SENTINEL['customer_type'])
+    mocker.patch('perma_payments.views.process_perma_transmission', autospec=True, return_value={**purchase_history['valid_data'], 'limit': 100})
+    prepped = mocker.patch('perma_payments.views.prep_for_perma', autospec=True, return_value=SENTINEL['bytes'])
+    client.post(purchase_history['route'])
+    assert len(prepped.call_args[0][0]['purchase_history']) == 2
+    assert prepped.call_args[0][0]['has_more']
+
+
+@pytest.mark.django_db
+def test_unpaged_purchase_history_is_whole(client, settings, purchase_history, get_prr_for_user, mocker):
+    settings.PURCHASE_HISTORY_PAGE_SIZE = 2
+    prrs = [get_prr_for_user(SENTINEL['customer_pk'], SENTINEL['customer_type']) for _ in range(3)]
+    mocker.patch('perma_payments.views.process_perma_transmission', autospec=True, return_value=purchase_history['valid_data'])
+    prepped = mocker.patch('perma_payments.views.prep_for_perma', autospec=True, return_value=SENTINEL['bytes'])
+    client.post(purchase_history['route'])
+    sent = prepped.call_args[0][0]
+    assert [purchase['id'] for purchase in sent['purchase_history']] == [prr.id for prr in prrs]
+    assert sent['cursor'].endswith('_{}'.format(prrs[-1].id))
+    assert not sent['has_more']
+
+
+@pytest.mark.parametrize('fields', [
+    {'after': 'not a cursor'},
+    {'after': 42},
+    {'since': 'yesterday'},
+    {'limit': 0},
+    {'limit': 'many'},
+])
+def test_purchase_history_invalid_page(client, purchase_history, mocker, fields):
+    mocker.patch('perma_payments.views.process_perma_transmission', autospec=True, return_value={**purchase_history['valid_data'], **fields})
+    response = client.post(purchase_history['route'])
+    assert response.status_code == 400
+
+
 def test_purchase_history_other_methods(client, purchase_history):
     get_not_allowed(client, purchase_history['route'])
     put_patch_delete_not_allowed(client, purchase_history['route'])
@@ -1601,6 +2160,51 @@ def test_cancel_request_post_subscription_status_actually_updated(client, cancel
     assert complete_standing_sa.cancellation_requested
 
 
+@pytest.mark.django_db
+def test_cancel_request_post_only_queues_email(client, cancel_request, get_standing_sa_for_user, mailoutbox, django_capture_on_commit_callbacks, mocker):
+    mocker.patch('perma_payments.views.process_perma_transmission', autospec=True, return_value=cancel_request['valid_data'])
+    get_standing_sa_for_user(SENTINEL['customer_pk'], SENTINEL['customer_type'])
+
+    with django_capture_on_commit_callbacks() as callbacks:
+        response = client.post(cancel_request['route'])
+    assert response.status_code == 302
+    assert OutgoingEmail.objects.get().status == 'Queued'
+    assert len(mailoutbox) == 0
+
+    # the email goes out once the request's transaction commits
+    for callback in callbacks:
+        callback()
+    assert OutgoingEmail.objects.get().status == 'Sent'
+    assert len(mailoutbox) == 1
+
+
+@pytest.mark.django_db
+def test_cancel_request_post_queues_email_only_if_recorded(client, cancel_request, get_standing_sa_for_user, django_capture_on_commit_callbacks, mocker):
+    mocker.patch('perma_payments.views.process_perma_transmission', autospec=True, return_value=cancel_request['valid_data'])
+    get_standing_sa_for_user(SENTINEL['customer_pk'], SENTINEL['customer_type'])
+    mocker.patch.object(SubscriptionAgreement, 'save', autospec=True, side_effect=DatabaseError)
+
+    with django_capture_on_commit_callbacks(execute=True) as callbacks:
+        with pytest.raises(DatabaseError):
+            client.post(cancel_request['route'])
+    assert not OutgoingEmail.objects.exists()
+    # nor is anything forgotten or refreshed
+    assert callbacks == []
+
+
+@pytest.mark.django_db
+def test_cancel_request_post_query_count(client, cancel_request, get_standing_sa_for_user, django_assert_num_queries, mocker):
+    mocker.patch('perma_payments.views.process_perma_transmission', autospec=True, return_value=cancel_request['valid_data'])
+    mocker.patch('perma_payments.views.send_self_email', autospec=True)
+    get_standing_sa_for_user(SENTINEL['customer_pk'], SENTINEL['customer_type'])
+
+    # the subscription and its request, in one query; a savepoint; saving it, with history; release
+    with django_assert_num_queries(5) as queries:
+        response = client.post(cancel_request['route'])
+    assert response.status_code == 302
+    assert 'perma_payments_subscriptionrequest' in queries.captured_queries[0]['sql']
+
+
 def test_cancel_request_other_methods(client, cancel_request):
     get_not_allowed(client, cancel_request['route'])
     put_patch_delete_not_allowed(client, cancel_request['route'])
@@ -1624,10 +2228,8 @@ def test_update_statuses_post_staff_required(client, non_admin, update_statuses)
 
 @pytest.mark.django_db
 def test_update_statuses_post_alerts_if_not_found_with_setting(admin_client, update_statuses, settings, mocker):
-    mocker.patch('perma_payments.views.skip_lines', autospec=True)
-    sa = mocker.patch('perma_payments.views.SubscriptionAgreement', autospec=True)
-    sa.objects.filter.return_value.get.side_effect = ObjectDoesNotExist
-    log = mocker.patch('perma_payments.views.logger.log', autospec=True)
+    mocker.patch('perma_payments.status_reports.skip_lines', autospec=True)
+    log = mocker.patch('perma_payments.models.logger.log', autospec=True)
     settings.RAISE_IF_SUBSCRIPTION_NOT_FOUND = True
     admin_client.post(update_statuses['route'], update_statuses["valid_data"])
     assert log.call_count == 2
@@ -1637,10 +2239,8 @@ def test_update_statuses_post_alerts_if_not_found_with_setting(admin_client, upd
 
 @pytest.mark.django_db
 def test_update_statuses_post_doesnt_alert_if_not_found_without_setting(admin_client, update_statuses, settings, mocker):
-    mocker.patch('perma_payments.views.skip_lines', autospec=True)
-    sa = mocker.patch('perma_payments.views.SubscriptionAgreement', autospec=True)
-    sa.objects.filter.return_value.get.side_effect = ObjectDoesNotExist
-    log = mocker.patch('perma_payments.views.logger.log', autospec=True)
+    mocker.patch('perma_payments.status_reports.skip_lines', autospec=True)
+    log = mocker.patch('perma_payments.models.logger.log', autospec=True)
     settings.RAISE_IF_SUBSCRIPTION_NOT_FOUND = False
     admin_client.post(update_statuses['route'], update_statuses["valid_data"])
     assert log.call_count == 2
@@ -1649,12 +2249,12 @@ def test_update_statuses_post_doesnt_alert_if_not_found_without_setting(admin_cl
 
 
 @pytest.mark.django_db
-def test_update_statuses_post_alerts_if_multiple_found_with_setting(admin_client, update_statuses, settings, mocker):
+def test_update_statuses_post_alerts_if_multiple_found_with_setting(admin_client, update_statuses, get_sa_with_reference_number, settings, mocker):
     # mocks
-    mocker.patch('perma_payments.views.skip_lines', autospec=True)
-    sa = mocker.patch('perma_payments.views.SubscriptionAgreement', autospec=True)
-    sa.objects.filter.return_value.get.side_effect = MultipleObjectsReturned
-    log = mocker.patch('perma_payments.views.logger.log', autospec=True)
+    mocker.patch('perma_payments.status_reports.skip_lines', autospec=True)
+    for reference_number in ['ref1', 'ref1', 'ref2', 'ref2']:
+        get_sa_with_reference_number(reference_number)
+    log = mocker.patch('perma_payments.models.logger.log', autospec=True)
     settings.RAISE_IF_MULTIPLE_SUBSCRIPTIONS_FOUND = True
     admin_client.post(update_statuses['route'], update_statuses["valid_data"])
     assert log.call_count == 2
@@ -1663,12 +2263,12 @@ def test_update_statuses_post_alerts_if_multiple_found_with_setting(admin_client
 
 
 @pytest.mark.django_db
-def test_update_statuses_post_doesnt_alert_if_multiple_found_without_setting(admin_client, update_statuses, settings, mocker):
+def test_update_statuses_post_doesnt_alert_if_multiple_found_without_setting(admin_client, update_statuses, get_sa_with_reference_number, settings, mocker):
     # mocks
-    mocker.patch('perma_payments.views.skip_lines', autospec=True)
-    sa = mocker.patch('perma_payments.views.SubscriptionAgreement', autospec=True)
-    sa.objects.filter.return_value.get.side_effect = MultipleObjectsReturned
-    log = mocker.patch('perma_payments.views.logger.log', autospec=True)
+    mocker.patch('perma_payments.status_reports.skip_lines', autospec=True)
+    for reference_number in ['ref1', 'ref1', 'ref2', 'ref2']:
+        get_sa_with_reference_number(reference_number)
+    log = mocker.patch('perma_payments.models.logger.log', autospec=True)
     settings.RAISE_IF_MULTIPLE_SUBSCRIPTIONS_FOUND = False
     admin_client.post(update_statuses['route'], update_statuses["valid_data"])
     assert log.call_count == 2
@@ -1677,50 +2277,177 @@ def test_update_statuses_post_doesnt_alert_if_multiple_found_without_setting(adm
 
 
 @pytest.mark.django_db
-def test_update_statuses_post_rejects_invalid(admin_client, broken_update_statuses, complete_standing_sa, mocker):
+def test_update_statuses_post_rejects_invalid(admin_client, broken_update_statuses, get_sa_with_reference_number, mocker):
     # mocks
-    mocker.patch('perma_payments.views.skip_lines', autospec=True)
-    sa = mocker.patch('perma_payments.views.SubscriptionAgreement', autospec=True)
-    matching_sa = sa.objects.filter
-    matching_sa.return_value.get.return_value = complete_standing_sa
-    info_log = mocker.patch('perma_payments.views.logger.info', autospec=True)
+    mocker.patch('perma_payments.status_reports.skip_lines', autospec=True)
+    sa1 = get_sa_with_reference_number('ref1')
+    sa2 = get_sa_with_reference_number('ref2')
 
     # request
-    with pytest.raises(ValidationError):
-        admin_client.post(broken_update_statuses['route'], broken_update_statuses["valid_data"])
-    assert info_log.call_count == 0
+    response = admin_client.post(broken_update_statuses['route'], broken_update_statuses["valid_data"])
+
+    # assertions
+    assert response.status_code == 200
+    assert response.context['counts'] == {'invalid': 1, 'updated': 1}
+    assert [result['outcome'] for result in response.context['problems']] == ['invalid']
+    sa1.refresh_from_db()
+    sa2.refresh_from_db()
+    assert sa1.status == 'Current'
+    assert sa2.status == 'Superseded'
 
 
 @pytest.mark.django_db
-def test_update_statuses_post_statuses_happy_path(admin_client, update_statuses, complete_standing_sa, mocker):
+def test_update_statuses_post_statuses_happy_path(admin_client, update_statuses, get_sa_with_reference_number, mocker):
     # mocks
-    skip_lines = mocker.patch('perma_payments.views.skip_lines', autospec=True)
-    sa = mocker.patch('perma_payments.views.SubscriptionAgreement', autospec=True)
-    matching_sa = sa.objects.filter
-    matching_sa.return_value.get.return_value = complete_standing_sa
-    log = mocker.patch('perma_payments.views.logger.log', autospec=True)
-    info_log = mocker.patch('perma_payments.views.logger.info', autospec=True)
+    skip_lines = mocker.patch('perma_payments.status_reports.skip_lines', autospec=True)
+    sa1 = get_sa_with_reference_number('ref1')
+    sa2 = get_sa_with_reference_number('ref2')
+    log = mocker.patch('perma_payments.models.logger.log', autospec=True)
+    info_log = mocker.patch('perma_payments.models.logger.info', autospec=True)
 
     # request
     response = admin_client.post(update_statuses['route'], update_statuses["valid_data"])
 
     # assertions
-    skip_lines.mock_calls[0][1][0] == 4  # header lines skipped
-    assert matching_sa.call_count == 2
-    assert matching_sa.return_value.get.call_count == 2
-    matching_sa.assert_any_call(subscription_request__reference_number='ref1')
-    matching_sa.assert_any_call(subscription_request__reference_number='ref2')
-    assert complete_standing_sa.status == 'Superseded'
+    assert skip_lines.mock_calls[0][1][1] == 4  # header lines skipped
+    for sa in [sa1, sa2]:
+        sa.refresh_from_db()
+        assert sa.status == 'Superseded'
+        assert sa.history.count() == 2
+        assert sa.history.latest().history_user.username == 'admin'
     # this is how we log errors
     assert not log.called
     # this is how we log successes
     assert info_log.call_count == 2
     assert response.status_code == 200
-    expected_template_used(response, 'generic.html')
+    expected_template_used(response, 'update_statuses.html')
     assert b"Statuses Updated" in response.content
+    assert response.context['rows_processed'] == 2
+    assert response.context['counts'] == {'updated': 2}
+    assert response.context['problems'] == []
+
+
+@pytest.mark.django_db
+def test_update_statuses_post_unchanged_not_written(admin_client, update_statuses, get_sa_with_reference_number, mocker):
+    mocker.patch('perma_payments.status_reports.skip_lines', autospec=True)
+    sa = get_sa_with_reference_number('ref1', status='Superseded')
+
+    response = admin_client.post(update_statuses['route'], update_statuses["valid_data"])
+
+    assert response.context['counts'] == {'unchanged': 1, 'not found': 1}
+    assert [result['reference_number'] for result in response.context['problems']] == ['ref2']
+    assert sa.history.count() == 1
+
+
+@pytest.mark.django_db
+def test_update_statuses_post_lists_first_problems(admin_client, update_statuses, settings, mocker):
+    mocker.patch('perma_payments.status_reports.skip_lines', autospec=True)
+    settings.STATUS_UPDATE_MAX_PROBLEMS = 1
+
+    response = admin_client.post(update_statuses['route'], update_statuses["valid_data"])
+
+    assert response.context['counts'] == {'not found': 2}
+    assert [result['reference_number'] for result in response.context['problems']] == ['ref1']
+    assert b'1 more, not listed' in response.content
+
+
+@pytest.mark.django_db
+def test_update_statuses_post_background(admin_client, update_statuses, get_sa_with_reference_number, mocker, django_capture_on_commit_callbacks):
+    mocker.patch('perma_payments.status_reports.skip_lines', autospec=True)
+    sa = get_sa_with_reference_number('ref1')
+
+    with django_capture_on_commit_callbacks(execute=True):
+        response = admin_client.post(update_statuses['route'], {**update_statuses["valid_data"], 'background': '1'})
+
+    job = StatusUpdateJob.objects.get()
+    assert response.status_code == 302
+    assert response['Location'] == '/update-statuses/jobs/{}/'.format(job.pk)
+    assert (job.status, job.updated, job.not_found) == ('Completed', 1, 1)
+    sa.refresh_from_db()
+    assert sa.status == 'Superseded'
 
 
 def test_update_statuses_other_methods(admin_client, update_statuses):
     get_not_allowed(admin_client, update_statuses['route'])
     put_patch_delete_not_allowed(admin_client, update_statuses['route'])
 
+
+# status_update_job
+
+@pytest.mark.django_db
+def test_status_update_job_get_staff_required(client, non_admin):
+    job = StatusUpdateJob.objects.create()
+    client.force_login(non_admin)
+    response = client.get('/update-statuses/jobs/{}/'.format(job.pk))
+    assert response.status_code == 403
+
+
+@pytest.mark.django_db
+def test_status_update_job_get_in_progress(admin_client):
+    job = StatusUpdateJob.objects.create(status='Running', last_progress_at=make_aware(datetime.now()), rows_processed=1500, updated=1200)
+    response = admin_client.get('/update-statuses/jobs/{}/'.format(job.pk))
+    assert response.status_code == 200
+    expected_template_used(response, 'status_update_job.html')
+    assert b'http-equiv="refresh"' in response.content
+    assert b'1500' in response.content and b'1200' in response.content
+    assert b'Re-run' not in response.content
+
+
+@pytest.mark.django_db
+def test_status_update_job_get_finished(admin_client):
+    job = StatusUpdateJob.objects.create(status='Completed', problems=[{'row': 7, 'reference_number': 'ref7', 'status': 'Current', 'outcome': 'not found'}])
+    response = admin_client.get('/update-statuses/jobs/{}/'.format(job.pk))
+    assert b'http-equiv="refresh"' not in response.content
+    assert b'ref7' in response.content
+
+
+@pytest.mark.django_db
+def test_status_update_job_get_not_found(admin_client):
+    response = admin_client.get('/update-statuses/jobs/1/')
+    assert response.status_code == 404
+
+
+@pytest.mark.django_db
+def test_status_update_job_post_reruns_failed(admin_client, mocker):
+    job = StatusUpdateJob.objects.create(status='Failed', error='boom')
+    rerun = mocker.patch('perma_payments.views.rerun_status_update_job', autospec=True)
+    response = admin_client.post('/update-statuses/jobs/{}/'.format(job.pk))
+    assert response.status_code == 302
+    assert response['Location'] == '/update-statuses/jobs/{}/'.format(job.pk)
+    assert rerun.call_args[0][0].pk == job.pk
+
+
+@pytest.mark.django_db
+def test_status_update_job_get_finished_lists_first_problems(admin_client, settings):
+    settings.STATUS_UPDATE_MAX_PROBLEMS = 1
+    job = StatusUpdateJob.objects.create(status='Completed', not_found=3, problems=[{'row': 7, 'reference_number': 'ref7', 'status': 'Current', 'outcome': 'not found'}])
+    response = admin_client.get('/update-statuses/jobs/{}/'.format(job.pk))
+    assert b'ref7' in response.content
+    assert b'2 more, not listed' in response.content
+
+
+@pytest.mark.django_db
+def test_status_update_job_post_reruns_abandoned(admin_client, mocker):
+    job = StatusUpdateJob.objects.create(status='Running', last_progress_at=make_aware(datetime.now()) - timedelta(days=1))
+    response = admin_client.get('/update-statuses/jobs/{}/'.format(job.pk))
+    assert b'abandoned' in response.content and b'Re-run' in response.content
+    rerun = mocker.patch('perma_payments.views.rerun_status_update_job', autospec=True)
+    response = admin_client.post('/update-statuses/jobs/{}/'.format(job.pk))
+    assert response.status_code == 302
+    assert rerun.call_args[0][0].pk == job.pk
+
+
+@pytest.mark.django_db
+def test_status_update_job_post_rejects_unfinished(admin_client, mocker):
+    job = StatusUpdateJob.objects.create(status='Running', last_progress_at=make_aware(datetime.now()))
+    rerun = mocker.patch('perma_payments.views.rerun_status_update_job', autospec=True)
+    response = admin_client.post('/update-statuses/jobs/{}/'.format(job.pk))
+    assert response.status_code == 400
+    assert not rerun.called
+
+
+@pytest.mark.django_db
+def test_status_update_job_other_methods(admin_client):
+    job = StatusUpdateJob.objects.create()
+    put_patch_delete_not_allowed(admin_client, '/update-statuses/jobs/{}/'.format(job.pk))
+
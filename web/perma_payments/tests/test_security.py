@@ -2,18 +2,22 @@ from collections import OrderedDict
 from datetime import datetime, timedelta
 import decimal
 from django.conf import settings
+from django.core.cache import caches
 from django.http import QueryDict
+from django.urls import reverse
 from nacl import encoding
-from nacl.public import PrivateKey, PublicKey
+from nacl.exceptions import CryptoError
+from nacl.public import Box, PrivateKey, PublicKey
 from string import ascii_lowercase
 
 from hypothesis import given
 from hypothesis.strategies import characters, text, integers, booleans, datetimes, dates, decimals, uuids, binary, lists, dictionaries
 import pytest
 
-from perma_payments.security import (decrypt_from_perma, decrypt_from_storage,
-    encrypt_for_perma, encrypt_for_storage, generate_public_private_keys,
-    InvalidTransmissionException, is_valid_signature, is_valid_timestamp,
+from perma_payments.metrics import PERMA_DECRYPTIONS
+from perma_payments.security import (PERMA_NONCE_CACHE, decrypt_from_perma, decrypt_from_storage,
+    encrypt_for_perma, encrypt_for_storage, generate_public_private_keys, get_cached_box, get_cybersource_signer, get_perma_keyring,
+    InvalidTransmissionException, is_replay, is_valid_signature, is_valid_timestamp,
     prep_for_cybersource, prep_for_perma, process_cybersource_transmission,
     process_perma_transmission, retrieve_fields, sign_data, stringify_data,
     stringify_for_signature, unstringify_data)
@@ -119,6 +123,32 @@ def spoof_django_post_object():
     return QueryDict('a=1,b=2,c=3')
 
 
+@pytest.fixture
+def nonce_cache(settings):
+    settings.CACHES = {**settings.CACHES, PERMA_NONCE_CACHE: {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'test-nonces'}}
+    nonce_cache = caches[PERMA_NONCE_CACHE]
+    nonce_cache.clear()
+    yield nonce_cache
+    nonce_cache.clear()
+
+
+@pytest.fixture
+def rotating_keys(settings):
+    """
+    Accept a second key pair from Perma; returns it, with a Box to encrypt messages as Perma would using it.
+    """
+    keys = generate_public_private_keys()
+    accepted = {
+        'id': settings.PERMA_ENCRYPTION_KEYS['id'] + 1,
+        'perma_payments_secret_key': keys['a']['secret'],
+        'perma_payments_public_key': keys['a']['public'],
+        'perma_public_key': keys['b']['public'],
+    }
+    settings.ACCEPTED_PERMA_ENCRYPTION_KEYS = [accepted]
+    perma_box = Box(PrivateKey(keys['b']['secret'], encoder=encoding.Base64Encoder), PublicKey(keys['a']['public'], encoder=encoding.Base64Encoder))
+    return accepted, perma_box
+
+
 #
 # TESTS
 #
@@ -292,12 +322,43 @@ def test_process_perma_transmission_happy_path(spoof_perma_post, mocker):
     decrypt = mocker.patch('perma_payments.security.decrypt_from_perma', autospec=True, return_value=mocker.sentinel.decrypted)
     unstringify = mocker.patch('perma_payments.security.unstringify_data', autospec=True, return_value=spoof_perma_post['encrypted_data'])
     timestamp = mocker.patch('perma_payments.security.is_valid_timestamp', autospec=True, return_value=True)
+    replay = mocker.patch('perma_payments.security.is_replay', autospec=True, return_value=False)
 
     assert process_perma_transmission(spoof_perma_post, ['desired_field']) == {'desired_field': 'desired_field'}
 
     decrypt.assert_called_once_with(spoof_perma_post['encrypted_data'])
     unstringify.assert_called_once_with(mocker.sentinel.decrypted)
     timestamp.assert_called_once_with(spoof_perma_post['encrypted_data']['timestamp'], settings.PERMA_TIMESTAMP_MAX_AGE_SECONDS)
+    replay.assert_called_once_with(spoof_perma_post['encrypted_data'], spoof_perma_post['encrypted_data']['timestamp'])
+
+
+def test_process_perma_transmission_replayed(spoof_perma_post, mocker):
+    mocker.patch('perma_payments.security.decrypt_from_perma', autospec=True)
+    mocker.patch('perma_payments.security.unstringify_data', autospec=True, return_value=spoof_perma_post['encrypted_data'])
+    mocker.patch('perma_payments.security.is_valid_timestamp', autospec=True, return_value=True)
+    mocker.patch('perma_payments.security.is_replay', autospec=True, return_value=True)
+    with pytest.raises(InvalidTransmissionException) as excinfo:
+        process_perma_transmission(spoof_perma_post, [])
+    assert 'Replayed data.' in str(excinfo)
+
+
+def test_process_perma_transmission_replay_rejected(nonce_cache):
+    post = {'encrypted_data': prep_for_perma({'timestamp': datetime.utcnow().timestamp(), 'desired_field': 'value'})}
+    assert process_perma_transmission(post, ['desired_field']) == {'desired_field': 'value'}
+    with pytest.raises(InvalidTransmissionException) as excinfo:
+        process_perma_transmission(post, ['desired_field'])
+    assert 'Replayed data.' in str(excinfo)
+    # the same content, encrypted again, is a new message
+    post = {'encrypted_data': prep_for_perma({'timestamp': datetime.utcnow().timestamp(), 'desired_field': 'value'})}
+    assert process_perma_transmission(post, ['desired_field']) == {'desired_field': 'value'}
+
+
+@pytest.mark.django_db
+def test_replay_rejected_before_database_access(client, nonce_cache, django_assert_num_queries):
+    post = {'encrypted_data': prep_for_perma({'timestamp': datetime.utcnow().timestamp(), 'customer_pk': 1, 'customer_type': 'Registrar'}).decode('ascii')}
+    assert client.post(reverse('subscription'), post).status_code == 200
+    with django_assert_num_queries(0):
+        assert client.post(reverse('subscription'), post).status_code == 400
 
 
 # Helpers
@@ -308,6 +369,10 @@ def test_retrieve_fields_returns_only_specified_fields(one_two_three_dict):
     assert retrieve_fields(one_two_three_dict, ['one', 'three']) == {'one': 'one', 'three': 'three'}
 
 
+def test_retrieve_fields_includes_optional_fields_if_present(one_two_three_dict):
+    assert retrieve_fields(one_two_three_dict, ['one'], ['three', 'four']) == {'one': 'one', 'three': 'three'}
+
+
 def test_retrieve_fields_raises_if_field_absent(one_two_three_dict):
     with pytest.raises(InvalidTransmissionException):
         retrieve_fields(one_two_three_dict, ['four'])
@@ -323,6 +388,25 @@ def test_is_valid_timestamp():
     assert not is_valid_timestamp(invalid, max_age)
 
 
+def test_is_valid_timestamp_too_old():
+    max_age = 60
+    still_valid = (datetime.utcnow() - timedelta(seconds=max_age - 1)).timestamp()
+    invalid = (datetime.utcnow() - timedelta(seconds=max_age * 2)).timestamp()
+    assert is_valid_timestamp(still_valid, max_age)
+    assert not is_valid_timestamp(invalid, max_age)
+
+
+def test_is_replay_remembers_until_timestamp_expires(nonce_cache, mocker):
+    add = mocker.spy(nonce_cache, 'add')
+    message = encrypt_for_perma(b'')
+    timestamp = datetime.utcnow().timestamp()
+    assert not is_replay(message, timestamp)
+    assert is_replay(message, timestamp)
+    assert not is_replay(encrypt_for_perma(b''), timestamp)
+    timeout = add.call_args_list[0][0][2]
+    assert settings.PERMA_TIMESTAMP_MAX_AGE_SECONDS - 1 < timeout <= settings.PERMA_TIMESTAMP_MAX_AGE_SECONDS
+
+
 preserved = text(alphabet=characters(min_codepoint=1, blacklist_categories=('Cc', 'Cs'))) | integers() | booleans()
 @given(preserved | dictionaries(keys=text(alphabet=characters(min_codepoint=1, blacklist_categories=('Cc', 'Cs'))), values=preserved))
 def test_stringify_and_unstringify_data_types_preserved(data):
@@ -379,6 +463,33 @@ def test_is_valid_signature_invalid(signed_data):
     assert not is_valid_signature(signed_data['data'], b"")
 
 
+def test_prep_for_cybersource_signature_valid(one_two_three_dict, reverse_ascii_ordered_dict):
+    prepped = prep_for_cybersource(one_two_three_dict, reverse_ascii_ordered_dict)
+    signed = OrderedDict((field, prepped[field]) for field in prepped['signed_field_names'].split(','))
+    assert is_valid_signature(signed, prepped['signature'])
+
+
+def test_cybersource_signer_cached():
+    signer = get_cybersource_signer()
+    assert get_cybersource_signer() is signer
+    sign_data('message')
+    assert get_cybersource_signer() is signer
+
+
+def test_cybersource_signer_accepts_previous_secret(settings, signed_data):
+    old_signer = get_cybersource_signer()
+    settings.ACCEPTED_CS_SECRET_KEYS = [settings.CS_SECRET_KEY]
+    settings.CS_SECRET_KEY = 'a-new-really-long-test-string'
+    assert get_cybersource_signer() is not old_signer
+    # replies signed with either secret are accepted...
+    assert is_valid_signature(signed_data['data'], signed_data['signature'])
+    assert is_valid_signature(signed_data['data'], sign_data(signed_data['string']))
+    # ...but we sign with the new one
+    assert sign_data(signed_data['string']) != signed_data['signature']
+    settings.ACCEPTED_CS_SECRET_KEYS = []
+    assert not is_valid_signature(signed_data['data'], signed_data['signature'])
+
+
 def test_generate_public_private_keys():
     keys = generate_public_private_keys()
     expected_keys = ['a', 'b']
@@ -400,3 +511,58 @@ def test_storage_encrypt_and_decrypt(b):
 def test_perma_encrypt_and_decrypt(b):
     ci = encrypt_for_perma(b)
     assert decrypt_from_perma(ci) == b
+
+
+def test_boxes_cached_per_key_id():
+    encrypt_for_perma(b'')
+    box = get_cached_box('perma', settings.PERMA_ENCRYPTION_KEYS, None)
+    encrypt_for_perma(b'')
+    assert get_cached_box('perma', settings.PERMA_ENCRYPTION_KEYS, None) is box
+
+
+def test_cached_boxes_cleared_when_keys_change(settings):
+    keys = generate_public_private_keys()
+    encrypt_for_perma(b'')
+    old_box = get_cached_box('perma', settings.PERMA_ENCRYPTION_KEYS, None)
+    settings.PERMA_ENCRYPTION_KEYS = {
+        'id': settings.PERMA_ENCRYPTION_KEYS['id'],
+        'perma_payments_secret_key': keys['a']['secret'],
+        'perma_payments_public_key': keys['a']['public'],
+        'perma_public_key': keys['b']['public'],
+    }
+    ci = encrypt_for_perma(b'sentinel')
+    assert get_cached_box('perma', settings.PERMA_ENCRYPTION_KEYS, None) is not old_box
+    perma_box = Box(PrivateKey(keys['b']['secret'], encoder=encoding.Base64Encoder), PublicKey(keys['a']['public'], encoder=encoding.Base64Encoder))
+    assert perma_box.decrypt(ci, encoder=encoding.Base64Encoder) == b'sentinel'
+
+
+def test_decrypt_from_perma_with_accepted_keys(settings, rotating_keys):
+    accepted, perma_box = rotating_keys
+    before = PERMA_DECRYPTIONS.value(key_id=accepted['id'])
+    assert decrypt_from_perma(perma_box.encrypt(b'new', encoder=encoding.Base64Encoder)) == b'new'
+    assert decrypt_from_perma(encrypt_for_perma(b'old')) == b'old'
+    assert PERMA_DECRYPTIONS.value(key_id=accepted['id']) == before + 1
+
+
+def test_perma_keyring_tries_most_recently_successful_first(settings, rotating_keys):
+    accepted, perma_box = rotating_keys
+    primary_id = settings.PERMA_ENCRYPTION_KEYS['id']
+    keyring = get_perma_keyring()
+    assert [key_id for key_id, _ in keyring.boxes] == [primary_id, accepted['id']]
+    decrypt_from_perma(perma_box.encrypt(b'', encoder=encoding.Base64Encoder))
+    assert [key_id for key_id, _ in keyring.boxes] == [accepted['id'], primary_id]
+    decrypt_from_perma(encrypt_for_perma(b''))
+    assert [key_id for key_id, _ in keyring.boxes] == [primary_id, accepted['id']]
+    assert get_perma_keyring() is keyring
+
+
+def test_perma_keyring_shares_cached_boxes():
+    [(_, box)] = get_perma_keyring().boxes
+    assert box is get_cached_box('perma', settings.PERMA_ENCRYPTION_KEYS, None)
+
+
+def test_decrypt_from_perma_no_key_matches(rotating_keys):
+    keys = generate_public_private_keys()
+    stranger = Box(PrivateKey(keys['a']['secret'], encoder=encoding.Base64Encoder), PublicKey(keys['b']['public'], encoder=encoding.Base64Encoder))
+    with pytest.raises(CryptoError):
+        decrypt_from_perma(stranger.encrypt(b'', encoder=encoding.Base64Encoder))
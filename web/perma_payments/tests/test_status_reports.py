@@ -0,0 +1,250 @@
+from datetime import datetime, timedelta
+import io
+import os
+import tracemalloc
+
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile, TemporaryUploadedFile
+from django.utils.timezone import make_aware
+
+import pytest
+from pytest_factoryboy import register
+
+from perma_payments.models import StatusUpdateJob, SubscriptionRequest
+from perma_payments.status_reports import (skip_lines, uploaded_csv_to_dict_reader, store_report, StoredReport,
+    enqueue_status_update_job, rerun_status_update_job, claim_status_update_job, process_status_update_jobs)
+
+from .factories import SubscriptionRequestFactory
+
+register(SubscriptionRequestFactory)
+
+
+#
+# FIXTURES
+#
+
+@pytest.fixture()
+def five_line_file():
+    file = io.StringIO("line1\nline2\nline3\nline4\nline5\n")
+    assert 5 == sum(1 for line in file)
+    file.seek(0)
+    return file
+
+
+@pytest.fixture()
+def status_report_preamble():
+    return b"Subscription List\nGenerated by CyberSource\nSome date\n\nMerchant Reference Code,Status\n"
+
+
+@pytest.fixture()
+def large_status_report(status_report_preamble):
+    file = TemporaryUploadedFile('report.csv', 'text/csv', None, 'utf-8')
+    file.write(status_report_preamble)
+    for i in range(500000):
+        file.write(b"PERMA-%04d-%04d,CURRENT\n" % divmod(i, 10000))
+    file.seek(0)
+    yield file
+    file.close()
+
+
+@pytest.fixture()
+def status_report(status_report_preamble):
+    return SimpleUploadedFile('report.csv', status_report_preamble + b"ref1,SUPERSEDED\nref2,Current\nref3,Superseded\nref4,Bogus\n")
+
+
+@pytest.fixture()
+def subscriptions(subscription_request_factory):
+    subscriptions = []
+    for reference_number in ['ref1', 'ref2', 'ref4', 'ref4']:
+        sr = subscription_request_factory(subscription_agreement__status='Current')
+        # bypass the registry, so that duplicates (which predate it) can be set up
+        SubscriptionRequest.objects.filter(pk=sr.pk).update(reference_number=reference_number)
+        subscriptions.append(sr.subscription_agreement)
+    return subscriptions
+
+
+#
+# TESTS
+#
+
+# reading reports
+
+def test_skip_lines(five_line_file):
+    skip_lines(five_line_file, 4)
+    assert five_line_file.readline() == 'line5\n'
+
+
+def test_uploaded_csv_to_dict_reader(status_report_preamble):
+    file = SimpleUploadedFile('report.csv', status_report_preamble + 'PERMA-1234-5678,Current\n"PERMA-0000-0001","Hold, "\n'.encode('utf-8'))
+    rows = uploaded_csv_to_dict_reader(file, skip=4)
+    assert list(rows) == [
+        {'Merchant Reference Code': 'PERMA-1234-5678', 'Status': 'Current'},
+        {'Merchant Reference Code': 'PERMA-0000-0001', 'Status': 'Hold, '},
+    ]
+    assert not file.closed
+
+
+def test_uploaded_csv_to_dict_reader_is_lazy(status_report_preamble, mocker):
+    skip = mocker.patch('perma_payments.status_reports.skip_lines', autospec=True)
+    rows = uploaded_csv_to_dict_reader(SimpleUploadedFile('report.csv', status_report_preamble), skip=4)
+    assert not skip.called
+    next(rows)
+    assert skip.call_args[0][1] == 4
+
+
+def test_uploaded_csv_to_dict_reader_memory_flat(large_status_report):
+    tracemalloc.start()
+    try:
+        count = 0
+        for row in uploaded_csv_to_dict_reader(large_status_report, skip=4):
+            count += 1
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert count == 500000
+    assert row == {'Merchant Reference Code': 'PERMA-0049-9999', 'Status': 'CURRENT'}
+    # the file itself is over 11MB
+    assert os.path.getsize(large_status_report.temporary_file_path()) > 11 * 1024 * 1024
+    assert peak < 256 * 1024
+
+
+# storing reports
+
+@pytest.mark.django_db
+def test_stored_report_round_trip(status_report, mocker):
+    mocker.patch('perma_payments.status_reports.REPORT_CHUNK_BYTES', 10)
+    job = StatusUpdateJob.objects.create()
+    # uploads small enough to be kept in memory are stored whole: this one is read in pieces
+    store_report(job, ContentFile(status_report.file.getvalue()))
+    assert job.report_chunks.count() > 1
+    assert io.BufferedReader(StoredReport(job)).read() == status_report.file.getvalue()
+    assert [row['Merchant Reference Code'] for row in uploaded_csv_to_dict_reader(io.BufferedReader(StoredReport(job)), skip=4)] == ['ref1', 'ref2', 'ref3', 'ref4']
+
+
+@pytest.mark.django_db
+def test_stored_report_memory_flat(large_status_report):
+    job = StatusUpdateJob.objects.create()
+    store_report(job, large_status_report)
+    assert job.report_chunks.count() > 10
+    tracemalloc.start()
+    try:
+        count = 0
+        for row in uploaded_csv_to_dict_reader(io.BufferedReader(StoredReport(job)), skip=4):
+            count += 1
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert count == 500000
+    assert row == {'Merchant Reference Code': 'PERMA-0049-9999', 'Status': 'CURRENT'}
+    # one 1MB chunk at a time, not the whole 11MB report
+    assert peak < 4 * 1024 * 1024
+
+
+# background jobs
+
+@pytest.mark.django_db
+def test_enqueue_status_update_job_waits_for_commit(status_report, django_capture_on_commit_callbacks):
+    with django_capture_on_commit_callbacks() as callbacks:
+        job = enqueue_status_update_job(status_report)
+    job.refresh_from_db()
+    assert job.status == 'Queued'
+    assert io.BufferedReader(StoredReport(job)).read() == status_report.file.getvalue()
+    assert len(callbacks) == 1
+
+
+@pytest.mark.django_db
+def test_status_update_job_happy_path(status_report, subscriptions, admin_user, django_capture_on_commit_callbacks):
+    with django_capture_on_commit_callbacks(execute=True):
+        job = enqueue_status_update_job(status_report, user=admin_user)
+
+    job.refresh_from_db()
+    assert job.status == 'Completed'
+    assert job.started_at and job.finished_at
+    assert (job.rows_processed, job.updated, job.unchanged, job.not_found, job.duplicates, job.invalid) == (4, 1, 1, 1, 1, 0)
+    assert [(problem['reference_number'], problem['outcome']) for problem in job.problems] == [('ref3', 'not found'), ('ref4', 'duplicate')]
+    subscriptions[0].refresh_from_db()
+    assert subscriptions[0].status == 'Superseded'
+    assert subscriptions[0].history.latest().history_user == admin_user
+
+
+@pytest.mark.django_db
+def test_status_update_job_records_progress_per_chunk(status_report, subscriptions, mocker, django_capture_on_commit_callbacks):
+    mocker.patch('perma_payments.status_reports.STATUS_REPORT_CHUNK_SIZE', 2)
+    save = mocker.spy(StatusUpdateJob, 'save')
+    with django_capture_on_commit_callbacks(execute=True):
+        enqueue_status_update_job(status_report)
+    progress_saves = [call for call in save.call_args_list if 'status' not in call.kwargs.get('update_fields', ['status'])]
+    assert len(progress_saves) == 2
+
+
+@pytest.mark.django_db
+def test_status_update_job_caps_problems(status_report, subscriptions, settings, django_capture_on_commit_callbacks):
+    settings.STATUS_UPDATE_MAX_PROBLEMS = 1
+    with django_capture_on_commit_callbacks(execute=True):
+        job = enqueue_status_update_job(status_report)
+    job.refresh_from_db()
+    assert (job.not_found, job.duplicates) == (1, 1)
+    assert [problem['reference_number'] for problem in job.problems] == ['ref3']
+    assert job.problems_not_shown() == 1
+
+
+@pytest.mark.django_db
+def test_status_update_job_failure_and_rerun(status_report, subscriptions, mocker, django_capture_on_commit_callbacks):
+    apply = mocker.patch('perma_payments.status_reports.SubscriptionAgreement.apply_status_report', autospec=True, side_effect=Exception('boom'))
+    with django_capture_on_commit_callbacks(execute=True):
+        job = enqueue_status_update_job(status_report)
+    job.refresh_from_db()
+    assert job.status == 'Failed'
+    assert 'boom' in job.error
+    assert job.is_finished()
+
+    apply.side_effect = None
+    apply.return_value = iter([{'row': 1, 'reference_number': 'ref1', 'status': 'Superseded', 'outcome': 'updated'}])
+    with django_capture_on_commit_callbacks(execute=True):
+        rerun_status_update_job(job)
+    job.refresh_from_db()
+    assert job.status == 'Completed'
+    assert job.error == ''
+    assert (job.rows_processed, job.updated) == (1, 1)
+
+
+@pytest.mark.django_db
+def test_rerun_status_update_job_only_if_failed_or_abandoned(status_report):
+    job = enqueue_status_update_job(status_report)
+    with pytest.raises(ValueError):
+        rerun_status_update_job(job)
+    job.status = 'Running'
+    job.last_progress_at = make_aware(datetime.now())
+    job.save()
+    with pytest.raises(ValueError):
+        rerun_status_update_job(job)
+    job.last_progress_at = make_aware(datetime.now() - timedelta(days=1))
+    job.save()
+    rerun_status_update_job(job)
+    job.refresh_from_db()
+    assert job.status == 'Queued'
+
+
+@pytest.mark.django_db
+def test_claim_status_update_job_reclaims_abandoned(settings):
+    settings.STATUS_UPDATE_JOB_LEASE_SECONDS = 60
+    live = StatusUpdateJob.objects.create(status='Running', last_progress_at=make_aware(datetime.now() - timedelta(seconds=30)))
+    abandoned = StatusUpdateJob.objects.create(status='Running', rows_processed=1000, last_progress_at=make_aware(datetime.now() - timedelta(seconds=90)))
+    claimed = claim_status_update_job()
+    assert claimed.pk == abandoned.pk
+    assert claimed.rows_processed == 0
+    assert claimed.last_progress_at > make_aware(datetime.now() - timedelta(seconds=30))
+    assert claim_status_update_job() is None
+    live.refresh_from_db()
+    assert live.status == 'Running'
+
+
+@pytest.mark.django_db
+def test_process_status_update_jobs_oldest_first(status_report, mocker):
+    jobs = [StatusUpdateJob.objects.create() for i in range(3)]
+    run = mocker.patch('perma_payments.status_reports.run_status_update_job', autospec=True)
+    process_status_update_jobs()
+    assert [call[0][0].pk for call in run.call_args_list] == [job.pk for job in jobs]
+    for job in jobs:
+        job.refresh_from_db()
+        assert job.status == 'Running'
@@ -1,8 +1,6 @@
-import io
-
 import pytest
 
-from perma_payments.views import SENSITIVE_POST_PARAMETERS, redact, skip_lines
+from perma_payments.views import SENSITIVE_POST_PARAMETERS, redact
 
 
 #
@@ -37,23 +35,10 @@ def senstive_dict():
     return data
 
 
-@pytest.fixture()
-def five_line_file():
-    file = io.StringIO("line1\nline2\nline3\nline4\nline5\n")
-    assert 5 == sum(1 for line in file)
-    file.seek(0)
-    return file
-
-
 #
 # TESTS
 #
 
-def test_skip_lines(five_line_file):
-    skip_lines(five_line_file, 4)
-    assert five_line_file.readline() == 'line5\n'
-
-
 def test_redact(senstive_dict):
     redacted = redact(senstive_dict)
     for field in SENSITIVE_POST_PARAMETERS:
@@ -1,9 +1,13 @@
 from ast import literal_eval
 from datetime import datetime, timezone
+import socketserver
+import threading
 import urllib
 
 from django.core.exceptions import ValidationError
+from django.db import connection
 from django.http import QueryDict
+from django.test.utils import CaptureQueriesContext
 
 from faker import Faker
 import pytest
@@ -74,6 +78,23 @@ def autopopulated_fields_present(o, fields):
         assert value is not None and value != ''
 
 
+def query_plans(func, *args, **kwargs):
+    """
+    Returns the Postgres query plan of every query run by func.
+    Tiny test tables never merit an index, so sequential scans are discouraged while planning.
+    Must be called inside a transaction (e.g. from a django_db test).
+    """
+    with CaptureQueriesContext(connection) as context:
+        func(*args, **kwargs)
+    plans = []
+    with connection.cursor() as cursor:
+        cursor.execute('SET LOCAL enable_seqscan = off')
+        for query in context.captured_queries:
+            cursor.execute('EXPLAIN {}'.format(query['sql']))
+            plans.append('\n'.join(row[0] for row in cursor.fetchall()))
+    return plans
+
+
 # Views
 
 def expected_template_used(response, expected):
@@ -99,3 +120,61 @@ def put_patch_delete_not_allowed(client, route):
     response = client.delete(route)
     assert response.status_code == 405
 
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    """
+    Just enough of an SMTP server, on localhost, to receive mail from Django's SMTP backend.
+    Counts connections and collects messages; refuses the next `refuse` senders with a temporary error.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeSMTPHandler)
+        self.port = self.server_address[1]
+        self.connections = 0
+        self.messages = []
+        self.refuse = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections += 1
+        self.reply('220 localhost fake SMTP')
+        for line in self.rfile:
+            command = line.decode().strip().upper()
+            if command.startswith('MAIL'):
+                with server.lock:
+                    refused, server.refuse = server.refuse > 0, max(server.refuse - 1, 0)
+                self.reply('451 try again later' if refused else '250 OK')
+            elif command.startswith('DATA'):
+                self.reply('354 end with .')
+                data = []
+                for line in self.rfile:
+                    if line.rstrip(b'\r\n') == b'.':
+                        break
+                    data.append(line)
+                with server.lock:
+                    server.messages.append(b''.join(data))
+                self.reply('250 OK')
+            elif command.startswith('QUIT'):
+                self.reply('221 bye')
+                return
+            else:
+                # EHLO, HELO, RCPT, RSET, NOOP
+                self.reply('250 OK')
@@ -6,12 +6,16 @@ urlpatterns = [
     re_path(r'^$', views.index, name='index'),
     re_path(r'^cancel-request/$', views.cancel_request, name='cancel_request'),
     re_path(r'^cybersource-callback/$', views.cybersource_callback, name='cybersource_callback'),
+    re_path(r'^metrics/$', views.metrics, name='metrics'),
     re_path(r'^purchase/$', views.purchase, name='purchase'),
     re_path(r'^acknowledge-purchase/$', views.acknowledge_purchase, name='acknowledge_purchase'),
+    re_path(r'^acknowledge-purchases/$', views.acknowledge_purchases, name='acknowledge_purchases'),
     re_path(r'^purchase-history/$', views.purchase_history, name='purchase_history'),
     re_path(r'^subscribe/$', views.subscribe, name='subscribe'),
     re_path(r'^subscription/$', views.subscription, name='subscription'),
+    re_path(r'^subscriptions/$', views.subscriptions, name='subscriptions'),
     re_path(r'^update-statuses/$', views.update_statuses, name='update_statuses'),
+    re_path(r'^update-statuses/jobs/(?P<pk>\d+)/$', views.status_update_job, name='status_update_job'),
     re_path(r'^update/$', views.update, name='update'),
     re_path(r'^change/$', views.change, name='change'),
 ]
@@ -1,15 +1,14 @@
-import csv
+from collections import Counter
 from datetime import datetime
-from pytz import timezone
 from functools import wraps
-import io
 
 from django.conf import settings
 from django.contrib.auth.decorators import login_required
-from django.core.exceptions import ValidationError, ObjectDoesNotExist, MultipleObjectsReturned, PermissionDenied
+from django.core.cache import cache
+from django.core.exceptions import ValidationError, PermissionDenied
 from django.db import transaction
-from django.http import JsonResponse
-from django.shortcuts import render, redirect
+from django.http import HttpResponse, JsonResponse
+from django.shortcuts import get_object_or_404, render, redirect
 from django.utils.timezone import make_aware
 from django.views.decorators.debug import sensitive_post_parameters
 from django.views.decorators.http import require_http_methods
@@ -22,7 +21,10 @@ from .constants import (
 )
 from .custom_errors import bad_request
 from .email import send_self_email
+from .metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, CYBERSOURCE_CALLBACKS, CYBERSOURCE_DUPLICATE_CALLBACKS, render_metrics
+from .routers import use_replica
 from .models import (
+    StatusUpdateJob,
     SubscriptionAgreement,
     OutgoingTransaction,
     SubscriptionRequest,
@@ -33,7 +35,12 @@ from .models import (
     SubscriptionRequestResponse,
     ChangeRequestResponse,
     UpdateRequestResponse,
-    PurchaseRequestResponse
+    PurchaseRequestResponse,
+    WITH_SUBSCRIPTION_REQUEST,
+    WITH_SUBSCRIPTION_REQUEST_RESPONSE,
+    forget_subscription_statuses,
+    refresh_subscription_summary,
+    subscription_status_cache_keys,
 )
 from .security import (
    InvalidTransmissionException,
@@ -41,6 +48,14 @@ from .security import (
    process_cybersource_transmission,
    prep_for_perma,
    process_perma_transmission,
+   safe_str_cmp,
+)
+from .status_reports import (
+    PROBLEM_OUTCOMES,
+    REPORT_PREAMBLE_LINES,
+    enqueue_status_update_job,
+    rerun_status_update_job,
+    uploaded_csv_to_dict_reader,
 )
 
 import logging
@@ -60,6 +75,9 @@ FIELDS_REQUIRED_FROM_PERMA = {
     'acknowledge_purchase': [
         'purchase_pk'
     ],
+    'acknowledge_purchases': [
+        'purchase_pks'
+    ],
     'subscribe': [
         'customer_pk',
         'customer_type',
@@ -86,12 +104,23 @@ FIELDS_REQUIRED_FROM_PERMA = {
         'customer_pk',
         'customer_type'
     ],
+    'subscriptions': [
+        'customers'
+    ],
     'cancel_request': [
         'customer_pk',
         'customer_type'
     ]
 }
 
+FIELDS_OPTIONAL_FROM_PERMA = {
+    'purchase_history': [
+        'after',
+        'since',
+        'limit'
+    ]
+}
+
 FIELDS_REQUIRED_FOR_CYBERSOURCE = {
     'purchase': [
         'access_key',
@@ -181,26 +210,6 @@ def redact(post):
     return {k: v for (k, v) in post.items() if k not in SENSITIVE_POST_PARAMETERS}
 
 
-def skip_lines(csv_file, lines):
-    """
-    Given a file object, advances the read/write head <lines> number of lines.
-    Useful for skipping over undesired lines of a file before processing.
-    Returns None.
-    """
-    for i in range(lines):
-        csv_file.readline()
-
-
-def in_mem_csv_to_dict_reader(csv_file):
-    """
-    A POSTed file is processed by Django and made available as an InMemoryUploadedFile.
-    InMemoryUploadedFiles lack the necessary methods to pass them to a csv reader in the normal way.
-    This is a work around.
-    https://docs.djangoproject.com/en/1.11/ref/files/uploads/
-    """
-    return csv.DictReader(io.StringIO(csv_file.read().decode('utf-8')))
-
-
 def user_passes_test_or_403(test_func):
     """
     Decorator for views that checks that the user passes the given test,
@@ -219,6 +228,103 @@ def user_passes_test_or_403(test_func):
     return decorator
 
 
+def customer_subscription_status(customer_pk, customer_type):
+    """
+    A simplified version of a customer's subscription status, and any bonus links
+    they have purchased but Perma has not yet acknowledged, as reported by /subscription/.
+    """
+    return subscription_status(
+        SubscriptionAgreement.customer_standing_subscription(customer_pk, customer_type, select_related=WITH_SUBSCRIPTION_REQUEST),
+        PurchaseRequestResponse.customer_unacknowledged(customer_pk, customer_type)
+    )
+
+
+def subscription_status(standing_subscription, purchases):
+    if not standing_subscription:
+        subscription = None
+    else:
+        subscription = {
+            'link_limit': standing_subscription.current_link_limit,
+            'link_limit_effective_timestamp': formatted_date_or_none(standing_subscription.current_link_limit_effective_timestamp),
+            'rate': standing_subscription.current_rate,
+            'frequency': standing_subscription.current_frequency,
+            'paid_through': formatted_date_or_none(standing_subscription.paid_through),
+            'reference_number': standing_subscription.subscription_request.reference_number
+        }
+
+        if standing_subscription.cancellation_requested and standing_subscription.status != 'Canceled':
+            subscription['status'] = 'Cancellation Requested'
+        else:
+            subscription['status'] = standing_subscription.status
+
+    return {
+        'subscription': subscription,
+        'purchases': purchases
+    }
+
+
+def customers_from_perma(customers):
+    """
+    Validates a list of [customer_pk, customer_type] pairs sent by Perma,
+    returning a list of (customer_pk, customer_type) tuples without duplicates.
+    """
+    if not isinstance(customers, list) or len(customers) > settings.MAX_CUSTOMERS_PER_REQUEST:
+        raise InvalidTransmissionException('Expected a list of at most {} customers.'.format(settings.MAX_CUSTOMERS_PER_REQUEST))
+    validated = {}
+    for customer in customers:
+        try:
+            customer_pk, customer_type = customer
+            validated[(int(customer_pk), str(customer_type))] = None
+        except (TypeError, ValueError):
+            raise InvalidTransmissionException('Invalid customer: {}'.format(customer))
+    return list(validated)
+
+
+def purchase_pks_from_perma(purchase_pks):
+    """
+    Validates a list of purchase pks sent by Perma, returning a list of ints without duplicates.
+    """
+    if not isinstance(purchase_pks, list) or len(purchase_pks) > settings.MAX_PURCHASES_PER_REQUEST:
+        raise InvalidTransmissionException('Expected a list of at most {} purchases.'.format(settings.MAX_PURCHASES_PER_REQUEST))
+    try:
+        return list(dict.fromkeys(int(pk) for pk in purchase_pks))
+    except (TypeError, ValueError):
+        raise InvalidTransmissionException('Invalid purchases: {}'.format(purchase_pks))
+
+
+def purchase_history_cursor(purchase):
+    """
+    Points just past this purchase, in /purchase-history/'s order: Perma passes it back as 'after'.
+    """
+    return '{}_{}'.format(purchase['date'].isoformat(), purchase['id'])
+
+
+def purchase_history_page_from_perma(data):
+    """
+    Validates the optional 'after' (a cursor), 'since' (a timestamp) and 'limit' fields sent to /purchase-history/,
+    returning them as arguments for PurchaseRequestResponse.customer_history. With none of them, returns None:
+    the whole history is wanted, as before pagination.
+    """
+    if not any(data.get(field) is not None for field in FIELDS_OPTIONAL_FROM_PERMA['purchase_history']):
+        return None
+    try:
+        after = None
+        if data.get('after') is not None:
+            after_datetime, after_id = data['after'].rsplit('_', 1)
+            after = (datetime.fromisoformat(after_datetime), int(after_id))
+        since = None
+        if data.get('since') is not None:
+            since = make_aware(datetime.fromtimestamp(data['since']))
+        limit = settings.PURCHASE_HISTORY_PAGE_SIZE
+        if data.get('limit') is not None:
+            limit = min(int(data['limit']), limit)
+    except (AttributeError, TypeError, ValueError, OverflowError, OSError):
+        raise InvalidTransmissionException('Invalid page of purchase history: {}'.format(data))
+    if limit < 1:
+        raise InvalidTransmissionException('Invalid page size: {}'.format(limit))
+    return {'after': after, 'since': since, 'limit': limit}
+
+
 def formatted_date_or_none(dt):
     if dt:
         return datetime.strftime(dt, '%Y-%m-%dT%H:%M:%S.%fZ')
@@ -298,27 +404,31 @@ def acknowledge_purchase(request):
     """
     try:
         data = process_perma_transmission(request.POST, FIELDS_REQUIRED_FROM_PERMA['acknowledge_purchase'])
+        [purchase_pk] = purchase_pks_from_perma([data['purchase_pk']])
     except InvalidTransmissionException:
         return bad_request(request)
 
-    with transaction.atomic():
-        try:
-            purchase = PurchaseRequestResponse.objects.select_for_update().get(pk=data['purchase_pk'])
-        except PurchaseRequestResponse.DoesNotExist:
-            logger.warning('Perma attempted to acknowledge non-existent purchase {}'.format(data['purchase_pk']))
-            return bad_request(request)
+    if PurchaseRequestResponse.acknowledge([purchase_pk])[purchase_pk] != 'acknowledged':
+        return bad_request(request)
+    return JsonResponse({'status': 'ok'})
 
-        if not purchase.inform_perma:
-            logger.warning('Perma attempted to acknowledge unacknowledgeable purchase {}'.format(data['purchase_pk']))
-            return bad_request(request)
-        if purchase.perma_acknowledged_at:
-            logger.warning('Perma attempted to acknowledge already-acknowledged purchase {}'.format(data['purchase_pk']))
-            return bad_request(request)
 
-        purchase.perma_acknowledged_at = datetime.now(tz=timezone(settings.TIME_ZONE))
-        purchase.save(update_fields=['perma_acknowledged_at'])
-        logger.info("Purchase {} acknowledged by Perma".format(data['purchase_pk']))
-        return JsonResponse({'status': 'ok'})
+@csrf_exempt
+@require_http_methods(["POST"])
+@sensitive_post_parameters('encrypted_data')
+def acknowledge_purchases(request):
+    """
+    Like /acknowledge-purchase/, for many purchases at once: for working through a backlog.
+    Takes a list of purchase pks, acknowledges all those that can be, and returns
+    what became of each: see PurchaseRequestResponse.acknowledge.
+    """
+    try:
+        data = process_perma_transmission(request.POST, FIELDS_REQUIRED_FROM_PERMA['acknowledge_purchases'])
+        purchase_pks = purchase_pks_from_perma(data['purchase_pks'])
+    except InvalidTransmissionException:
+        return bad_request(request)
+
+    return JsonResponse({'status': 'ok', 'purchases': PurchaseRequestResponse.acknowledge(purchase_pks)})
 
 
 @csrf_exempt
@@ -409,7 +519,7 @@ def change(request):
         return bad_request(request)
 
     # The user must have a subscription that can be updated.
-    sa = SubscriptionAgreement.customer_standing_subscription(data['customer_pk'], data['customer_type'])
+    sa = SubscriptionAgreement.customer_standing_subscription(data['customer_pk'], data['customer_type'], select_related=WITH_SUBSCRIPTION_REQUEST_RESPONSE)
     if not sa or not sa.can_be_altered():
         return render(request, 'generic.html', {'heading': "We're Having Trouble With Your Request",
                                                 'message': "We can't find any active subscriptions associated with your account.<br>" +
@@ -471,7 +581,7 @@ def update(request):
         return bad_request(request)
 
     # The user must have a subscription that can be updated.
-    sa = SubscriptionAgreement.customer_standing_subscription(data['customer_pk'], data['customer_type'])
+    sa = SubscriptionAgreement.customer_standing_subscription(data['customer_pk'], data['customer_type'], select_related=WITH_SUBSCRIPTION_REQUEST_RESPONSE)
     if not sa or not sa.can_be_altered():
         return render(request, 'generic.html', {'heading': "We're Having Trouble With Your Update Request",
                                                 'message': "We can't find any active subscriptions associated with your account.<br>" +
@@ -523,11 +633,32 @@ def cybersource_callback(request):
     except InvalidTransmissionException:
         return bad_request(request)
 
-    related_request = OutgoingTransaction.objects.get(transaction_uuid=data['req_transaction_uuid'])
+    record_cybersource_reply(request, data)
+    return render(request, 'generic.html', {'heading': 'CyberSource Callback', 'message': 'OK'})
+
+
+@transaction.atomic
+def record_cybersource_reply(request, data):
+    """
+    Saves CyberSource's reply to one of our requests, and acts on its decision.
+
+    CyberSource may deliver the same reply more than once, even simultaneously:
+    the related request stays locked until we're done, so each reply is recorded and acted on exactly once,
+    and duplicates are acknowledged without doing anything.
+    """
+    related_request = OutgoingTransaction.get_by_transaction_uuid(data['req_transaction_uuid'], for_update=True)
     decision = data['decision']
     reason_code = data['reason_code']
     message = data['message']
 
+    if related_request.response_recorded():
+        CYBERSOURCE_DUPLICATE_CALLBACKS.inc()
+        logger.info("Ignoring duplicate CyberSource callback for {}".format(related_request))
+        return
+
+    # count the reply only once it's recorded: not if recording it fails and is rolled back
+    transaction.on_commit(lambda: CYBERSOURCE_CALLBACKS.inc(decision=decision, reason_code=reason_code))
+
     if isinstance(related_request, UpdateRequest):
         Response.save_new_with_encrypted_full_response(
             UpdateRequestResponse,
@@ -590,8 +721,6 @@ def cybersource_callback(request):
     else:
         raise NotImplementedError("Can't handle a response of type {}, returned in response to outgoing transaction {}".format(type(related_request), related_request.pk))
 
-    return render(request, 'generic.html', {'heading': 'CyberSource Callback', 'message': 'OK'})
-
 
 @csrf_exempt
 @require_http_methods(["POST"])
@@ -606,33 +735,70 @@ def subscription(request):
     except InvalidTransmissionException:
         return bad_request(request)
 
-    standing_subscription = SubscriptionAgreement.customer_standing_subscription(data['customer_pk'], data['customer_type'])
-    if not standing_subscription:
-        subscription = None
-    else:
-        subscription = {
-            'link_limit': standing_subscription.current_link_limit,
-            'link_limit_effective_timestamp': formatted_date_or_none(standing_subscription.current_link_limit_effective_timestamp),
-            'rate': standing_subscription.current_rate,
-            'frequency': standing_subscription.current_frequency,
-            'paid_through': formatted_date_or_none(standing_subscription.paid_through),
-            'reference_number': standing_subscription.subscription_request.reference_number
-        }
-
-        if standing_subscription.cancellation_requested and standing_subscription.status != 'Canceled':
-            subscription['status'] = 'Cancellation Requested'
-        else:
-            subscription['status'] = standing_subscription.status
-
-    # Mention any bonus links that have been purchased, but not yet acknowledged
-    purchases = PurchaseRequestResponse.customer_unacknowledged(data['customer_pk'], data['customer_type'])
+    # Perma asks on almost every page load: cache the answer until something changes.
+    # See forget_subscription_statuses.
+    customer = (data['customer_pk'], data['customer_type'])
+    cache_key = subscription_status_cache_keys([customer])[customer]
+    status = cache.get(cache_key)
+    if status is None:
+        with use_replica(customers=[customer]):
+            status = customer_subscription_status(data['customer_pk'], data['customer_type'])
+        cache.set(cache_key, status, settings.SUBSCRIPTION_STATUS_CACHE_TIMEOUT)
 
     response = {
         'customer_pk': data['customer_pk'],
         'customer_type': data['customer_type'],
-        'subscription': subscription,
+        'subscription': status['subscription'],
         'timestamp': datetime.utcnow().timestamp(),
-        'purchases': purchases
+        'purchases': status['purchases']
+    }
+    return JsonResponse({'encrypted_data': prep_for_perma(response).decode('ascii')})
+
+
+@csrf_exempt
+@require_http_methods(["POST"])
+@sensitive_post_parameters('encrypted_data')
+def subscriptions(request):
+    """
+    Like /subscription/, for many customers at once: for Perma's nightly jobs and dashboards.
+    Takes a list of [customer_pk, customer_type] pairs, and returns a list of
+    what /subscription/ would have returned for each, minus the timestamp.
+    Where /subscription/ would have failed, because the customer has more than one
+    standing subscription, their entry has an 'error' instead.
+    """
+    try:
+        data = process_perma_transmission(request.POST, FIELDS_REQUIRED_FROM_PERMA['subscriptions'])
+        customers = customers_from_perma(data['customers'])
+    except InvalidTransmissionException:
+        return bad_request(request)
+
+    # Use any cached statuses; look the rest up all at once, and cache them too.
+    cache_keys = subscription_status_cache_keys(customers)
+    cached = cache.get_many(cache_keys.values())
+    statuses = {customer: cached[key] for customer, key in cache_keys.items() if key in cached}
+    missing = [customer for customer in customers if customer not in statuses]
+    if missing:
+        with use_replica(customers=missing):
+            standing_subscriptions = SubscriptionAgreement.customers_standing_subscriptions(missing)
+            purchases = PurchaseRequestResponse.customers_unacknowledged(missing)
+        fetched = {
+            customer: subscription_status(standing_subscriptions[customer], purchases[customer])
+            for customer in missing if not isinstance(standing_subscriptions[customer], SubscriptionAgreement.MultipleObjectsReturned)
+        }
+        cache.set_many({cache_keys[customer]: status for customer, status in fetched.items()}, settings.SUBSCRIPTION_STATUS_CACHE_TIMEOUT)
+        statuses.update(fetched)
+        # already logged; don't cache, so that the error clears as soon as the duplicates are cleaned up
+        statuses.update({customer: {'error': 'Multiple standing subscriptions found.'} for customer in missing if customer not in fetched})
+
+    response = {
+        'subscriptions': [
+            {
+                'customer_pk': customer_pk,
+                'customer_type': customer_type,
+                **statuses[(customer_pk, customer_type)]
+            } for customer_pk, customer_type in customers
+        ],
+        'timestamp': datetime.utcnow().timestamp()
     }
     return JsonResponse({'encrypted_data': prep_for_perma(response).decode('ascii')})
 
@@ -642,19 +808,37 @@ def subscription(request):
 @sensitive_post_parameters('encrypted_data')
 def purchase_history(request):
     """
-    Returns a customer's one-time purchase history.
+    Returns a customer's one-time purchase history, oldest first.
+
+    Perma may ask for a page of it at a time, by sending any of 'limit' (at most PURCHASE_HISTORY_PAGE_SIZE,
+    the default), 'since' (a timestamp: only purchases requested since then) and 'after' (the 'cursor'
+    returned with the previous page). 'has_more' says whether there is a next page. Once there isn't, the
+    cursor can be kept, to fetch only newer purchases later. (A purchase is dated when requested, but only
+    appears here once accepted: one accepted after a later-requested purchase was fetched won't come after
+    the cursor; it is reported through /subscription/ until acknowledged, regardless.)
     """
     try:
-        data = process_perma_transmission(request.POST, FIELDS_REQUIRED_FROM_PERMA['subscription'])
+        data = process_perma_transmission(request.POST, FIELDS_REQUIRED_FROM_PERMA['subscription'], FIELDS_OPTIONAL_FROM_PERMA['purchase_history'])
+        page = purchase_history_page_from_perma(data)
     except InvalidTransmissionException:
         return bad_request(request)
 
-    purchase_history = PurchaseRequestResponse.customer_history(data['customer_pk'], data['customer_type'])
+    with use_replica(customers=[(data['customer_pk'], data['customer_type'])]):
+        if page is None:
+            purchase_history = PurchaseRequestResponse.customer_history(data['customer_pk'], data['customer_type'])
+            has_more = False
+        else:
+            # one extra, to see whether there's another page
+            purchase_history = PurchaseRequestResponse.customer_history(data['customer_pk'], data['customer_type'], **dict(page, limit=page['limit'] + 1))
+            has_more = len(purchase_history) > page['limit']
+            purchase_history = purchase_history[:page['limit']]
 
     response = {
         'customer_pk': data['customer_pk'],
         'customer_type': data['customer_type'],
         'purchase_history': purchase_history,
+        'cursor': purchase_history_cursor(purchase_history[-1]) if purchase_history else data.get('after'),
+        'has_more': has_more,
         'timestamp': datetime.utcnow().timestamp()
     }
     return JsonResponse({'encrypted_data': prep_for_perma(response).decode('ascii')})
@@ -673,7 +857,7 @@ def cancel_request(request):
         return bad_request(request)
 
     # The user must have a subscription that can be canceled.
-    sa = SubscriptionAgreement.customer_standing_subscription(data['customer_pk'], data['customer_type'])
+    sa = SubscriptionAgreement.customer_standing_subscription(data['customer_pk'], data['customer_type'], select_related=WITH_SUBSCRIPTION_REQUEST)
     if not sa or not sa.can_be_altered():
         return render(request, 'generic.html', {'heading': "We're Having Trouble With Your Cancellation Request",
                                                 'message': "We can't find any active subscriptions associated with your account.<br>" +
@@ -690,9 +874,14 @@ def cancel_request(request):
         'merchant_reference_number': sa.subscription_request.reference_number
     }
     logger.info("Cancellation request received from {} {} for {}".format(data['customer_pk'], data['customer_type'], context['merchant_reference_number']))
-    send_self_email('ACTION REQUIRED: cancellation request received', request, template="email/cancel.txt", context=context, devs_only=False)
-    sa.cancellation_requested = True
-    sa.save(update_fields=['cancellation_requested'])
+    # Queue the email to staff and record the request together, or not at all.
+    # Forgetting and refreshing wait until this commits.
+    with transaction.atomic():
+        send_self_email('ACTION REQUIRED: cancellation request received', request, template="email/cancel.txt", context=context, devs_only=False)
+        sa.cancellation_requested = True
+        sa.save(update_fields=['cancellation_requested'])
+        forget_subscription_statuses([(sa.customer_pk, sa.customer_type)])
+        refresh_subscription_summary()
     return redirect(settings.PERMA_SUBSCRIPTION_CANCELED_REDIRECT_URL)
 
 
@@ -700,33 +889,60 @@ def cancel_request(request):
 @require_http_methods(["POST"])
 @sensitive_post_parameters('encrypted_data')
 def update_statuses(request):
-    csv_file = request.FILES['csv_file']
-    skip_lines(csv_file, 4)
-    for row in in_mem_csv_to_dict_reader(csv_file):
-        reference = row['Merchant Reference Code']
-        status = row['Status'].capitalize()
-        try:
-            sa = SubscriptionAgreement.objects.filter(subscription_request__reference_number=reference).get()
-        except ObjectDoesNotExist:
-            if settings.RAISE_IF_SUBSCRIPTION_NOT_FOUND:
-                log_level = logging.ERROR
-            else:
-                log_level = logging.INFO
-            logger.log(log_level, "CyberSource reports a subscription {}: no corresponding record found".format(reference))
-            continue
-        except MultipleObjectsReturned:
-            if settings.RAISE_IF_MULTIPLE_SUBSCRIPTIONS_FOUND:
-                log_level = logging.ERROR
-            else:
-                log_level = logging.INFO
-            logger.log(log_level, "Multiple subscription requests associated with {}.".format(reference))
-            continue
-
-        sa.status = status
-        sa.paid_through = sa.calculate_paid_through_date_from_reported_status(status)
-        sa.full_clean()
-        sa.save(update_fields=['status', 'paid_through'])
-        logger.info("Updated subscription status for {} to {}".format(reference, status))
-
-    return render(request, 'generic.html', {'heading': "Statuses Updated",
-                                            'message': "Check the application log for details."})
+    """
+    Applies a subscription report from the CyberSource Business Center to our records.
+    Large reports should be applied in the background: see status_update_job.
+    """
+    if request.POST.get('background'):
+        job = enqueue_status_update_job(request.FILES['csv_file'], user=request.user)
+        return redirect('status_update_job', pk=job.pk)
+
+    rows = uploaded_csv_to_dict_reader(request.FILES['csv_file'], skip=REPORT_PREAMBLE_LINES)
+    # tally results as they come, keeping only the first few problems, rather than every row
+    counts = Counter()
+    problems = []
+    for result in SubscriptionAgreement.apply_status_report(rows, user=request.user):
+        counts[result['outcome']] += 1
+        if result['outcome'] in PROBLEM_OUTCOMES and len(problems) < settings.STATUS_UPDATE_MAX_PROBLEMS:
+            problems.append(result)
+    return render(request, 'update_statuses.html', {
+        'heading': "Statuses Updated",
+        'rows_processed': sum(counts.values()),
+        'counts': dict(counts),
+        'problems': problems,
+        'problems_not_shown': sum(counts[outcome] for outcome in PROBLEM_OUTCOMES) - len(problems)
+    })
+
+
+@user_passes_test_or_403(lambda user: user.is_staff)
+@require_http_methods(["GET", "POST"])
+def status_update_job(request, pk):
+    """
+    Reports the progress of a background status update; POST to re-run a failed or abandoned one.
+    """
+    job = get_object_or_404(StatusUpdateJob, pk=pk)
+    if request.method == "POST":
+        if not job.can_be_rerun():
+            return bad_request(request)
+        rerun_status_update_job(job)
+        return redirect('status_update_job', pk=job.pk)
+    return render(request, 'status_update_job.html', {'heading': "Status Update {}".format(job.pk), 'job': job})
+
+
+def is_metrics_scraper(request):
+    """
+    Whether the request carries settings.METRICS_TOKEN as a bearer token, if one is configured.
+    """
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    return bool(settings.METRICS_TOKEN) and scheme == 'Bearer' and safe_str_cmp(token, settings.METRICS_TOKEN)
+
+
+@require_http_methods(["GET"])
+def metrics(request):
+    """
+    Payment flow metrics, in the Prometheus text format.
+    For staff, or for a scraper with the metrics token: see is_metrics_scraper.
+    """
+    if not (request.user.is_staff or is_metrics_scraper(request)):
+        raise PermissionDenied
+    return HttpResponse(render_metrics(), content_type=METRICS_CONTENT_TYPE)
@@ -76,7 +76,7 @@ def find_pending_cancellation_requests(ctx, tier='dev'):
     Report pending cancellation requests.
     """
     from perma_payments.constants import CS_SUBSCRIPTION_SEARCH_URL  #noqa
-    from perma_payments.email import send_self_email  #noqa
+    from perma_payments.email import send_self_email, send_queued_emails  #noqa
     from perma_payments.models import SubscriptionAgreement  #noqa
     from django.test.client import RequestFactory  #noqa
     from django.conf import settings  #noqa
@@ -114,3 +114,312 @@ def find_pending_cancellation_requests(ctx, tier='dev'):
             },
             devs_only=False
         )
+    # don't leave the report in the queue when we exit
+    send_queued_emails()
+
+
+@task
+@setup_django
+def process_status_update_jobs(ctx):
+    """
+    Apply any queued status reports, e.g. if the web process that queued them restarted first.
+    """
+    from perma_payments.status_reports import process_status_update_jobs  #noqa
+    process_status_update_jobs()
+
+
+@task
+@setup_django
+def send_queued_emails(ctx):
+    """
+    Send any queued emails that are due, e.g. if the web process that queued them restarted first.
+    Run periodically, to pick up retries.
+    """
+    from django.db.models import Count  #noqa
+    from perma_payments.email import send_queued_emails  #noqa
+    from perma_payments.models import OutgoingEmail  #noqa
+
+    send_queued_emails()
+    for row in OutgoingEmail.objects.exclude(status='Sent').values('status').annotate(count=Count('id')):
+        print("{count} {status}".format(**row))
+
+
+@task
+@setup_django
+def encrypt_pending_full_responses(ctx):
+    """
+    Encrypt and store any full responses left staged by ENCRYPT_RESPONSES_IN_BACKGROUND, e.g. after a
+    process was killed. See perma_payments/response_encryption.py. Run after deploys, or from cron.
+    """
+    from perma_payments.response_encryption import encrypt_pending_full_responses  #noqa
+    failed = encrypt_pending_full_responses()
+    if failed:
+        print("Could not encrypt: Response {}".format(', '.join(str(pk) for pk in failed)))
+
+
+@task
+@setup_django
+def reencrypt_full_responses(ctx, after_id=0, chunk_size=500, processes=None):
+    """
+    Re-encrypt stored full responses under STORAGE_ENCRYPTION_KEYS, after rotating them.
+    See perma_payments/key_rotation.py. Resumable: pass --after-id=<the last id reported>.
+    """
+    from perma_payments.key_rotation import reencrypt_full_responses  #noqa
+
+    def report(summary):
+        print("{rows} rows re-encrypted ({rows_per_second:.0f}/s); last id {last_id}".format(**summary))
+
+    summary = reencrypt_full_responses(
+        after_id=int(after_id),
+        chunk_size=int(chunk_size),
+        processes=None if processes is None else int(processes),
+        progress=report
+    )
+    print("Done: {} rows in {:.1f}s.".format(summary['rows'], summary['seconds']))
+    if summary['failed']:
+        print("Could not decrypt: Response {}".format(', '.join(str(pk) for pk in summary['failed'])))
+
+
+@task
+@setup_django
+def refresh_subscription_summary(ctx):
+    """
+    Refresh the subscription counts on the admin dashboard, e.g. from cron, or after editing subscriptions in the admin.
+    """
+    from perma_payments.models import SubscriptionSummary  #noqa
+    SubscriptionSummary.refresh()
+    for status, count in SubscriptionSummary.dashboard()['by_status']:
+        print("{} {}".format(count, status))
+
+
+@task
+@setup_django
+def reference_number_occupancy(ctx):
+    """
+    Report how crowded the reference number keyspace is.
+    """
+    from perma_payments.models import ReferenceNumber  #noqa
+
+    occupancy = ReferenceNumber.occupancy()
+    print("{allocated} of {keyspace} reference numbers allocated ({occupancy:.4%}): "
+          "{expected_attempts:.3f} attempts per allocation expected; "
+          "{exhaustion_probability:.2e} chance of giving up.".format(**occupancy))
+
+
+@task
+@setup_django
+def benchmark_reference_numbers(ctx, allocations=1000, digits='0123'):
+    """
+    Measure reference number allocation latency as the keyspace fills up.
+
+    The production keyspace is too big to fill, so this shrinks it to numbers made of <digits>,
+    fills that to each level of occupancy, and allocates <allocations> numbers at each.
+    Everything happens inside a transaction that is rolled back.
+    """
+    import itertools  #noqa
+    import random  #noqa
+    import statistics  #noqa
+    import time  #noqa
+    from django.db import transaction  #noqa
+    from perma_payments import models  #noqa
+
+    keyspace = ["PERMA-{}-{}".format(''.join(a), ''.join(b)) for a, b in itertools.product(
+        itertools.product(digits, repeat=4), itertools.product(digits, repeat=4)
+    )]
+    random.shuffle(keyspace)
+    original_rn_set = models.RN_SET
+    models.RN_SET = digits
+    try:
+        with transaction.atomic():
+            filled = 0
+            for occupancy in [0, 0.25, 0.5, 0.75, 0.9]:
+                target = int(len(keyspace) * occupancy)
+                models.ReferenceNumber.objects.bulk_create(
+                    [models.ReferenceNumber(reference_number=rn) for rn in keyspace[filled:target]],
+                    ignore_conflicts=True
+                )
+                filled = target
+                timings = []
+                allocated = []
+                for _ in range(allocations):
+                    start = time.perf_counter()
+                    allocated.append(models.generate_reference_number())
+                    timings.append((time.perf_counter() - start) * 1000)
+                # don't let this round's allocations count towards the next level
+                models.ReferenceNumber.objects.filter(reference_number__in=allocated).delete()
+                percentiles = statistics.quantiles(timings, n=100)
+                print("{:>4.0%} full: p50 {:.2f}ms, p95 {:.2f}ms, p99 {:.2f}ms".format(
+                    occupancy, percentiles[49], percentiles[94], percentiles[98]
+                ))
+            transaction.set_rollback(True)
+    finally:
+        models.RN_SET = original_rn_set
+
+
+@task
+@setup_django
+def benchmark_key_cache(ctx, iterations=1000):
+    """
+    Compare the per-request crypto cost of the /subscription/ and /purchase/ paths,
+    rebuilding key material for every message (as we used to) vs. using the cached boxes.
+    """
+    import timeit  #noqa
+    from datetime import datetime  #noqa
+    from perma_payments import security  #noqa
+
+    request = security.prep_for_perma({'customer_pk': 1, 'customer_type': 'Registrar', 'timestamp': datetime.utcnow().timestamp()})
+    response = {'customer_pk': 1, 'customer_type': 'Registrar', 'subscription': None, 'purchases': [], 'timestamp': datetime.utcnow().timestamp()}
+
+    def purchase(rebuild):
+        if rebuild:
+            security._boxes.clear()
+        security.decrypt_from_perma(request)
+
+    def subscription(rebuild):
+        purchase(rebuild)
+        if rebuild:
+            security._boxes.clear()
+        security.prep_for_perma(response)
+
+    for name, path in [('/purchase/', purchase), ('/subscription/', subscription)]:
+        rebuilt = timeit.timeit(lambda: path(True), number=iterations) / iterations * 1e6
+        cached = timeit.timeit(lambda: path(False), number=iterations) / iterations * 1e6
+        print(f"{name}: {rebuilt:.1f}µs rebuilding keys, {cached:.1f}µs cached, {rebuilt - cached:.1f}µs saved per request")
+
+
+@task
+@setup_django
+def benchmark_signing(ctx, iterations=10000):
+    """
+    Compare the cost of signing a typical request to CyberSource and verifying a typical reply,
+    keying an hmac for every message (as we used to) vs. using the pre-keyed signer.
+    """
+    import base64  #noqa
+    import hashlib  #noqa
+    import hmac  #noqa
+    import timeit  #noqa
+    from collections import OrderedDict  #noqa
+    from django.conf import settings  #noqa
+    from perma_payments import security  #noqa
+
+    fields = {'field_{}'.format(i): 'value {}'.format(i) for i in range(25)}
+    reply = OrderedDict(sorted(fields.items()), signed_field_names=','.join(sorted(fields) + ['signed_field_names']))
+
+    def old_sign(data):
+        message = ','.join('{}={}'.format(key, data[key]) for key in data)
+        return base64.b64encode(hmac.new(bytes(settings.CS_SECRET_KEY, 'utf-8'), bytes(message, 'utf-8'), hashlib.sha256).digest())
+
+    paths = [
+        ('sign', lambda: old_sign(dict(sorted(fields.items()))), lambda: security.sign_data(security.stringify_for_signature(fields))),
+        ('verify', lambda: security.safe_str_cmp(b'', old_sign(reply)), lambda: security.is_valid_signature(reply, b'')),
+    ]
+    for name, old, new in paths:
+        rekeyed = timeit.timeit(old, number=iterations) / iterations * 1e6
+        prekeyed = timeit.timeit(new, number=iterations) / iterations * 1e6
+        print(f"{name}: {rekeyed:.2f}µs keying per message, {prekeyed:.2f}µs pre-keyed, {rekeyed - prekeyed:.2f}µs saved")
+
+
+@task
+@setup_django
+def benchmark_connections(ctx, iterations=200):
+    """
+    Compare the database cost of a request that makes one query: connecting for every request
+    (CONN_MAX_AGE=0), reusing a persistent connection (CONN_MAX_AGE > 0, with and without
+    CONN_HEALTH_CHECKS), and borrowing from a pool (perma_payments.postgresql_pool).
+    Run against the docker Postgres, or wherever DATABASES['default'] points.
+    """
+    import timeit  #noqa
+    from django.db import connections  #noqa
+    from django.db.backends.postgresql.base import DatabaseWrapper  #noqa
+    from perma_payments.postgresql_pool.base import DatabaseWrapper as PooledDatabaseWrapper, close_pools  #noqa
+
+    def wrapper(backend, **settings):
+        return backend({**connections['default'].settings_dict, **settings}, 'benchmark')
+
+    wrappers = {
+        'cold': wrapper(DatabaseWrapper, CONN_MAX_AGE=0, CONN_HEALTH_CHECKS=False),
+        'persistent': wrapper(DatabaseWrapper, CONN_MAX_AGE=None, CONN_HEALTH_CHECKS=False),
+        'persistent, health checked': wrapper(DatabaseWrapper, CONN_MAX_AGE=None, CONN_HEALTH_CHECKS=True),
+        'pooled': wrapper(PooledDatabaseWrapper, CONN_MAX_AGE=0, CONN_HEALTH_CHECKS=False),
+        'pooled, health checked': wrapper(PooledDatabaseWrapper, CONN_MAX_AGE=0, CONN_HEALTH_CHECKS=True),
+    }
+
+    def request(connection):
+        # what Django does around each request
+        connection.close_if_health_check_failed()
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+        connection.close_if_unusable_or_obsolete()
+
+    try:
+        for name, connection in wrappers.items():
+            request(connection)  # warm up: open the persistent connection, fill the pool
+            seconds = timeit.timeit(lambda: request(connection), number=iterations)
+            print(f"{name}: {seconds / iterations * 1e3:.3f}ms per request")
+    finally:
+        for connection in wrappers.values():
+            connection.close()
+        close_pools()
+
+
+@task
+@setup_django
+def benchmark_endpoints(ctx, endpoints='', requests=200, concurrency=1, customers=500, purchases=5, output='', baseline=''):
+    """
+    Load-test the routes Perma.cc and CyberSource talk to, against a throwaway database.
+
+    Seeds <customers> customers, each with a subscription and <purchases> purchases, then sends
+    <requests> requests to each of <endpoints> (comma-separated; default all) from <concurrency> threads.
+    Prints latency percentiles, queries per request and requests per second; writes them as JSON
+    to <output>, if given, and shows how they changed since the JSON in <baseline>, if given.
+    """
+    import json  #noqa
+    import logging  #noqa
+    import platform  #noqa
+    from datetime import datetime  #noqa
+    import django  #noqa
+    from django.test.utils import setup_databases, setup_test_environment, teardown_databases, teardown_test_environment  #noqa
+    from perma_payments import benchmarks  #noqa
+
+    endpoints = endpoints.split(',') if endpoints else list(benchmarks.SCENARIOS)
+    results = {
+        'meta': {
+            'commit': subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip(),
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'django': django.get_version(),
+            'python': platform.python_version(),
+            'customers': int(customers),
+            'purchases_per_customer': int(purchases),
+            'requests': int(requests),
+            'concurrency': int(concurrency),
+        },
+        'endpoints': {},
+    }
+
+    setup_test_environment()
+    old_config = setup_databases(verbosity=1, interactive=False, aliases={'default'})
+    # per-request logging would drown out the results, and slow things down
+    logging.disable(logging.INFO)
+    try:
+        print("Seeding {} customers...".format(customers))
+        seeded = benchmarks.seed(int(customers), int(purchases))
+        for endpoint in endpoints:
+            result = benchmarks.benchmark_endpoint(endpoint, seeded, int(requests), int(concurrency))
+            results['endpoints'][endpoint] = result
+            print("{:<22} p50 {p50:>7.2f}ms  p95 {p95:>7.2f}ms  p99 {p99:>7.2f}ms  {:>5.1f} queries  {:>7.1f} req/s  {} errors".format(
+                endpoint, result['queries_per_request']['mean'], result['requests_per_second'], result['errors'], **result['latency_ms']
+            ))
+    finally:
+        logging.disable(logging.NOTSET)
+        teardown_databases(old_config, verbosity=1)
+        teardown_test_environment()
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write('\n')
+    if baseline:
+        with open(baseline) as f:
+            print("\nSince {}:".format(baseline))
+            for endpoint, metric, before, after, change in benchmarks.compare(json.load(f), results):
+                print("{:<22} {:<8} {:>9} -> {:>9}  {:+.0f}%".format(endpoint, metric, before, after, change))